@@ -1,12 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, g, Response
+import click
+import itertools
 import json
 import os
 import threading
 import time
 from datetime import datetime, timedelta
 from functools import wraps
+import recurrence
+import storage
 import utils
-from config import EMAIL_VERIFICATION_ENABLED, MAX_MESSAGES_PER_DAY_UNFOLLOWED, REMINDER_TIMES, REMINDER_CHECK_SECRET
+from dashboard import cache as dashboard_cache
+from scheduler import reminders as reminder_scheduler
+from config import EMAIL_VERIFICATION_ENABLED, MAX_MESSAGES_PER_DAY_UNFOLLOWED, REMINDER_TIMES, REMINDER_CHECK_SECRET, TASK_RANGE_MAX_DAYS
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'
@@ -19,21 +25,28 @@ config = utils.load_config()
 if 'email_verification_enabled' in config:
     EMAIL_VERIFICATION_ENABLED = config['email_verification_enabled']
 
+# 预建二级索引（按用户、会话等查询时无需全表扫描）
+utils.store.build_indexes()
+for field, value, user_ids in utils.find_identity_collisions():
+    print(f"[存储] {'用户名' if field == 'username' else '邮箱'} {value!r} 被多个用户使用（忽略大小写）: {user_ids}，"
+          f"登录时优先大小写完全一致的用户，其次 id 最小的用户，请为其他用户改名或更换邮箱")
+if utils.router.enabled:
+    for name in utils.router.SHARDED:
+        if utils.store.read(name):
+            print(f'[存储] 已启用分片存储，但 {name} 中仍有未迁移的数据，请执行 flask --app app shard-data')
+
 # Custom template filters
 from datetime import datetime
 
 @app.template_filter('time_ago')
-def time_ago_filter(date_str):
-    """将ISO时间字符串转换为相对时间描述"""
-    if not date_str:
+def time_ago_filter(value):
+    """将时间（记录中预先计算的 *_ts 纪元秒，或ISO时间字符串）转换为相对时间描述"""
+    if not value:
         return ''
-    try:
-        date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-    except ValueError:
-        return date_str
-    now = datetime.now()
-    delta = now - date
-    seconds = delta.total_seconds()
+    ts = utils.to_timestamp(value)
+    if ts is None:
+        return value
+    seconds = time.time() - ts
     if seconds < 60:
         return '刚刚'
     minutes = seconds / 60
@@ -52,26 +65,29 @@ def time_ago_filter(date_str):
     return f'{int(years)}年前'
 
 @app.template_filter('format_date')
-def format_date_filter(date_str):
+def format_date_filter(value):
     """格式化日期时间"""
-    if not date_str:
+    if not value:
         return ''
-    try:
-        date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-        return date.strftime('%Y-%m-%d %H:%M')
-    except ValueError:
-        return date_str
+    ts = utils.to_timestamp(value)
+    if ts is None:
+        return value
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')
 
 @app.template_filter('format_time')
-def format_time_filter(date_str):
+def format_time_filter(value):
     """仅格式化时间部分"""
-    if not date_str:
+    if not value:
         return ''
-    try:
-        date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-        return date.strftime('%H:%M')
-    except ValueError:
-        return date_str
+    ts = utils.to_timestamp(value)
+    if ts is None:
+        return value
+    return datetime.fromtimestamp(ts).strftime('%H:%M')
+
+@app.template_filter('recurrence_text')
+def recurrence_text_filter(rule):
+    """重复规则的中文描述"""
+    return recurrence.describe(rule) if rule else '不重复'
 
 @app.template_filter('truncate')
 def truncate_filter(text, length=200):
@@ -99,6 +115,33 @@ def post_content_filter(content):
     content = content.replace('\n', '<br>')
     return content
 
+# 请求级数据上下文：每个集合/记录在一次请求内只读取一次，写入在请求结束时合并提交
+@app.before_request
+def open_data_context():
+    g.data_context = utils.store.begin()
+    g.data_context.__enter__()
+
+@app.after_request
+def flush_data_context(response):
+    data_context = g.get('data_context')
+    if data_context is not None:
+        # 服务器错误时不提交该请求的缓冲写入；提交失败时让请求以错误结束而不是静默丢失
+        if response.status_code < 500:
+            data_context.flush()
+        stats = data_context.stats()
+        response.headers['X-Data-Reads'] = str(stats['reads'])
+        response.headers['X-Data-Reads-Avoided'] = str(stats['reads_avoided'])
+    return response
+
+@app.teardown_request
+def close_data_context(exc):
+    data_context = g.pop('data_context', None)
+    if data_context is not None:
+        data_context.close()
+        app.logger.debug('%s %s: 数据读取 %d 次，避免重复读取 %d 次，缓冲写入 %d 条，提交 %d 次',
+                         request.method, request.path, data_context.reads, data_context.reads_avoided,
+                         data_context.writes_buffered, data_context.flushes)
+
 # Login required decorator
 def login_required(f):
     @wraps(f)
@@ -122,10 +165,7 @@ def admin_required(f):
 # Context processor to inject variables into templates
 @app.context_processor
 def inject_variables():
-    def get_unread_count(user_id):
-        notifications = utils.get_user_notifications(user_id)
-        return sum(1 for n in notifications if not n.get('read'))
-    return dict(get_unread_count=get_unread_count, EMAIL_VERIFICATION_ENABLED=EMAIL_VERIFICATION_ENABLED, REMINDER_TIMES=REMINDER_TIMES)
+    return dict(get_unread_count=utils.count_unread_notifications, EMAIL_VERIFICATION_ENABLED=EMAIL_VERIFICATION_ENABLED, REMINDER_TIMES=REMINDER_TIMES)
 
 @app.route('/')
 def index():
@@ -136,18 +176,8 @@ def index():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    user_id = session['user_id']
-    tasks = utils.get_tasks_by_user(user_id)
-    stats = {
-        'total_tasks': len(tasks),
-        'completed_tasks': sum(1 for t in tasks if t.get('status') == 'completed'),
-        'in_progress_tasks': sum(1 for t in tasks if t.get('status') == 'in_progress'),
-        'pending_tasks': sum(1 for t in tasks if t.get('status') == 'pending'),
-    }
-    recent_tasks = sorted(tasks, key=lambda x: x.get('created_at', ''), reverse=True)[:5]
-    recent_notifications = utils.get_user_notifications(user_id)[:5]
-    quota = utils.get_test_email_quota(user_id)
-    return render_template('dashboard.html', stats=stats, recent_tasks=recent_tasks, recent_notifications=recent_notifications, quota=quota)
+    # 计数、最近任务/通知和配额来自按用户缓存的快照，由写入事件增量更新
+    return render_template('dashboard.html', **dashboard_cache.get(session['user_id']))
 
 # Authentication routes
 @app.route('/login', methods=['GET', 'POST'])
@@ -217,7 +247,12 @@ def register():
             session.pop('verification_email', None)
             session.pop('verification_sent_at', None)
         
-        user_id = utils.create_user(username, password, email, verified)
+        try:
+            user_id = utils.create_user(username, password, email, verified)
+        except utils.DuplicateKeyError as e:
+            # 并发注册时唯一索引兜底
+            flash('用户名已存在' if e.field == 'username_key' else '邮箱已被注册', 'danger')
+            return redirect(url_for('register'))
         session['user_id'] = user_id
         session['username'] = username
         flash('注册成功', 'success')
@@ -261,12 +296,69 @@ def logout():
     return redirect(url_for('index'))
 
 # Tasks routes
+def _is_date(value):
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+        return True
+    except ValueError:
+        return False
+
 @app.route('/tasks')
 @login_required
 def tasks():
     user_id = session['user_id']
-    task_list = utils.get_tasks_by_user(user_id)
-    return render_template('tasks.html', tasks=task_list)
+    status = request.args.get('status')
+    if status not in ('pending', 'in_progress', 'completed'):
+        status = None
+    per_page = min(max(request.args.get('per_page', default=20, type=int), 1), 100)
+    start_from = request.args.get('start_from', '')
+    start_to = request.args.get('start_to', '')
+    start_from_ts = utils.day_start_timestamp(datetime.strptime(start_from, '%Y-%m-%d')) if _is_date(start_from) else None
+    start_to_ts = (utils.day_start_timestamp(datetime.strptime(start_to, '%Y-%m-%d') + timedelta(days=1))
+                   if _is_date(start_to) else None)
+    after = utils.decode_cursor(request.args.get('after'))
+    task_list, cursor = utils.get_tasks_page(user_id, per_page, after, status, start_from_ts, start_to_ts)
+    filters = {'status': status, 'start_from': start_from, 'start_to': start_to, 'per_page': per_page}
+    return render_template('tasks.html', tasks=task_list, filters=filters, is_first_page=after is None,
+                           next_cursor=utils.encode_cursor(cursor))
+
+@app.route('/tasks/search')
+@login_required
+def search_tasks():
+    """全文检索任务：自己的任务以及其他用户展示到主页的任务"""
+    query = request.args.get('q', '').strip()
+    mine = request.args.get('mine') == '1'
+    results = utils.search_tasks(session['user_id'], query, 50, mine) if query else []
+    return render_template('search.html', query=query, mine=mine, results=results)
+
+@app.route('/api/tasks/search')
+@login_required
+def api_search_tasks():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '缺少 q 参数'}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    tasks = utils.search_tasks(session['user_id'], query, limit, request.args.get('mine') == '1')
+    return jsonify([{
+        'id': task['id'],
+        'user_id': task['user_id'],
+        'name': task['name'],
+        'start_time': task.get('start_time'),
+        'location': task.get('location', ''),
+        'status': task['status'],
+    } for task in tasks])
+
+def _recurrence_from_form():
+    """从表单读取重复规则，未选择重复时返回 None"""
+    freq = request.form.get('recurrence_freq')
+    if not freq:
+        return None
+    return {
+        'freq': freq,
+        'interval': request.form.get('recurrence_interval'),
+        'count': request.form.get('recurrence_count'),
+        'until': request.form.get('recurrence_until'),
+    }
 
 @app.route('/tasks/add', methods=['GET', 'POST'])
 @login_required
@@ -298,12 +390,54 @@ def add_task():
             'notes': notes,
             'show_on_homepage': show_on_homepage,
             'reminder_times': reminder_times,
+            'recurrence': _recurrence_from_form(),
         }
-        task_id = utils.add_task(session['user_id'], task_data)
+        try:
+            task_id = utils.add_task(session['user_id'], task_data)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return render_template('add_task.html')
         flash('任务添加成功', 'success')
         return redirect(url_for('tasks'))
     return render_template('add_task.html')
 
+@app.route('/tasks/import', methods=['POST'])
+@login_required
+def import_tasks():
+    """批量导入任务（NDJSON 或 CSV 文件，按扩展名识别）"""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('请选择要导入的文件', 'danger')
+        return redirect(url_for('tasks'))
+    filename = upload.filename.lower()
+    if filename.endswith('.csv'):
+        rows = utils.iter_csv_rows(upload.stream)
+    elif filename.endswith(('.ndjson', '.jsonl')):
+        rows = utils.iter_ndjson_rows(upload.stream)
+    else:
+        flash('只支持 .ndjson / .jsonl / .csv 文件', 'danger')
+        return redirect(url_for('tasks'))
+    count, errors = utils.import_tasks(session['user_id'], rows)
+    if errors:
+        # 只显示前几条错误，避免消息过长
+        flash('导入失败，未导入任何任务：' + '；'.join(errors[:5]) + ('……' if len(errors) > 5 else ''), 'danger')
+    elif count == 0:
+        flash('文件中没有任务', 'warning')
+    else:
+        flash(f'成功导入 {count} 个任务', 'success')
+    return redirect(url_for('tasks'))
+
+@app.route('/tasks/export')
+@login_required
+def export_tasks():
+    """流式导出当前用户的任务（format=ndjson 或 csv）"""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        abort(400)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(utils.export_tasks(session['user_id'], fmt), mimetype=mimetype + '; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename=tasks.{fmt}'})
+
 @app.route('/tasks/ai_parse', methods=['POST'])
 @login_required
 def ai_parse_task():
@@ -328,21 +462,34 @@ def task_detail(task_id):
     is_owner = task['user_id'] == session['user_id']
     if not is_owner and not task.get('show_on_homepage', False):
         abort(404)
-    # 自动更新状态（如果已开始）
-    task = utils.update_task_status_if_needed(task)
-    # 获取任务所有者的任务列表，用于计算索引和相似任务
-    owner_tasks = utils.get_tasks_by_user(task['user_id'])
-    # 按创建时间排序
-    owner_tasks_sorted = sorted(owner_tasks, key=lambda x: x.get('created_at', ''))
-    # 查找当前任务在所有者任务列表中的索引（1-based）
-    task_index = None
-    for i, t in enumerate(owner_tasks_sorted):
-        if t['id'] == task_id:
-            task_index = i + 1
-            break
-    # 相似任务：相同状态的任务数（在所有者任务中）
-    similar_count = sum(1 for t in owner_tasks if t.get('status') == task.get('status'))
-    return render_template('task_detail.html', task=task, task_index=task_index, similar_count=similar_count, is_owner=is_owner)
+    # 任务在所有者任务中按创建时间的序号（1-based），以及相同状态的任务数，都来自索引，无需加载所有者的其他任务
+    task_index = utils.get_task_ordinal(task)
+    similar_count = utils.count_tasks_by_status(task['user_id']).get(task['status'], 0)
+    # 重复任务只展开接下来的几次
+    upcoming = []
+    if task.get('recurrence') and is_owner:
+        now = time.time()
+        upcoming = list(itertools.islice(utils.iter_occurrences(task, now, None, now), 5))
+    return render_template('task_detail.html', task=task, task_index=task_index, similar_count=similar_count,
+                           is_owner=is_owner, upcoming=upcoming)
+
+@app.route('/tasks/<int:task_id>/occurrences/<int:n>', methods=['POST'])
+@login_required
+def update_occurrence(task_id, n):
+    """修改重复任务某一次的状态和完成率，只为这一次保存覆盖值"""
+    task = utils.get_task_by_id(task_id)
+    if not task or task['user_id'] != session['user_id'] or not task.get('recurrence'):
+        abort(404)
+    status = request.form.get('status', 'completed')
+    if status not in utils.TASK_STATUSES:
+        abort(400)
+    updates = {'status': status}
+    if status == 'completed':
+        updates['completion_rate'] = request.form.get('completion_rate', type=int, default=100)
+    if not utils.update_occurrence(task_id, n, updates):
+        abort(404)
+    flash('已更新该次任务', 'success')
+    return redirect(url_for('task_detail', task_id=task_id))
 
 @app.route('/tasks/<int:task_id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -380,7 +527,13 @@ def edit_task(task_id):
             reminder_times = list(set(reminder_times))
         updates['reminder_times'] = reminder_times
         updates['show_on_homepage'] = request.form.get('show_on_homepage') == 'on'
-        utils.update_task(task_id, updates)
+        if 'recurrence_freq' in request.form:
+            updates['recurrence'] = _recurrence_from_form()
+        try:
+            utils.update_task(task_id, updates)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return render_template('edit_task.html', task=task)
         flash('任务更新成功', 'success')
         return redirect(url_for('task_detail', task_id=task_id))
     return render_template('edit_task.html', task=task)
@@ -447,7 +600,7 @@ def notifications():
 @app.route('/notifications/<int:notif_id>/read', methods=['POST'])
 @login_required
 def mark_notification_read(notif_id):
-    utils.mark_notification_read(notif_id)
+    utils.mark_notification_read(notif_id, session['user_id'])
     return jsonify({'success': True})
 
 # Messages
@@ -554,12 +707,15 @@ def follow(user_id):
     if follower_id == user_id:
         flash('不能关注自己', 'danger')
     else:
-        if utils.is_following(follower_id, user_id):
-            utils.unfollow_user(follower_id, user_id)
-            flash('已取消关注', 'success')
-        else:
-            utils.follow_user(follower_id, user_id)
-            flash('关注成功', 'success')
+        try:
+            if utils.is_following(follower_id, user_id):
+                utils.unfollow_user(follower_id, user_id)
+                flash('已取消关注', 'success')
+            else:
+                utils.follow_user(follower_id, user_id)
+                flash('关注成功', 'success')
+        except utils.DuplicateKeyError:
+            flash('用户数据中存在重复的用户名或邮箱，操作未完成，请联系管理员', 'danger')
     return redirect(url_for('profile', user_id=user_id))
 
 # Profile editing
@@ -578,8 +734,11 @@ def edit_profile():
         if avatar:
             updates['avatar'] = avatar
         if updates:
-            utils.update_user(session['user_id'], updates)
-            flash('资料更新成功', 'success')
+            try:
+                utils.update_user(session['user_id'], updates)
+                flash('资料更新成功', 'success')
+            except utils.DuplicateKeyError:
+                flash('用户数据中存在重复的用户名或邮箱，资料未更新，请联系管理员', 'danger')
         return redirect(url_for('profile', user_id=session['user_id']))
     # GET request: render edit form
     user = utils.get_user_by_id(session['user_id'])
@@ -687,31 +846,53 @@ def delete_comment(post_id, comment_id):
 @app.route('/calendar')
 @login_required
 def calendar_view():
-    tasks = utils.get_tasks_by_user(session['user_id'])
-    events = []
-    today_tasks = []
+    # 日历中的任务由前端按可见范围从 /api/tasks 按需加载，这里只查询今天的任务
     today = datetime.now().date()
-    for task in tasks:
-        if task.get('start_time'):
-            # 添加到事件列表
-            events.append({
-                'title': task['name'],
-                'start': task['start_time'],
-                'color': '#007bff',
-                'extendedProps': {
-                    'taskId': task['id'],
-                    'location': task.get('location', ''),
-                    'startTime': task['start_time']
-                }
-            })
-            # 检查是否为今天任务
-            try:
-                start_date = datetime.fromisoformat(task['start_time'].replace('Z', '+00:00')).date()
-                if start_date == today:
-                    today_tasks.append(task)
-            except ValueError:
-                pass
-    return render_template('calendar.html', events=events, today_tasks=today_tasks)
+    today_tasks = utils.get_tasks_in_range(session['user_id'],
+                                           utils.day_start_timestamp(today),
+                                           utils.day_start_timestamp(today + timedelta(days=1)))
+    return render_template('calendar.html', today_tasks=today_tasks)
+
+@app.route('/api/tasks')
+@login_required
+def api_tasks():
+    """当前用户开始时间在 [from, to) 内的任务。
+    参数为 from/to（日期或ISO时间），或 date 加 range=day/week/month（周从周一开始）"""
+    date_str = request.args.get('date')
+    if date_str:
+        try:
+            day = datetime.strptime(date_str, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': '日期格式应为 YYYY-MM-DD'}), 400
+        span = request.args.get('range', 'day')
+        if span == 'day':
+            start, end = day, day + timedelta(days=1)
+        elif span == 'week':
+            start = day - timedelta(days=day.weekday())
+            end = start + timedelta(days=7)
+        elif span == 'month':
+            start = day.replace(day=1)
+            end = (start + timedelta(days=32)).replace(day=1)
+        else:
+            return jsonify({'error': 'range 只能是 day、week 或 month'}), 400
+        start_ts, end_ts = utils.day_start_timestamp(start), utils.day_start_timestamp(end)
+    else:
+        start_ts = utils.to_timestamp(request.args.get('from'))
+        end_ts = utils.to_timestamp(request.args.get('to'))
+        if start_ts is None or end_ts is None:
+            return jsonify({'error': '需要 date 或 from/to 参数'}), 400
+        # 限制区间长度，重复任务展开的次数随之有界
+        if not 0 < end_ts - start_ts <= TASK_RANGE_MAX_DAYS * 86400:
+            return jsonify({'error': f'from/to 区间须在 {TASK_RANGE_MAX_DAYS} 天以内'}), 400
+    tasks = utils.get_tasks_in_range(session['user_id'], start_ts, end_ts)
+    return jsonify([{
+        'id': task['id'],
+        'occurrence': task.get('occurrence'),
+        'name': task['name'],
+        'start_time': task['start_time'],
+        'location': task.get('location', ''),
+        'status': task['status'],
+    } for task in tasks])
 
 # Statistics
 @app.route('/stats')
@@ -746,7 +927,7 @@ def stats():
 @app.route('/admin')
 @admin_required
 def admin():
-    users = utils.load_json('users.json')
+    users = utils.read_json('users.json')
     users_list = []
     for uid, user in users.items():
         users_list.append({
@@ -759,15 +940,14 @@ def admin():
     # Sort by id
     users_list.sort(key=lambda x: x['id'])
     
-    tasks = utils.load_json('tasks.json')
-    posts = utils.load_json('posts.json')
-    messages = utils.load_json('messages.json')
+    tasks = utils.read_json('tasks.json')
+    posts = utils.read_json('posts.json')
     
     stats = {
         'total_users': len(users_list),
         'total_tasks': len(tasks),
         'total_posts': len(posts),
-        'total_messages': len(messages),
+        'total_messages': utils.count_messages(),
     }
     api_key, api_url, ai_enabled = utils.get_deepseek_config()
     email_config = utils.get_email_config()
@@ -827,12 +1007,18 @@ def admin_send_notification():
         flash('标题和内容不能为空', 'danger')
         return redirect(url_for('admin'))
     # Send to all users
-    users = utils.load_json('users.json')
-    for uid in users.keys():
-        utils.add_notification(int(uid), title, content, 'system')
+    users = utils.read_json('users.json')
+    utils.add_notifications([int(uid) for uid in users.keys()], title, content, 'system')
     flash('全局通知发送成功', 'success')
     return redirect(url_for('admin'))
 
+# 缓存命中率与快照新鲜度
+@app.route('/admin/cache_stats')
+@admin_required
+def admin_cache_stats():
+    return jsonify({'dashboard': dashboard_cache.stats(), 'documents': storage.cache.stats(),
+                    'reminders': reminder_scheduler.stats()})
+
 # 测试邮箱配置
 @app.route('/admin/test_email_config', methods=['POST'])
 @admin_required
@@ -903,30 +1089,63 @@ def check_reminders():
     secret = request.args.get('secret')
     if secret != REMINDER_CHECK_SECRET:
         return jsonify({'success': False, 'message': '无效的密钥'}), 403
+    if not reminder_scheduler.may_run():
+        return jsonify({'success': True, 'message': '提醒由其他进程处理', 'queued': 0})
     try:
-        utils.check_task_reminders()
-        return jsonify({'success': True, 'message': '提醒检查完成'})
+        queued = reminder_scheduler.run_due()
+        return jsonify({'success': True, 'message': '提醒检查完成', 'queued': queued})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
 def start_reminder_scheduler():
-    """启动后台线程，每分钟检查一次任务提醒"""
-    def reminder_worker():
-        import time
-        while True:
-            try:
-                utils.check_task_reminders()
-            except Exception as e:
-                print(f"提醒检查出错: {e}")
-            time.sleep(60)  # 每分钟检查一次
-
-    # 在应用主进程中启动线程（避免在重载器中重复启动）
-    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or os.environ.get('WERKZEUG_RUN_MAIN') is None:
-        thread = threading.Thread(target=reminder_worker, daemon=True)
-        thread.start()
-        print(f"提醒检查调度器已启动 (WERKZEUG_RUN_MAIN={os.environ.get('WERKZEUG_RUN_MAIN')})")
-    else:
-        print(f"提醒检查调度器跳过 (WERKZEUG_RUN_MAIN={os.environ.get('WERKZEUG_RUN_MAIN')})")
+    """启动提醒调度的后台线程。多个进程（重载器的父子进程、WSGI 的多个 worker）都可以调用，
+    它们通过租约文件选出一个进程处理提醒，其余进程只定期尝试接管"""
+    reminder_scheduler.start()
+    print(f"提醒检查调度器已启动，参与选举 (pid={os.getpid()})")
+
+@app.cli.command('run-scheduler')
+def run_scheduler():
+    """以独立进程运行提醒调度（与其他启动了调度的进程通过租约选出唯一的执行者）"""
+    print(f"提醒调度进程已启动 (pid={os.getpid()})，租约文件 {reminder_scheduler.lease.path}")
+    reminder_scheduler.run_forever()
+
+@app.cli.command('migrate-sqlite')
+@click.option('--db', 'db_path', default=None, help='目标数据库路径，默认使用 config.SQLITE_PATH')
+def migrate_sqlite(db_path):
+    """将 data/*.json 流式导入 SQLite 数据库"""
+    import sqlite_store
+    counts = sqlite_store.migrate_from_json(utils.DATA_DIR, db_path)
+    for name, count in counts.items():
+        print(f'{name}: 导入 {count} 条')
+    print('迁移完成，将 config.py 中的 STORAGE_BACKEND 设置为 \'sqlite\' 即可启用')
+
+@app.cli.command('shard-data')
+def shard_data():
+    """把 notifications.json、messages.json 拆分为按用户/会话的分片文件"""
+    if utils.STORAGE_BACKEND == 'sqlite':
+        raise click.ClickException('sqlite 后端按行存储，无需分片')
+    router = storage.ShardRouter(utils.DATA_DIR, True)
+    store = storage.open_store(utils.STORAGE_BACKEND, utils.DATA_DIR)
+    for name in router.SHARDED:
+        count = router.split(store, name)
+        print(f'{name}: 迁移 {count} 条到 {len(router.collections(name))} 个分片')
+    print('分片完成，将 config.py 中的 SHARD_BY_OWNER 设置为 True 即可启用')
+
+@app.cli.command('backfill-timestamps')
+def backfill_timestamps():
+    """为已有的任务、通知、消息、帖子（含评论）补写 *_ts 时间戳字段"""
+    for base, fields in utils.TIMESTAMP_FIELDS.items():
+        updated = 0
+        for name in utils.router.collections(base):
+            with utils.store.transaction(name) as records:
+                for key in records.keys():
+                    record = records[key]
+                    utils.stamp_timestamps(record, fields)
+                    for comment in record.get('comments', []) if base == 'posts.json' else ():
+                        utils.stamp_timestamps(comment, ('created_at',))
+                changes = records.changes()
+            updated += len(changes)
+        print(f'{base}: 更新 {updated} 条')
 
 if __name__ == '__main__':
     start_reminder_scheduler()
@@ -20,4 +20,71 @@ MAX_MESSAGES_PER_DAY_UNFOLLOWED = 10
 REMINDER_TIMES = [30, 5]
 
 # Secret key for reminder check endpoint (optional)
-REMINDER_CHECK_SECRET = 'change_this_secret'
\ No newline at end of file
+REMINDER_CHECK_SECRET = 'change_this_secret'
+
+# In-process cache for data/*.json documents (approximate upper bound, bytes)
+DOC_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Storage backend: 'json' rewrites the whole file on every change,
+# 'journal' appends each change to data/<name>.journal and compacts it
+# into a new snapshot once it grows past the thresholds below,
+# 'sqlite' stores everything in SQLITE_PATH (run `flask --app app migrate-sqlite` first)
+STORAGE_BACKEND = 'json'
+JOURNAL_COMPACT_MIN_BYTES = 1024 * 1024
+JOURNAL_COMPACT_RATIO = 1.0  # compact when journal size >= snapshot size * ratio
+SQLITE_PATH = 'data/smart_todo.db'
+
+# On-disk encoding of data files: 'json' (compact), 'json-pretty' (indented, the old format),
+# 'orjson' (compact JSON via orjson, falls back to 'json' if it is not installed) or
+# 'msgpack' (binary, requires msgpack). Files in any of these formats are detected on load.
+# The default keeps the tracked data/*.json files in their original indented form;
+# switch to a compact format explicitly for faster saves on large data sets.
+DATA_FORMAT = 'json-pretty'
+
+# Store notifications per user (data/notifications/<user_id>.json) and messages per
+# conversation (data/messages/<low_id>_<high_id>.json) instead of one global file each.
+# Run `flask --app app shard-data` before enabling. Ignored by the sqlite backend.
+SHARD_BY_OWNER = False
+
+# Maximum number of rows accepted by one bulk task import (/tasks/import)
+TASK_IMPORT_MAX_ROWS = 10000
+
+# Widest start/end window accepted by /api/tasks; bounds how many occurrences of a
+# recurring task one request can expand
+TASK_RANGE_MAX_DAYS = 366
+
+# Task search ranking: a match created this many days ago scores half as much as an
+# otherwise identical match created today
+SEARCH_RECENCY_DAYS = 30
+
+# Per-user dashboard snapshots kept in memory and updated by write events. TTL bounds how
+# long writes made by other processes (which raise no events here) can go unnoticed.
+DASHBOARD_CACHE_TTL = 60
+DASHBOARD_CACHE_MAX_USERS = 10000
+
+# The reminder scheduler keeps a deadline heap updated by task write events; it is also
+# rebuilt from storage this often to pick up writes made by other processes
+REMINDER_RESYNC_SECONDS = 600
+
+# Reminder delivery runs on a pool of REMINDER_WORKERS threads. REMINDER_SEND_TIMEOUT bounds
+# one attempt (seconds): it is the SMTP socket timeout, and an attempt still running after it
+# is counted as failed. Failed attempts are retried up to
+# REMINDER_MAX_ATTEMPTS times in total, waiting REMINDER_RETRY_BACKOFF seconds before the
+# first retry and doubling after each one (never past the task start time)
+REMINDER_WORKERS = 4
+REMINDER_SEND_TIMEOUT = 10
+REMINDER_MAX_ATTEMPTS = 4
+REMINDER_RETRY_BACKOFF = 30
+
+# Only one process runs the reminder scheduler: processes that start it compete for a lease
+# in REMINDER_LEASE_PATH, the holder renews it every REMINDER_LEASE_SECONDS / 3 seconds and
+# another process takes over once it has not been renewed for REMINDER_LEASE_SECONDS
+REMINDER_LEASE_PATH = 'data/reminder_scheduler.lease'
+REMINDER_LEASE_SECONDS = 30
+
+# Reminders missed while no scheduler was running (downtime, crash, a long tick) are found
+# from the last tick saved in storage, looking back at most REMINDER_CATCHUP_MAX_SECONDS, and
+# drained at REMINDER_CATCHUP_RATE reminders per second after the live ones. Tasks that have
+# already started get one combined "missed" notification per user instead of late reminders
+REMINDER_CATCHUP_RATE = 20
+REMINDER_CATCHUP_MAX_SECONDS = 7 * 24 * 3600
\ No newline at end of file
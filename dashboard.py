@@ -0,0 +1,222 @@
+"""仪表盘的按用户快照：任务计数、最近任务、最近通知和测试邮件配额。
+快照在首次访问时由索引计算，之后随存储的写入事件增量更新，访问仪表盘时只需查字典。
+计数依赖当前时间（任务到达开始时间后状态改变），快照在用户下一个任务开始、跨过零点（配额重置）
+或超过 DASHBOARD_CACHE_TTL 时过期；TTL 兜底其他进程的写入（写入事件只在本进程内触发）"""
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import records
+import utils
+from config import DASHBOARD_CACHE_MAX_USERS, DASHBOARD_CACHE_TTL
+from storage import KEY_MAX, field_value, thaw
+
+RECENT_LIMIT = 5
+
+
+def _task_order(record):
+    """与 get_recent_tasks 相同的顺序：(created_at_ts, 键) 倒序，没有创建时间的任务不参与"""
+    ts = field_value(record, 'created_at_ts')
+    return None if ts is None else (ts, str(record['id']))
+
+
+def _notification_order(record):
+    """与 get_user_notifications 相同的顺序：创建时间倒序"""
+    return utils.created_order(record), record['id']
+
+
+class Recent:
+    """按排序键倒序的前 RECENT_LIMIT 条记录；complete 表示已包含全部记录（记录数不足一页）"""
+    __slots__ = ('entries', 'complete')
+
+    def __init__(self, records, order, complete):
+        self.entries = sorted(((order(r), r) for r in records), key=lambda e: e[0], reverse=True)
+        self.complete = complete
+
+    def update(self, old_order, new_order, record):
+        """一条记录的排序键从 old_order 变为 new_order（None 表示不在列表范围内）。
+        移出列表后需要补入列表之外的记录时无法增量更新，返回 False"""
+        entries = self.entries
+        listed = old_order is not None and any(order == old_order for order, _ in entries)
+        if listed:
+            entries[:] = [e for e in entries if e[0] != old_order]
+            if not self.complete and (new_order is None or new_order < old_order):
+                return False
+        if new_order is not None and (listed or self.complete or new_order > entries[-1][0]):
+            entries.append((new_order, record))
+            entries.sort(key=lambda e: e[0], reverse=True)
+            if len(entries) > RECENT_LIMIT:
+                entries.pop()
+                self.complete = False
+        return True
+
+    def records(self):
+        return [record for _, record in self.entries]
+
+
+class Snapshot:
+    __slots__ = ('counts', 'tasks', 'notifications', 'quota', 'day', 'built_at', 'expires_at')
+
+
+class DashboardCache:
+    """按用户缓存仪表盘快照，LRU 淘汰。on_change 注册为存储的写入事件监听者"""
+
+    def __init__(self, store, router, ttl=DASHBOARD_CACHE_TTL, max_users=DASHBOARD_CACHE_MAX_USERS):
+        self.store = store
+        self.router = router
+        self.ttl = ttl
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._snapshots = OrderedDict()
+        # 构建期间有新的写入时丢弃构建结果：user_id -> 写入事件次数，整体替换集合时递增 _generation
+        self._versions = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.invalidations = 0
+        self.expirations = 0
+        self.evictions = 0
+        self._age_total = 0.0
+        self._age_max = 0.0
+
+    def get(self, user_id, now=None):
+        """仪表盘模板所需的数据：stats、recent_tasks、recent_notifications、quota"""
+        now = now or time.time()
+        with self._lock:
+            snapshot = self._snapshots.get(user_id)
+            if snapshot is not None and now >= snapshot.expires_at:
+                del self._snapshots[user_id]
+                self.expirations += 1
+                snapshot = None
+            if snapshot is not None:
+                self._snapshots.move_to_end(user_id)
+                self.hits += 1
+                age = now - snapshot.built_at
+                self._age_total += age
+                self._age_max = max(self._age_max, age)
+            else:
+                self.misses += 1
+                version = (self._generation, self._versions.get(user_id, 0))
+        if snapshot is None:
+            snapshot = self._build(user_id, now)
+            with self._lock:
+                if (self._generation, self._versions.get(user_id, 0)) == version:
+                    self._snapshots[user_id] = snapshot
+                    self._snapshots.move_to_end(user_id)
+                    while len(self._snapshots) > self.max_users:
+                        self._snapshots.popitem(last=False)
+                        self.evictions += 1
+        return self._view(snapshot, now)
+
+    def _build(self, user_id, now):
+        snapshot = Snapshot()
+        snapshot.counts = utils.count_tasks_by_status(user_id, now)
+        tasks, cursor = self.store.find_page('tasks.json', 'created_at_ts', RECENT_LIMIT, descending=True,
+                                             user_id=user_id)
+        snapshot.tasks = Recent(tasks, _task_order, cursor is None)
+        notifications = self.store.find(self.router.notifications(user_id), user_id=user_id)
+        snapshot.notifications = Recent(heapq.nlargest(RECENT_LIMIT, notifications, key=_notification_order),
+                                        _notification_order, len(notifications) <= RECENT_LIMIT)
+        snapshot.day = datetime.fromtimestamp(now).date()
+        snapshot.quota = utils.test_email_quota(self.store.get('users.json', user_id), snapshot.day)
+        snapshot.built_at = now
+        midnight = datetime.combine(snapshot.day + timedelta(days=1), datetime.min.time()).timestamp()
+        snapshot.expires_at = min(now + self.ttl, midnight)
+        # 下一个开始的任务：开始时间 > now（游标 (now, KEY_MAX) 之后的第一条）
+        upcoming, _ = self.store.find_page('tasks.json', 'start_time_ts', 1, (now, KEY_MAX), user_id=user_id)
+        if upcoming:
+            snapshot.expires_at = min(snapshot.expires_at, field_value(upcoming[0], 'start_time_ts'))
+        return snapshot
+
+    @staticmethod
+    def _view(snapshot, now):
+        counts = snapshot.counts
+        return {
+            'stats': {
+                'total_tasks': counts['total'],
+                'completed_tasks': counts['completed'],
+                'in_progress_tasks': counts['in_progress'],
+                'pending_tasks': counts['pending'],
+            },
+            'recent_tasks': [utils.with_computed_status(thaw(t), now) for t in snapshot.tasks.records()],
+            'recent_notifications': [thaw(n) for n in snapshot.notifications.records()],
+            'quota': dict(snapshot.quota),
+        }
+
+    def on_change(self, name, changes):
+        record_type = records.type_for(name)
+        if record_type not in (records.Task, records.Notification, records.User):
+            return
+        with self._lock:
+            if changes is None:
+                # 整个集合被替换，无法得知涉及哪些用户
+                self.invalidations += len(self._snapshots)
+                self._snapshots.clear()
+                self._generation += 1
+                return
+            now = time.time()
+            for key, old, new in changes:
+                if record_type is records.User:
+                    users = {int(key)}
+                else:
+                    users = {r.get('user_id') for r in (old, new) if r is not None}
+                for user_id in users:
+                    self._versions[user_id] = self._versions.get(user_id, 0) + 1
+                    snapshot = self._snapshots.get(user_id)
+                    if snapshot is None:
+                        continue
+                    if now < snapshot.expires_at and self._apply(snapshot, record_type, user_id, old, new, now):
+                        self.updates += 1
+                    else:
+                        del self._snapshots[user_id]
+                        self.invalidations += 1
+
+    @staticmethod
+    def _apply(snapshot, record_type, user_id, old, new, now):
+        """把一条记录的变化合并进快照，无法增量更新时返回 False"""
+        if record_type is records.User:
+            if new is None:
+                return False
+            snapshot.quota = utils.test_email_quota(new, snapshot.day)
+            return True
+        old = old if old is not None and old.get('user_id') == user_id else None
+        new = new if new is not None and new.get('user_id') == user_id else None
+        if record_type is records.Notification:
+            return snapshot.notifications.update(old and _notification_order(old),
+                                                 new and _notification_order(new), new)
+        counts = snapshot.counts
+        # 快照未过期说明构建以来没有任务到达开始时间，旧记录此刻的状态就是计入时的状态
+        for record, delta in ((old, -1), (new, 1)):
+            if record is not None:
+                counts['total'] += delta
+                counts[utils.compute_task_status(record, now)] += delta
+        if new is not None:
+            start = field_value(new, 'start_time_ts')
+            if start is not None and start > now:
+                snapshot.expires_at = min(snapshot.expires_at, start)
+        return snapshot.tasks.update(old and _task_order(old), new and _task_order(new), new)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'snapshots': len(self._snapshots),
+                'max_users': self.max_users,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / (self.hits + self.misses), 3) if self.hits + self.misses else None,
+                'updates': self.updates,
+                'invalidations': self.invalidations,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                # 命中时快照距构建的秒数（期间的写入已增量合并，其他进程的写入最多滞后 ttl）
+                'age_avg': round(self._age_total / self.hits, 2) if self.hits else None,
+                'age_max': round(self._age_max, 2),
+                'ttl': self.ttl,
+            }
+
+
+cache = DashboardCache(utils.store, utils.router)
+utils.store.on_change(cache.on_change)
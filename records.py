@@ -0,0 +1,312 @@
+"""类型化的记录：任务、用户、帖子、通知在写入时按字段校验并统一类型，
+缓存中以 __slots__ 对象保存（比字典省内存），对外是只读映射接口，序列化后仍是原来的 JSON 结构"""
+import sys
+from collections.abc import Mapping
+
+import storage  # 只在运行时使用 storage.freeze / FrozenDict（两个模块互相导入）
+
+_UNSET = object()
+# 加载旧数据时转换失败的处理：保留原值
+KEEP = object()
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError('缓存中的记录是只读的，如需修改请使用 thaw() 得到的副本')
+
+
+def converter(types, fallback=KEEP):
+    """字段转换函数的装饰器。types：已是这些类型的值加载时无需转换（为空表示总是转换）；
+    fallback：加载旧数据时转换失败使用的值，KEEP 表示保留原值"""
+    def wrap(fn):
+        fn.types = types
+        fn.fallback = fallback
+        return fn
+    return wrap
+
+
+@converter((int, type(None)))
+def to_int(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    return int(str(value).strip())
+
+
+@converter((int, float), fallback=0)
+def to_rate(value):
+    """完成率：0-100 的数字，空值为 0"""
+    if value is None or value == '':
+        return 0
+    if isinstance(value, bool):
+        raise ValueError(value)
+    number = float(value)
+    if not 0 <= number <= 100:
+        raise ValueError(value)
+    return int(number) if number.is_integer() else number
+
+
+@converter((bool,), fallback=False)
+def to_bool(value):
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in ('1', 'true', 'yes', 'on'):
+            return True
+        if text in ('', '0', 'false', 'no', 'off'):
+            return False
+        raise ValueError(value)
+    return bool(value)
+
+
+@converter((str, type(None)))
+def to_text(value):
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+@converter((int, float, type(None)))
+def to_timestamp(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError(value)
+    return float(value)
+
+
+@converter(())
+def to_int_list(value):
+    """整数列表，也接受逗号分隔的字符串"""
+    if value is None or value == '':
+        return storage.FrozenList()
+    if isinstance(value, str):
+        value = [part for part in value.split(',') if part.strip()]
+    return storage.FrozenList(to_int(v) for v in value)
+
+
+@converter(())
+def to_data(value):
+    """嵌套的 JSON 数据（列表、字典），转换为只读结构"""
+    return storage.freeze(value)
+
+
+def choice(*values):
+    """取值限定在 values 中的字符串；驻留后所有记录共用同一个字符串对象"""
+    allowed = frozenset(values)
+
+    @converter(())
+    def to_choice(value):
+        if value not in allowed:
+            raise ValueError(value)
+        return sys.intern(value)
+    return to_choice
+
+
+@converter(())
+def to_tag(value):
+    """取值种类很少的字符串（如通知类型），驻留以节省内存"""
+    return value if value is None else sys.intern(str(value))
+
+
+class Record(Mapping):
+    """类型化记录的基类。子类用 FIELDS 声明 (字段名, 转换函数)，并声明同名的 __slots__。
+    记录中没有的字段对应的 slot 不赋值；FIELDS 之外的字段原样保存在 _extra 中"""
+    __slots__ = ('_extra',)
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._names = tuple(name for name, _ in cls.FIELDS)
+        cls._name_set = frozenset(cls._names)
+        cls._specs = {name: (getattr(cls, name).__set__, convert) for name, convert in cls.FIELDS}
+
+    __setattr__ = __delattr__ = _readonly
+
+    @classmethod
+    def _build(cls, data, strict):
+        self = cls.__new__(cls)
+        specs = cls._specs
+        extra = None
+        for key, value in data.items():
+            spec = specs.get(key)
+            if spec is None:
+                if extra is None:
+                    extra = {}
+                extra[key] = storage.freeze(value)
+                continue
+            setter, convert = spec
+            if type(value) not in convert.types:
+                try:
+                    value = convert(value)
+                except (TypeError, ValueError):
+                    if strict:
+                        raise ValueError(f'字段 {key} 的值无效: {value!r}') from None
+                    value = storage.freeze(value) if convert.fallback is KEEP else convert.fallback
+            setter(self, value)
+        Record._extra.__set__(self, storage.FrozenDict(extra) if extra else None)
+        return self
+
+    @classmethod
+    def load(cls, data):
+        """从数据文件中解析出的字典构造；旧数据中无法转换的值按字段的 fallback 处理，不报错"""
+        return cls._build(data, strict=False)
+
+    @classmethod
+    def coerce(cls, data):
+        """写入前校验并统一类型，值无效时抛出 ValueError；已是本类型的记录原样返回"""
+        if type(data) is cls:
+            return data
+        return cls._build(data, strict=True)
+
+    def __getitem__(self, key):
+        if key in self._name_set:
+            value = getattr(self, key, _UNSET)
+            if value is not _UNSET:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._name_set:
+            return getattr(self, key, default)
+        return default if self._extra is None else self._extra.get(key, default)
+
+    def __contains__(self, key):
+        if key in self._name_set:
+            return getattr(self, key, _UNSET) is not _UNSET
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for name in self._names:
+            if getattr(self, name, _UNSET) is not _UNSET:
+                yield name
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        """浅拷贝为普通字典（嵌套值仍是只读结构），即写入数据文件的 JSON 结构"""
+        data = {}
+        for name in self._names:
+            value = getattr(self, name, _UNSET)
+            if value is not _UNSET:
+                data[name] = value
+        if self._extra is not None:
+            data.update(self._extra)
+        return data
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == dict(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+    def __copy__(self):
+        return self.to_dict()
+
+    def __deepcopy__(self, memo):
+        return storage.thaw(self)
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+
+class Task(Record):
+    FIELDS = (
+        ('id', to_int),
+        ('user_id', to_int),
+        ('name', to_text),
+        ('description', to_text),
+        ('start_time', to_text),
+        ('location', to_text),
+        ('duration', to_int),
+        ('notes', to_text),
+        ('show_on_homepage', to_bool),
+        ('reminder_times', to_int_list),
+        ('created_at', to_text),
+        ('status', choice('pending', 'in_progress', 'completed')),
+        ('completion_rate', to_rate),
+        ('sent_reminders', to_data),
+        ('recurrence', to_data),
+        ('occurrences', to_data),
+        ('reminded_before', to_int),
+        ('created_at_ts', to_timestamp),
+        ('start_time_ts', to_timestamp),
+    )
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+class User(Record):
+    FIELDS = (
+        ('id', to_int),
+        ('username', to_text),
+        ('password', to_text),
+        ('email', to_text),
+        ('verified', to_bool),
+        ('nickname', to_text),
+        ('bio', to_text),
+        ('avatar', to_text),
+        ('created_at', to_text),
+        ('followers', to_int_list),
+        ('following', to_int_list),
+        ('email_verification_code', to_text),
+        ('email_verification_sent_at', to_text),
+        ('email_verification_attempts', to_int),
+        ('test_email_sent_count', to_int),
+        ('test_email_last_date', to_text),
+    )
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+class Post(Record):
+    FIELDS = (
+        ('id', to_int),
+        ('user_id', to_int),
+        ('content', to_text),
+        ('images', to_data),
+        ('likes', to_int_list),
+        ('comments', to_data),
+        ('created_at', to_text),
+        ('created_at_ts', to_timestamp),
+    )
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+class Notification(Record):
+    FIELDS = (
+        ('id', to_int),
+        ('user_id', to_int),
+        ('title', to_tag),
+        ('content', to_text),
+        ('type', to_tag),
+        ('read', to_bool),
+        ('created_at', to_text),
+        ('created_at_ts', to_timestamp),
+    )
+    __slots__ = tuple(name for name, _ in FIELDS)
+
+
+# 集合 -> 记录类型；分片集合（如 notifications/3.json）使用原集合的类型
+RECORD_TYPES = {
+    'tasks.json': Task,
+    'users.json': User,
+    'posts.json': Post,
+    'notifications.json': Notification,
+}
+
+
+def type_for(name):
+    if '/' in name:
+        name = name.split('/', 1)[0] + '.json'
+    return RECORD_TYPES.get(name)
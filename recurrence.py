@@ -0,0 +1,106 @@
+"""重复任务的规则与展开：规则随任务只保存一次，各次发生只在查询的时间窗口内按需生成。
+规则格式 {'freq': 'daily'|'weekly'|'monthly', 'interval': 间隔, 'count': 总次数, 'until': 截止日期}，
+count 和 until 都可省略（无限重复）。时间均为本地时间（与任务的 start_time 一致）"""
+import calendar
+from datetime import datetime, timedelta
+
+FREQUENCIES = {'daily': '天', 'weekly': '周', 'monthly': '月'}
+
+
+def parse_until(value):
+    """截止时间：只给日期时包含当天，返回第一个不再发生的时刻"""
+    if not value:
+        return None
+    try:
+        until = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    if len(str(value)) <= 10:
+        return until + timedelta(days=1)
+    return until + timedelta(microseconds=1)
+
+
+def normalize_rule(rule):
+    """校验并规范化重复规则；规则为空时返回 None，无效时抛出 ValueError"""
+    if not rule:
+        return None
+    freq = rule.get('freq')
+    if freq not in FREQUENCIES:
+        raise ValueError('重复频率只能是每天、每周或每月')
+    try:
+        interval = int(rule['interval']) if rule.get('interval') not in (None, '') else 1
+        count = int(rule['count']) if rule.get('count') not in (None, '') else None
+    except (TypeError, ValueError):
+        raise ValueError('重复间隔和次数必须是整数')
+    if interval < 1 or (count is not None and count < 1):
+        raise ValueError('重复间隔和次数必须大于 0')
+    normalized = {'freq': freq, 'interval': interval}
+    if count is not None:
+        normalized['count'] = count
+    until = rule.get('until')
+    if until:
+        if parse_until(until) is None:
+            raise ValueError('重复截止日期格式错误')
+        normalized['until'] = str(until)
+    return normalized
+
+
+def describe(rule):
+    """规则的中文描述，例如“每2周，共10次”"""
+    unit = FREQUENCIES[rule['freq']]
+    text = f'每{unit}' if rule['interval'] == 1 else f'每{rule["interval"]}{unit}'
+    if rule.get('count'):
+        text += f'，共{rule["count"]}次'
+    if rule.get('until'):
+        text += f'，截止{rule["until"]}'
+    return text
+
+
+def _add_months(dt, months):
+    """加若干个月，日期超出当月天数时取当月最后一天"""
+    month = dt.month - 1 + months
+    year, month = dt.year + month // 12, month % 12 + 1
+    return dt.replace(year=year, month=month, day=min(dt.day, calendar.monthrange(year, month)[1]))
+
+
+def occurrence_start(start, rule, n):
+    """第 n 次（从 0 开始）发生的开始时间，不检查 count/until"""
+    if rule['freq'] == 'monthly':
+        return _add_months(start, n * rule['interval'])
+    days = rule['interval'] * (7 if rule['freq'] == 'weekly' else 1)
+    return start + timedelta(days=n * days)
+
+
+def _first_index(start, rule, after):
+    """开始时间不早于 after 的第一次发生的序号，直接计算而不逐次推算"""
+    if after <= start:
+        return 0
+    if rule['freq'] == 'monthly':
+        months = (after.year - start.year) * 12 + after.month - start.month
+        n = max(months // rule['interval'] - 1, 0)
+    else:
+        step = timedelta(days=rule['interval'] * (7 if rule['freq'] == 'weekly' else 1))
+        n = (after - start) // step
+    while occurrence_start(start, rule, n) < after:
+        n += 1
+    return n
+
+
+def in_series(rule, n, when):
+    """第 n 次、开始于 when 的发生是否仍在 count/until 限定的范围内"""
+    if n < 0 or (rule.get('count') is not None and n >= rule['count']):
+        return False
+    until = parse_until(rule.get('until'))
+    return until is None or when < until
+
+
+def occurrences(start, rule, window_start, window_end=None):
+    """按时间顺序产出开始时间在 [window_start, window_end) 内的 (序号, 开始时间)。
+    从窗口起点直接定位，生成器惰性求值；window_end 为 None 时由调用方决定取多少个"""
+    n = _first_index(start, rule, window_start)
+    while True:
+        when = occurrence_start(start, rule, n)
+        if (window_end is not None and when >= window_end) or not in_series(rule, n, when):
+            return
+        yield n, when
+        n += 1
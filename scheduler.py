@@ -0,0 +1,762 @@
+"""任务提醒调度：按触发时间排列的最小堆，启动时由任务数据建立一次，之后随任务的写入事件增量更新。
+后台线程睡眠到最早的触发时间，醒来只处理到期的条目，代价与到期的提醒数有关，与任务总数无关。
+调度线程认领到期的提醒并写入站内通知（每次处理合并为每个集合一次写入），邮件由 ReminderDispatcher 的线程池发送。
+
+条目有四种：remind（开始前 N 分钟发送提醒）、deliver（重新提交等待重试或发送中断的提醒）、
+start（到开始时间把待开始落盘为进行中）、next（重复任务展开下一次发生）。
+重复任务每次只排入一次发生，next 在下一次发生的第一个提醒之前触发。
+任务修改后其旧条目不从堆中删除，按版本号在弹出时跳过（过多时整体重建堆）。
+已处理到的时间保存在存储中，重启（或接管）后找出停机期间错过的提醒：任务还没开始的按速率迟到补发，
+已经开始的每个用户合并为一条通知。时钟可以注入（SimulatedClock），用于演练停机和补发。
+多个进程启动调度时通过 FileLease 选出一个进程处理提醒，其他进程不建立队列；
+认领记录在集合写锁内写入，即使两个进程同时处理也不会重复发送"""
+import atexit
+import heapq
+import itertools
+import json
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import utils
+from config import (REMINDER_CATCHUP_MAX_SECONDS, REMINDER_CATCHUP_RATE, REMINDER_LEASE_PATH, REMINDER_LEASE_SECONDS,
+                    REMINDER_MAX_ATTEMPTS, REMINDER_RESYNC_SECONDS, REMINDER_RETRY_BACKOFF, REMINDER_SEND_TIMEOUT,
+                    REMINDER_WORKERS)
+from storage import field_value, lock_file, unlock_file
+
+# 与原来每分钟检查一次的容差一致：错过触发时间 2 分钟以内仍然发送
+GRACE_SECONDS = 120
+# 最长睡眠时间，防止系统时钟调整后睡过头
+MAX_SLEEP_SECONDS = 60
+# 已认领的提醒超过这个时间仍没有发送结果（进程在发送前退出），重新发送
+QUEUED_RECOVERY_SECONDS = 300
+# 发送结果最多攒这么久再写入
+RESULT_COMMIT_DELAY = 1
+# 已处理到的时间保存在这个文档中（重启后据此找出错过的提醒），最多每 TICK_SAVE_SECONDS 秒写入一次
+STATE_DOC = 'scheduler.json'
+TICK_SAVE_SECONDS = 60
+
+
+def minutes_left(task, minutes, now):
+    """提醒文案中的剩余分钟数：按时发送时就是提醒的分钟数，补发和重试时按实际剩余时间（至少 1 分钟）"""
+    start = utils.record_timestamp(task, 'start_time')
+    if start is None:
+        return minutes
+    return max(1, min(minutes, math.ceil((start - now) / 60)))
+
+
+class SimulatedClock:
+    """手动推进的时钟，代替 time.time 注入调度器和发送器，用于在几秒内模拟停机、补发等长时间的场景"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        return self.now
+
+
+class FileLease:
+    """本地文件中的租约，用于在同一台机器的多个进程中选出唯一的调度进程。
+    持有者定期续约，租约超过 ttl 未续约（进程退出或卡住）时其他进程可以接管；
+    读-改-写在租约文件的排他锁（storage.lock_file：fcntl，Windows 上为 msvcrt）内完成，
+    两个进程不会同时认为自己持有租约"""
+
+    def __init__(self, path, ttl=REMINDER_LEASE_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.expires_at = 0.0
+        self.takeovers = 0
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            lock_file(fd)
+            try:
+                yield fd
+            finally:
+                unlock_file(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _read(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            lease = json.loads(os.read(fd, 4096) or b'{}')
+        except ValueError:
+            # 写了一半的租约（持有者在写入时退出）视为已过期
+            return {}
+        return lease if isinstance(lease, dict) else {}
+
+    def acquire(self):
+        """续约或在租约过期时接管，返回本进程是否持有租约"""
+        now = time.time()
+        with self._locked() as fd:
+            lease = self._read(fd)
+            if lease.get('owner') not in (None, self.owner) and lease.get('expires_at', 0) > now:
+                self.expires_at = 0.0
+                return False
+            if lease.get('owner') != self.owner:
+                self.takeovers += 1
+            data = json.dumps({'owner': self.owner, 'pid': os.getpid(), 'expires_at': now + self.ttl}).encode()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, data)
+        self.expires_at = now + self.ttl
+        return True
+
+    def holder(self):
+        """当前有效租约的持有者，没有时返回 None"""
+        with self._locked() as fd:
+            lease = self._read(fd)
+        return lease.get('owner') if lease.get('expires_at', 0) > time.time() else None
+
+    def release(self):
+        """正常退出时交出租约，其他进程下一次尝试即可接管，不必等租约过期"""
+        if not self.expires_at:
+            return
+        with self._locked() as fd:
+            if self._read(fd).get('owner') == self.owner:
+                os.ftruncate(fd, 0)
+        self.expires_at = 0.0
+
+
+class ReminderDispatcher:
+    """提醒的发送阶段：有界线程池发送邮件，一个慢的邮件服务器不会拖住其他提醒。
+    站内通知在认领时已写入，这里只发邮件。每次尝试的结果由写入线程合并写回 sent_reminders；
+    失败的记为 retry 并给出 next_at（指数退避），写入事件使调度器在 next_at 重新提交，进程重启后同样会继续重试。
+    每次尝试最多 timeout 秒：超时仍未返回的由写入线程记为一次失败的尝试；该线程仍占用一个发送线程，
+    之后返回发送成功时写回 sent，取消尚未开始的重试。超时未返回的尝试占满所有发送线程时不再接受提交"""
+
+    def __init__(self, store, workers=REMINDER_WORKERS, timeout=REMINDER_SEND_TIMEOUT,
+                 max_attempts=REMINDER_MAX_ATTEMPTS, backoff=REMINDER_RETRY_BACKOFF, clock=time.time):
+        self.store = store
+        self.clock = clock
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reminder')
+        self.workers = workers
+        self._idle = threading.Condition()
+        self._jobs = set()            # 已提交、结果尚未写入的 (任务键, 发生序号, 分钟数)
+        self._pending = deque()       # 等待空闲发送线程的 (job, 应提醒时间)
+        self._running = 0             # 占用发送线程的尝试数，包括超时仍未返回的
+        self._results = []            # 等待写入的 (job, 修改, 写入后是否移出 _jobs)
+        self._sending = {}            # 正在发送的尝试：token -> (截止时间（monotonic）, job, 目标, 第几次尝试)
+        self._abandoned = set()       # 已按超时记为失败的尝试的 token
+        self._committer = None
+        self._lateness = deque(maxlen=1000)   # 最近发送成功的提醒：发送完成时间 - 应提醒时间（秒）
+        self.submitted = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.commits = 0
+
+    def submit(self, key, n, minutes, due_at):
+        """提交一次发送；同一个提醒已在队列中或正在发送时，或超时未返回的尝试占满所有发送线程时返回 False"""
+        job = (key, n, minutes)
+        with self._idle:
+            if job in self._jobs or self.stalled():
+                return False
+            self._jobs.add(job)
+            self.submitted += 1
+            if self._committer is None:
+                self._committer = threading.Thread(target=self._commit_loop, daemon=True)
+                self._committer.start()
+            self._pending.append((job, due_at))
+            self._start_pending()
+        return True
+
+    def stalled(self):
+        """超时仍未返回的尝试是否占满了所有发送线程"""
+        with self._idle:
+            return len(self._abandoned) >= self.workers
+
+    def _start_pending(self):
+        """有空闲发送线程时交出等待中的提交（调用方持有 _idle）：超时未返回的尝试仍占用线程，
+        提交不会排在挂住的线程后面"""
+        while self._pending and self._running < self.workers:
+            job, due_at = self._pending.popleft()
+            self._running += 1
+            self._pool.submit(self._run, job, due_at)
+
+    def _run(self, job, due_at):
+        token = object()
+        updates = None
+        try:
+            updates = self._deliver(token, *job, due_at)
+        except Exception as e:
+            print(f'[提醒发送] 处理提醒出错: 任务 {job[0]}: {e}')
+        finally:
+            with self._idle:
+                self._running -= 1
+                self._sending.pop(token, None)
+                if token in self._abandoned:
+                    # 已按超时记为失败；之后仍发送成功时写回 sent，覆盖失败记录，等待中的重试不再发送
+                    self._abandoned.discard(token)
+                    if updates and updates['status'] == 'sent':
+                        self._results.append((job, updates, False))
+                        self._cancel(job)
+                elif updates:
+                    self._results.append((job, updates, True))
+                else:
+                    self._jobs.discard(job)
+                self._start_pending()
+                self._idle.notify_all()
+
+    def _cancel(self, job):
+        """取消还没交给发送线程的同一提醒的提交（调用方持有 _idle）"""
+        pending = deque(item for item in self._pending if item[0] != job)
+        if len(pending) < len(self._pending):
+            self._pending = pending
+            self._jobs.discard(job)
+
+    def _expire(self):
+        """把超过截止时间仍未返回的尝试记为失败（调用方持有 _idle），返回最近的截止时间，没有时为 None"""
+        now = time.monotonic()
+        for token, (deadline, job, target, attempts) in list(self._sending.items()):
+            if deadline <= now:
+                del self._sending[token]
+                self._abandoned.add(token)
+                self.timed_out += 1
+                updates = self._failure(target, attempts, f'发送超过 {self.timeout} 秒未完成')
+                self._results.append((job, updates, True))
+        return min((deadline for deadline, *_ in self._sending.values()), default=None)
+
+    def _commit_loop(self):
+        """写入线程：发送结果合并写回 tasks.json。有结果后等待其余已提交的发送完成（最多
+        RESULT_COMMIT_DELAY 秒），一次 tick 交出的提醒通常只产生一次写入"""
+        while True:
+            with self._idle:
+                while True:
+                    deadline = self._expire()
+                    if self._results:
+                        break
+                    self._idle.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+                self._idle.wait_for(lambda: len(self._results) >= len(self._jobs), RESULT_COMMIT_DELAY)
+                self._expire()
+                batch, self._results = self._results, []
+            try:
+                utils.update_reminder_entries([(*job, updates) for job, updates, _ in batch])
+            except Exception as e:
+                # 记录仍是 queued / retry，由调度器稍后重新提交
+                print(f'[提醒发送] 写入 {len(batch)} 条发送结果失败: {e}')
+            with self._idle:
+                self.commits += 1
+                for job, _, done in batch:
+                    if done:
+                        self._jobs.discard(job)
+                self._idle.notify_all()
+
+    def _deliver(self, token, key, n, minutes, due_at):
+        """发送一次提醒邮件，返回要写回发送记录的修改（记录已不需要发送时返回 None）"""
+        task = self.store.get('tasks.json', key)
+        target = None if task is None else utils.thaw(task) if n is None else utils.get_occurrence(task, n)
+        entry = target and utils.reminder_entry(target.get('sent_reminders'), minutes)
+        if not entry or entry['status'] not in ('queued', 'retry'):
+            return None
+        attempts = entry.get('attempts', 0) + 1
+        error = None
+        with self._idle:
+            self._sending[token] = (time.monotonic() + self.timeout, (key, n, minutes), target, attempts)
+            # 唤醒写入线程，按新的截止时间等待
+            self._idle.notify_all()
+        try:
+            utils.email_task_reminder(target, minutes_left(target, minutes, self.clock()), timeout=self.timeout)
+        except ValueError as e:
+            # 邮箱未配置：与以前一样，站内通知已送达即视为已发送，只记录邮件错误
+            error = str(e)
+            print(f'[提醒发送] 任务 {target["name"]} 的提醒邮件未发送: {error}')
+        except Exception as e:
+            with self._idle:
+                if token in self._abandoned:
+                    # 已按超时记为失败
+                    return None
+            return self._failure(target, attempts, e)
+        now = self.clock()
+        with self._idle:
+            self.sent += 1
+            self._lateness.append(now - due_at)
+            if token in self._abandoned:
+                print(f'[提醒发送] 任务 {target["name"]} 的提醒在超时后发送成功')
+        updates = {'attempts': attempts, 'status': 'sent', 'sent_at': now}
+        if error is not None:
+            updates['error'] = error
+        return updates
+
+    def _failure(self, target, attempts, error):
+        """一次失败的尝试要写回的修改：按指数退避重试，次数用完或重试时间不早于开始时间时记为失败"""
+        now = self.clock()
+        next_at = now + self.backoff * 2 ** (attempts - 1)
+        start = utils.record_timestamp(target, 'start_time')
+        if attempts >= self.max_attempts or (start is not None and next_at >= start):
+            with self._idle:
+                self.failed += 1
+            print(f'[提醒发送] 任务 {target["name"]} 的提醒发送失败，不再重试: {error}')
+            return {'attempts': attempts, 'status': 'failed', 'error': str(error)}
+        with self._idle:
+            self.retried += 1
+        print(f'[提醒发送] 任务 {target["name"]} 的提醒发送失败，{next_at - now:.0f} 秒后重试: {error}')
+        return {'attempts': attempts, 'status': 'retry', 'next_at': next_at, 'error': str(error)}
+
+    def wait_idle(self, timeout=None):
+        """等待已提交的发送全部完成，超时返回 False"""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._jobs, timeout)
+
+    def stats(self):
+        with self._idle:
+            lateness = sorted(self._lateness)
+            return {
+                'workers': self.workers,
+                'queue_depth': len(self._pending),
+                'running': self._running,
+                'stuck': len(self._abandoned),
+                'submitted': self.submitted,
+                'sent': self.sent,
+                'retried': self.retried,
+                'failed': self.failed,
+                'timed_out': self.timed_out,
+                'commits': self.commits,
+                # 端到端延迟：应提醒时间到发送完成，最近 1000 次成功发送
+                'lateness_avg': round(sum(lateness) / len(lateness), 2) if lateness else None,
+                'lateness_p95': round(lateness[int(len(lateness) * 0.95)], 2) if lateness else None,
+                'lateness_max': round(lateness[-1], 2) if lateness else None,
+            }
+
+
+class ReminderScheduler:
+
+    def __init__(self, store, dispatcher, lease=None, clock=time.time, catchup_rate=REMINDER_CATCHUP_RATE):
+        self.store = store
+        self.dispatcher = dispatcher
+        self.lease = lease
+        self.leading = lease is None
+        self.clock = clock
+        self.catchup_rate = catchup_rate
+        self._lock = threading.Lock()
+        self._heap = []               # (触发时间, 序号, 任务键, 版本, 类型, 发生序号, 参数)
+        self._seq = itertools.count()
+        self._versions = {}           # 任务键 -> 版本，每次写入递增
+        self._live = {}               # 任务键 -> 当前版本在堆中的条目数
+        self._stale = 0
+        self._built_at = None
+        self._changed = None          # 建立期间记录写入事件：任务键 -> 最新记录
+        self._backlog = []            # 错过的提醒，按开始时间排列：(开始时间, 触发时间, 序号, 任务键, 发生序号, 分钟数)
+        self._overdue = []            # 建立时任务已经开始的错过提醒，不需要发送，下一次处理时一并合并
+        self._tokens = 0.0
+        self._drained_at = None
+        self._last_tick = None        # 本进程最近一次处理的时间，None 表示（本次持有租约后）尚未处理过
+        self._saved_at = None
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.dispatched = 0
+        self.commits = 0
+        self.caught_up = 0
+        self.coalesced = 0
+
+    # ---- 建立与增量更新 ----
+
+    def build(self, now=None):
+        """由任务数据重建整个堆（启动时，以及每 REMINDER_RESYNC_SECONDS 秒一次以发现其他进程的写入）。
+        启动（或接管）后第一次建立时，还把上次保存的处理时间之后错过的提醒放入补发队列"""
+        with self._lock:
+            self._changed = {}
+        # 在锁外读取（读取可能要等集合写锁，而写入方持有写锁时会通知本调度器）
+        tasks = self.store.read('tasks.json')
+        now = now or self.clock()
+        since = self._catchup_since(now) if self._last_tick is None else None
+        with self._lock:
+            # 读取期间发生的写入以事件中的记录为准
+            changed, self._changed = self._changed, None
+            tasks = dict(tasks, **changed)
+            self._heap = []
+            self._live = {}
+            self._stale = 0
+            if since is not None:
+                self._backlog = []
+            for key, task in tasks.items():
+                if task is not None:
+                    self._schedule(key, task, now, since=since)
+            heapq.heapify(self._heap)
+            if since is not None:
+                self._overdue = [item for item in self._backlog if item[0] <= now]
+                self._backlog = [item for item in self._backlog if item[0] > now]
+            heapq.heapify(self._backlog)
+            self._built_at = now
+        self._wakeup.set()
+        print(f'[提醒调度] 已建立提醒队列：{len(tasks)} 个任务，{len(self._heap)} 个条目')
+        if since is not None:
+            print(f'[提醒调度] 自 {datetime.fromtimestamp(since):%Y-%m-%d %H:%M:%S} 以来错过 '
+                  f'{len(self._backlog) + len(self._overdue)} 个提醒，其中 {len(self._backlog)} 个任务尚未开始，'
+                  f'按每秒 {self.catchup_rate} 个补发')
+
+    def _catchup_since(self, now):
+        """上次保存的处理时间（最多回看 REMINDER_CATCHUP_MAX_SECONDS），从未保存过时不补发"""
+        state = self.store.get(STATE_DOC, 'reminders')
+        last_tick = state.get('last_tick') if state else None
+        return None if last_tick is None else max(last_tick, now - REMINDER_CATCHUP_MAX_SECONDS)
+
+    def on_change(self, name, changes):
+        if name != 'tasks.json':
+            return
+        now = self.clock()
+        with self._lock:
+            if self._changed is not None:
+                self._changed.update((key, task) for key, _, task in changes or ())
+            if self._built_at is None:
+                return
+            if changes is None:
+                # 整个集合被替换：由后台线程（或下一次 run_due）重建
+                self._built_at = None
+                self._heap = []
+                self._wakeup.set()
+                return
+            for key, _, task in changes:
+                self._stale += self._live.pop(key, 0)
+                self._versions[key] = self._versions.get(key, 0) + 1
+                if task is not None:
+                    self._schedule(key, task, now, push=True)
+            if self._stale > 1000 and self._stale * 2 > len(self._heap):
+                self._compact()
+
+    def _schedule(self, key, task, now, push=False, after=None, since=None):
+        """排入任务的条目（调用方持有锁）；after 为重复任务从哪个时间开始展开，
+        since 不为 None 时把触发时间在 [since, now - 容差) 内、尚未发送的提醒放入补发队列"""
+        start = utils.record_timestamp(task, 'start_time')
+        if start is None:
+            return
+        if not task.get('recurrence'):
+            self._add_reminders(key, task, start, None, now, push, since)
+            if task.get('status') == 'pending':
+                self._add(key, start, 'start', None, None, push)
+            return
+        # 重复任务：排入从 after（默认 now - 容差）起的第一次发生，并在下一次发生的第一个提醒之前展开下一次
+        lead = max((m for m in utils.task_reminder_times(task) if m > 0), default=0) * 60 + GRACE_SECONDS
+        after = now - GRACE_SECONDS if after is None else after
+        if since is not None and since < after:
+            # 停机期间已经开始的各次发生
+            for occurrence in utils.iter_occurrences(task, since, after, now):
+                self._add_reminders(key, occurrence, occurrence['start_time_ts'], occurrence['occurrence'], now, push,
+                                    since)
+        upcoming = utils.iter_occurrences(task, after, None, now)
+        occurrence = next(upcoming, None)
+        if occurrence is None:
+            return
+        self._add_reminders(key, occurrence, occurrence['start_time_ts'], occurrence['occurrence'], now, push, since)
+        following = next(upcoming, None)
+        if following is not None:
+            self._add(key, following['start_time_ts'] - lead, 'next', following['occurrence'],
+                      following['start_time_ts'], push)
+
+    def _add_reminders(self, key, task, start, n, now, push, since=None):
+        if utils.occurrence_reminded(task, n):
+            return
+        sent = task.get('sent_reminders')
+        for minutes in utils.task_reminder_times(task):
+            if minutes <= 0:
+                continue
+            entry = utils.reminder_entry(sent, minutes)
+            if entry is None:
+                fire_at = start - minutes * 60
+                if fire_at >= now - GRACE_SECONDS:
+                    self._add(key, fire_at, 'remind', n, minutes, push)
+                elif since is not None and fire_at >= since and fire_at >= (field_value(task, 'created_at_ts') or 0):
+                    # 任务创建之后、处理停止期间错过的提醒（创建时提醒时间已过的不算错过）
+                    self._backlog.append((start, fire_at, next(self._seq), key, n, minutes))
+            elif entry['status'] == 'retry':
+                self._add(key, entry.get('next_at') or now, 'deliver', n, minutes, push)
+            elif entry['status'] == 'queued':
+                # 已认领但没有发送结果：正常情况下由发送线程写入结果；进程在发送前退出时超时后重新发送
+                self._add(key, (entry.get('claimed_at') or now) + QUEUED_RECOVERY_SECONDS, 'deliver', n, minutes, push)
+
+    def _add(self, key, fire_at, kind, n, arg, push):
+        entry = (fire_at, next(self._seq), key, self._versions.get(key, 0), kind, n, arg)
+        self._live[key] = self._live.get(key, 0) + 1
+        if not push:
+            self._heap.append(entry)
+            return
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            # 新条目比当前等待的更早，唤醒后台线程重新计算睡眠时间
+            self._wakeup.set()
+
+    def _compact(self):
+        self._heap = [e for e in self._heap if e[3] == self._versions.get(e[2], 0)]
+        heapq.heapify(self._heap)
+        self._stale = 0
+
+    # ---- 触发 ----
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                entry = heapq.heappop(heap)
+                key, version = entry[2], entry[3]
+                if version != self._versions.get(key, 0):
+                    self._stale -= 1
+                    continue
+                self._live[key] -= 1
+                due.append(entry)
+        return due
+
+    def run_due(self, now=None):
+        """处理所有已到期的条目，再按速率补发错过的提醒，返回交给发送线程的提醒数。尚未建立队列时先建立"""
+        if self._built_at is None:
+            self.build(now)
+        now = now or self.clock()
+        started = []
+        claims = []
+        resubmits = []
+        missed = []
+        # 展开重复任务的下一次发生可能排入新的到期条目，直到没有到期条目为止
+        due = self._pop_due(now)
+        while due:
+            for fire_at, _, key, version, kind, n, arg in due:
+                if kind == 'start':
+                    started.append(key)
+                else:
+                    self._fire(key, version, fire_at, kind, n, arg, now, claims, resubmits)
+            due = self._pop_due(now)
+        # 实时的提醒处理完之后再补发，补发队列再长也不会推迟按时的提醒
+        with self._lock:
+            overdue, self._overdue = self._overdue, []
+        for item in overdue + self._take_backlog(now):
+            self._catch_up(item, now, claims, missed)
+        dispatched = self._commit(claims, resubmits, started, missed, now)
+        self.dispatched += dispatched
+        self._last_tick = now
+        if self._saved_at is None or now - self._saved_at >= TICK_SAVE_SECONDS:
+            self._save_tick(now)
+        return dispatched
+
+    def _fire(self, key, version, fire_at, kind, n, arg, now, claims, resubmits):
+        """处理一个到期条目：要认领的提醒加入 claims，要重新提交的加入 resubmits，由 _commit 一并写入"""
+        task = self.store.get('tasks.json', key)
+        # 弹出之后任务又被修改过：以修改时重新排入的条目为准
+        if task is None or self._versions.get(key, 0) != version:
+            return
+        if kind == 'next':
+            with self._lock:
+                if self._versions.get(key, 0) == version:
+                    self._schedule(key, task, now, push=True, after=arg)
+            return
+        target = utils.thaw(task) if n is None else utils.get_occurrence(task, n, now)
+        if target is None:
+            return
+        entry = utils.reminder_entry(target.get('sent_reminders'), arg)
+        if kind == 'deliver':
+            if entry and entry['status'] in ('queued', 'retry'):
+                resubmits.append((key, n, arg, entry.get('due_at') or fire_at, target, entry))
+            return
+        if entry is not None:
+            print(f'[提醒调度] 提醒已发送过，跳过: 任务 {task["name"]} 开始前 {arg} 分钟')
+        elif now > fire_at + GRACE_SECONDS:
+            # 处理得太晚（一次处理耗时过长、进程被挂起）：和停机期间错过的提醒一样按速率补发
+            print(f'[提醒调度] 提醒已错过，加入补发队列: 任务 {task["name"]} 开始前 {arg} 分钟')
+            with self._lock:
+                heapq.heappush(self._backlog, (utils.record_timestamp(target, 'start_time'), fire_at,
+                                               next(self._seq), key, n, arg))
+        else:
+            claims.append((key, n, arg, fire_at, target))
+
+    def _take_backlog(self, now):
+        """按 catchup_rate 从补发队列取出本次可以处理的提醒（令牌桶，最多攒 1 秒的量）"""
+        with self._lock:
+            if not self._backlog:
+                self._drained_at = now
+                return []
+            elapsed = 1 if self._drained_at is None else max(now - self._drained_at, 0)
+            self._tokens = min(self._tokens + elapsed * self.catchup_rate, self.catchup_rate)
+            self._drained_at = now
+            count = min(int(self._tokens), len(self._backlog))
+            self._tokens -= count
+            return [heapq.heappop(self._backlog) for _ in range(count)]
+
+    def _catch_up(self, item, now, claims, missed):
+        """补发一个错过的提醒：任务还没开始时作为迟到的提醒认领发送，已经开始时并入错过提醒的通知"""
+        start, fire_at, _, key, n, minutes = item
+        task = self.store.get('tasks.json', key)
+        target = None if task is None else utils.thaw(task) if n is None else utils.get_occurrence(task, n, now)
+        # 放入队列之后任务被删除、改了时间或提醒设置，或提醒已被其他进程处理
+        if (target is None or utils.record_timestamp(target, 'start_time') != start
+                or minutes not in utils.task_reminder_times(target)
+                or utils.reminder_entry(target.get('sent_reminders'), minutes) is not None):
+            return
+        if start > now:
+            self.caught_up += 1
+            claims.append((key, n, minutes, fire_at, target))
+        else:
+            missed.append((key, n, minutes, fire_at, target))
+
+    def _save_tick(self, now):
+        """保存已处理到的时间：补发队列中还没处理的提醒之前的时间不算已处理，重启后会重新找出它们"""
+        with self._lock:
+            tick = min((item[1] for item in self._backlog + self._overdue), default=now)
+        try:
+            self.store.put(STATE_DOC, 'reminders', {'last_tick': min(tick, now)})
+            self._saved_at = now
+        except Exception as e:
+            print(f'[提醒调度] 保存处理时间失败: {e}')
+
+    def _commit(self, claims, resubmits, started, missed, now):
+        """一次 tick 的所有写入：认领记录和开始状态合并为一次 tasks.json 写入，站内通知每个分片一次写入，
+        都写入之后才交给发送线程。认领记录带有预留的通知 id，中途退出后恢复发送时再次写入同一条通知
+        不会产生重复；邮件发送之后、结果写入之前退出时，恢复后邮件会再发一次。
+        missed 中错过且任务已开始的提醒记为 missed，每个用户合并为一条通知"""
+        if not (claims or resubmits or started or missed):
+            return 0
+        users = list(dict.fromkeys(target['user_id'] for *_, target in missed))
+        count = len(claims) + len(users)
+        first_id = self.store.reserve_ids('notifications.json', count) if count else 0
+        missed_ids = {user_id: first_id + len(claims) + i for i, user_id in enumerate(users)}
+        updates = [(key, n, minutes, {'status': 'queued', 'attempts': 0, 'due_at': fire_at, 'claimed_at': now,
+                                      'notification_id': first_id + i})
+                   for i, (key, n, minutes, fire_at, _) in enumerate(claims)]
+        updates += [(key, n, minutes, {'status': 'missed', 'due_at': fire_at, 'claimed_at': now,
+                                       'notification_id': missed_ids[target['user_id']]})
+                    for key, n, minutes, fire_at, target in missed]
+        entries = utils.update_reminder_entries(updates, claim=True, started=started, now=now)
+        jobs = []
+        notifications = []
+        for (key, n, minutes, fire_at, target), entry in zip(claims, entries):
+            if entry is None:
+                # 认领前被其他进程认领或已发送
+                continue
+            remaining = minutes_left(target, minutes, now)
+            print(f"[提醒检查] 触发提醒！任务 {target['name']} 将在 {remaining} 分钟后开始")
+            notifications.append(utils.reminder_notification(target, remaining, entry['notification_id']))
+            jobs.append((key, n, minutes, fire_at))
+        for key, n, minutes, due_at, target, entry in resubmits:
+            if entry['status'] == 'queued' and entry.get('notification_id') is not None:
+                # 认领之后没有发送结果（进程中途退出）：补写可能缺失的站内通知
+                notifications.append(utils.reminder_notification(target, minutes_left(target, minutes, now),
+                                                                 entry['notification_id']))
+            jobs.append((key, n, minutes, due_at))
+        coalesced = {}
+        for (key, n, minutes, fire_at, target), entry in zip(missed, entries[len(claims):]):
+            if entry is not None:
+                coalesced.setdefault(target['user_id'], []).append(target)
+        for user_id, targets in coalesced.items():
+            print(f'[提醒调度] 用户 {user_id} 有 {len(targets)} 个已开始任务的提醒错过，合并为一条通知')
+            notifications.append(utils.missed_reminders_notification(user_id, targets, missed_ids[user_id]))
+            self.coalesced += len(targets)
+        if notifications:
+            utils.insert_notifications(notifications)
+        self.commits += 1
+        if jobs and self.dispatcher.stalled():
+            # 超时未返回的发送占满了所有发送线程：记录保持 queued / retry，过 timeout 秒再提交
+            print(f'[提醒调度] 发送线程都被超时未返回的发送占用，{len(jobs)} 个提醒稍后再发送')
+            with self._lock:
+                for key, n, minutes, _ in jobs:
+                    self._add(key, now + self.dispatcher.timeout, 'deliver', n, minutes, True)
+            return 0
+        return sum(1 for job in jobs if self.dispatcher.submit(*job))
+
+    def next_fire_time(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def _lead(self):
+        """参与选举（续约或接管），返回本进程是否负责处理提醒。失去租约时丢弃队列，接管时从存储重建"""
+        if self.lease is None:
+            return True
+        try:
+            leading = self.lease.acquire()
+        except OSError as e:
+            print(f'[提醒调度] 读写租约失败: {e}')
+            leading = False
+        if leading and not self.leading:
+            print(f'[提醒调度] 取得租约，由本进程处理提醒 ({self.lease.owner})')
+            # 从存储重建，并补发上一个持有者最后一次保存处理时间之后错过的提醒
+            self._built_at = None
+            self._last_tick = None
+        elif not leading and self.leading:
+            print('[提醒调度] 租约由其他进程持有，本进程停止处理提醒')
+            with self._lock:
+                self._built_at = None
+                self._heap = []
+                self._live = {}
+                self._stale = 0
+                self._backlog = []
+                self._overdue = []
+                self._last_tick = None
+                self._saved_at = None
+        self.leading = leading
+        return leading
+
+    def may_run(self):
+        """本进程现在能否处理提醒：持有租约，或者没有任何进程持有租约"""
+        return self.lease is None or self.leading or self.lease.holder() is None
+
+    def run_forever(self):
+        """调度主循环：只有持有租约的进程建立队列并处理提醒，睡眠到最早的触发时间（有更早的新条目时提前醒来）；
+        其他进程不建立队列，每 ttl/3 秒尝试接管一次"""
+        if self.lease is not None:
+            atexit.register(self.lease.release)
+        while True:
+            leading = False
+            try:
+                leading = self._lead()
+                if leading:
+                    if self._built_at is None or self.clock() - self._built_at >= REMINDER_RESYNC_SECONDS:
+                        self.build()
+                    self.run_due()
+            except Exception as e:
+                print(f"提醒检查出错: {e}")
+            self._wakeup.clear()
+            next_fire = self.next_fire_time() if leading else None
+            timeout = MAX_SLEEP_SECONDS if next_fire is None else min(max(next_fire - self.clock(), 0),
+                                                                       MAX_SLEEP_SECONDS)
+            if leading and (self._backlog or self._overdue):
+                # 补发队列每秒处理一批
+                timeout = min(timeout, 1)
+            if self.lease is not None:
+                # 续约间隔
+                timeout = min(timeout, self.lease.ttl / 3)
+            self._wakeup.wait(timeout)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run_forever, daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._heap),
+                'stale': self._stale,
+                'tasks': sum(1 for count in self._live.values() if count),
+                'next_fire': self._heap[0][0] if self._heap else None,
+                'dispatched': self.dispatched,
+                'commits': self.commits,
+                'built_at': self._built_at,
+                'leader': self.leading,
+                'backlog': len(self._backlog) + len(self._overdue),
+                'caught_up': self.caught_up,
+                'coalesced': self.coalesced,
+                'last_tick': self._last_tick,
+                'lease_owner': self.lease.owner if self.lease else None,
+                'dispatch': self.dispatcher.stats(),
+            }
+
+
+reminders = ReminderScheduler(utils.store, ReminderDispatcher(utils.store), FileLease(REMINDER_LEASE_PATH))
+utils.store.on_change(reminders.on_change)
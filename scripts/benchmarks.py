@@ -0,0 +1,199 @@
+"""性能基准：在合成数据上比较各实现的耗时、大小和内存，临时文件放在临时目录中，不会改动 data/。
+用法：python scripts/benchmarks.py <命令> [选项]，例如 python scripts/benchmarks.py bench-serializers --records 20000"""
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import REMINDER_TIMES
+import storage
+
+
+def _open_store(backend, data_dir):
+    if backend == 'sqlite':
+        from sqlite_store import SqliteStore
+        return SqliteStore(data_dir, os.path.join(data_dir, 'bench.db'))
+    return storage.open_store(backend, data_dir)
+
+
+@click.group()
+def cli():
+    """性能基准"""
+
+
+@cli.command('bench-serializers')
+@click.option('--records', default=20000, show_default=True, help='合成通知记录条数')
+@click.option('--repeat', default=3, show_default=True, help='每项取最好成绩的重复次数')
+def bench_serializers(records, repeat):
+    """比较各数据格式的保存/加载耗时与文件大小（合成数据）"""
+    import random
+    import serializers
+    import tempfile
+    rng = random.Random(42)
+    now = datetime.now()
+    data = {
+        str(i): {
+            'id': i,
+            'user_id': rng.randint(1, 500),
+            'title': '任务即将开始',
+            'content': f'任务「示例任务 {i}」将在{rng.choice(REMINDER_TIMES)}分钟后开始。',
+            'type': rng.choice(['system', 'reminder']),
+            'read': rng.random() < 0.5,
+            'created_at': (now - timedelta(minutes=i)).isoformat(),
+        }
+        for i in range(1, records + 1)
+    }
+    print(f'{records} 条记录，每项取 {repeat} 次中的最好成绩')
+    print(f'{"格式":<12}{"保存(ms)":>10}{"加载(ms)":>10}{"大小(KB)":>10}')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.json')
+        for name, serializer in serializers.SERIALIZERS.items():
+            if not serializers.available(name):
+                print(f'{name:<12}未安装，跳过')
+                continue
+            save_times, load_times = [], []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                with open(path, 'wb') as f:
+                    f.write(serializer.dumps(data))
+                save_times.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                with open(path, 'rb') as f:
+                    loaded = serializer.loads(f.read())
+                load_times.append(time.perf_counter() - started)
+            assert loaded == data
+            size = os.path.getsize(path)
+            print(f'{name:<12}{min(save_times) * 1000:>10.1f}{min(load_times) * 1000:>10.1f}{size / 1024:>10.1f}')
+
+
+@cli.command('bench-search')
+@click.option('--backend', type=click.Choice(['json', 'journal', 'sqlite']), default='json', show_default=True)
+@click.option('--tasks', 'count', default=100000, show_default=True, help='合成任务条数')
+@click.option('--repeat', default=5, show_default=True, help='每个查询取最好成绩的重复次数')
+def bench_search(backend, count, repeat):
+    """比较全文索引与逐条子串匹配的查询耗时（合成数据，在临时目录中进行）"""
+    import random
+    import tempfile
+    rng = random.Random(42)
+    words = ['周会', '项目', '评审', '需求', '文档', '客户', '会议室', '上线', '复盘', '健身', '读书', '采购',
+             'weekly', 'sync', 'review', 'design', 'release', 'budget', 'report', 'gym', 'standup', 'demo']
+    # 常用词之外再混入大量低频的主题词（随机两字词和英文编号），使查询的选择性接近真实数据
+    chars = '的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研'
+    topics = [''.join(rng.sample(chars, 2)) for _ in range(2000)] + [f'task{n}' for n in range(2000)]
+    places = ['会议室A', '会议室B', '家', '公司', 'Cafe', 'Online']
+    now = datetime.now()
+    data = {
+        str(i): {
+            'id': i,
+            'user_id': rng.randint(1, 1000),
+            'name': f'{rng.choice(words)} {rng.choice(topics)}',
+            'description': ' '.join(rng.choices(words, k=4) + rng.choices(topics, k=4)),
+            'notes': rng.choice(words),
+            'location': rng.choice(places),
+            'show_on_homepage': rng.random() < 0.2,
+            'created_at': (now - timedelta(minutes=i)).isoformat(),
+        }
+        for i in range(1, count + 1)
+    }
+    queries = ['周会', 'weekly review', topics[0], topics[1] + ' ' + topics[2], topics[2500], '客户 ' + topics[3000],
+               '不存在的词']
+    fields = storage.TEXT_INDEXES['tasks.json']
+
+    def scan(query):
+        parts = query.lower().split()
+        return sum(1 for task in data.values()
+                   if all(any(p in str(task.get(f) or '').lower() for f in fields) for p in parts))
+
+    def best(fn):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - started)
+        return min(times) * 1000, result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = _open_store(backend, tmp)
+        started = time.perf_counter()
+        store.save('tasks.json', data)
+        print(f'{backend}: 写入 {count} 条任务 {time.perf_counter() - started:.1f}s')
+        started = time.perf_counter()
+        store.search('tasks.json', '预热')
+        print(f'首次查询（含建立索引）{(time.perf_counter() - started) * 1000:.0f}ms')
+        print(f'{"查询":<16}{"扫描(ms)":>10}{"索引(ms)":>10}{"扫描命中":>10}{"索引命中":>10}')
+        for query in queries:
+            scan_ms, scanned = best(lambda: scan(query))
+            index_ms, hits = best(lambda: store.search('tasks.json', query))
+            print(f'{query:<16}{scan_ms:>10.1f}{index_ms:>10.2f}{scanned:>10}{len(hits):>10}')
+        started = time.perf_counter()
+        store.put('tasks.json', count + 1, dict(data['1'], id=count + 1, name='增量 update 测试'))
+        store.search('tasks.json', '增量')
+        print(f'写入一条并再次查询 {(time.perf_counter() - started) * 1000:.1f}ms')
+
+
+@cli.command('bench-records')
+@click.option('--records', 'count', default=100000, show_default=True, help='每个集合的合成记录条数')
+def bench_records(count):
+    """比较只读字典（FrozenDict）与类型化记录（records）的加载耗时、内存占用和遍历耗时"""
+    import random
+    import tracemalloc
+    rng = random.Random(42)
+    now = datetime.now()
+    # 旧数据中常见的字符串数字，类型化记录加载时统一转换
+    tasks = {
+        str(i): {
+            'id': i, 'user_id': rng.randint(1, 1000), 'name': f'任务 {i}', 'description': '合成数据',
+            'start_time': (now + timedelta(hours=i % 500)).isoformat(timespec='minutes'), 'location': '',
+            'duration': str(rng.choice([30, 60, 90])), 'notes': '', 'show_on_homepage': rng.random() < 0.2,
+            'reminder_times': [15, 60], 'created_at': (now - timedelta(minutes=i)).isoformat(),
+            'status': rng.choice(['pending', 'in_progress', 'completed']),
+            'completion_rate': str(rng.choice([0, 50, 100])), 'sent_reminders': [],
+            'created_at_ts': now.timestamp() - i * 60, 'start_time_ts': now.timestamp() + i % 500 * 3600,
+        }
+        for i in range(1, count + 1)
+    }
+    notifications = {
+        str(i): {
+            'id': i, 'user_id': rng.randint(1, 1000), 'title': rng.choice(['任务提醒', '新的关注者', '新的评论']),
+            'content': f'通知内容 {i}', 'type': rng.choice(['task_reminder', 'follow', 'comment']),
+            'read': rng.random() < 0.5, 'created_at': (now - timedelta(minutes=i)).isoformat(),
+            'created_at_ts': now.timestamp() - i * 60,
+        }
+        for i in range(1, count + 1)
+    }
+
+    def rate_sum(data):
+        total = 0.0
+        for record in data.values():
+            rate = record.get('completion_rate', 0)
+            total += rate if isinstance(rate, (int, float)) else float(rate)
+        return total
+
+    for name, data in (('tasks.json', tasks), ('notifications.json', notifications)):
+        print(f'{name}（{count} 条）')
+        print(f'{"方式":<12}{"加载(ms)":>10}{"内存(MB)":>10}{"遍历(ms)":>10}')
+        for label, load in (('FrozenDict', storage.freeze), ('records', lambda d: storage.load_collection(name, d))):
+            # 每次从刚解析的数据开始，与读取数据文件时一致；耗时与内存分两次测量（tracemalloc 会拖慢分配）
+            raw = json.loads(json.dumps(data))
+            started = time.perf_counter()
+            load(raw)
+            load_ms = (time.perf_counter() - started) * 1000
+            raw = json.loads(json.dumps(data))
+            tracemalloc.start()
+            loaded = load(raw)
+            del raw
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            started = time.perf_counter()
+            rate_sum(loaded) if name == 'tasks.json' else sum(1 for r in loaded.values() if not r.get('read'))
+            scan_ms = (time.perf_counter() - started) * 1000
+            print(f'{label:<12}{load_ms:>10.0f}{size / 1024 / 1024:>10.1f}{scan_ms:>10.1f}')
+
+
+if __name__ == '__main__':
+    cli()
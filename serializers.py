@@ -0,0 +1,124 @@
+"""数据文件的序列化格式：紧凑/缩进 JSON、可选的 orjson 加速以及 msgpack 二进制格式。
+读取时按文件内容自动识别格式，旧的缩进 JSON 文件无需迁移"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _default(value):
+    """JSON 原生类型之外的值：类型化记录（records.Record）按 to_dict() 序列化"""
+    to_dict = getattr(value, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError(f'无法序列化 {type(value).__name__}')
+    return to_dict()
+
+
+class JsonSerializer:
+    """标准库 JSON；indent 为 None 时输出无空白的紧凑格式"""
+
+    def __init__(self, name, indent=None):
+        self.name = name
+        self.indent = indent
+
+    def dumps(self, data):
+        if self.indent is None:
+            text = json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=_default)
+        else:
+            text = json.dumps(data, ensure_ascii=False, indent=self.indent, default=_default)
+        return text.encode('utf-8')
+
+    def loads(self, raw):
+        return json.loads(raw)
+
+
+class OrjsonSerializer:
+    """orjson：输出与紧凑 JSON 兼容，编解码快数倍"""
+    name = 'orjson'
+
+    def dumps(self, data):
+        return orjson.dumps(data, default=_default)
+
+    def loads(self, raw):
+        return orjson.loads(raw)
+
+
+class MsgpackSerializer:
+    """msgpack 二进制格式：体积更小，但文件不再可读"""
+    name = 'msgpack'
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True, default=_default)
+
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+SERIALIZERS = {
+    'json': JsonSerializer('json'),
+    'json-pretty': JsonSerializer('json-pretty', indent=4),
+    'orjson': OrjsonSerializer(),
+    'msgpack': MsgpackSerializer(),
+}
+
+# 已提示过 orjson 未安装（只提示一次）
+_fallback_warned = False
+
+
+def available(name):
+    """格式所需的可选依赖是否已安装"""
+    if name == 'orjson':
+        return orjson is not None
+    if name == 'msgpack':
+        return msgpack is not None
+    return name in SERIALIZERS
+
+
+def get_serializer(name):
+    """按名称取得序列化器；orjson 未安装时退回等价的标准库紧凑 JSON"""
+    if name not in SERIALIZERS:
+        raise ValueError(f'未知的数据格式: {name}')
+    if name == 'orjson' and orjson is None:
+        global _fallback_warned
+        if not _fallback_warned:
+            _fallback_warned = True
+            print('[存储] 未安装 orjson，使用标准库紧凑 JSON')
+        return SERIALIZERS['json']
+    if name == 'msgpack' and msgpack is None:
+        raise ValueError('数据格式 msgpack 需要先安装 msgpack 包')
+    return SERIALIZERS[name]
+
+
+def is_json(raw):
+    """JSON 文本以 { 或 [ 开头（允许前导空白）；顶层为映射的 msgpack 首字节是 0x80-0x8f/0xde/0xdf"""
+    head = raw.lstrip()[:1]
+    return head in (b'{', b'[') or not head
+
+
+def dumps_json(data):
+    """编码为紧凑 JSON 字节串（日志行、SQLite 列等必须是 JSON 的场合）"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default)
+    return SERIALIZERS['json'].dumps(data)
+
+
+def loads_json(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def loads(raw):
+    """按内容自动识别格式并解码"""
+    if is_json(raw):
+        return loads_json(raw)
+    if msgpack is None:
+        raise ValueError('数据文件是 msgpack 格式，需要先安装 msgpack 包')
+    return SERIALIZERS['msgpack'].loads(raw)
@@ -0,0 +1,523 @@
+"""SQLite 存储后端：与 JsonStore 相同的接口，数据保存在一个 WAL 模式的数据库中"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import serializers
+import textsearch
+from config import SQLITE_PATH
+from storage import (RANGE_INDEXES, TEXT_INDEXES, UNIQUE_FIELDS, ChangeEvents, DuplicateKeyError, Transaction, cache,
+                     field_value, load_collection, load_record, typed_changes)
+
+# 集合 -> (表名, 抽取出来用于查询的列, 索引列表)
+# 完整记录仍以 JSON 文本保存在 data 列中，保持与 JSON 文件相同的记录结构
+TABLES = {
+    'users.json': ('users', ('username', 'email', 'username_key', 'email_key'), ()),
+    'tasks.json': ('tasks', ('user_id', 'start_time', 'created_at', 'status', 'start_time_ts', 'created_at_ts',
+                         'recurring'), (
+        ('user_id', 'created_at'),
+        ('user_id', 'start_time'),
+        ('start_time',),
+        ('user_id', 'start_time_ts'),
+        ('user_id', 'created_at_ts', 'key'),
+        ('user_id', 'status', 'start_time_ts'),
+        ('recurring', 'user_id'),
+    )),
+    'notifications.json': ('notifications', ('user_id', 'created_at', 'read'), (
+        ('user_id', 'created_at'),
+        ('user_id', 'read'),
+    )),
+    'messages.json': ('messages', ('sender_id', 'receiver_id', 'conversation', 'created_at'), (
+        ('sender_id', 'receiver_id', 'created_at'),
+        ('receiver_id', 'created_at'),
+        ('conversation', 'created_at'),
+    )),
+    'posts.json': ('posts', ('user_id', 'created_at'), (
+        ('user_id', 'created_at'),
+        ('created_at',),
+    )),
+    'friendships.json': ('friendships', ('follower_id', 'followee_id', 'created_at'), (
+        ('follower_id',),
+        ('followee_id',),
+    )),
+}
+
+MIGRATE_BATCH_SIZE = 1000
+
+
+class SqliteStore(ChangeEvents):
+    """每个集合一张表；未在 TABLES 中登记的集合存放在通用的 documents 表里"""
+
+    def __init__(self, data_dir, db_path=None):
+        self.data_dir = data_dir
+        self.db_path = db_path or SQLITE_PATH
+        self._local = threading.local()
+        self._listeners = []
+        self._init_schema()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS collection_versions '
+                     '(name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS sequences '
+                     '(name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS documents '
+                     '(name TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, '
+                     'PRIMARY KEY (name, key))')
+        for table, columns, indexes in TABLES.values():
+            cols = ''.join(f', {c}' for c in columns)
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                         f'(key TEXT PRIMARY KEY, data TEXT NOT NULL{cols})')
+            self._add_missing_columns(conn, table, columns)
+            for index in indexes:
+                conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{"_".join(index)} '
+                             f'ON {table} ({", ".join(index)})')
+        for name in TEXT_INDEXES:
+            self._init_terms(conn, name)
+        for name, fields in UNIQUE_FIELDS.items():
+            table = TABLES[name][0]
+            for field in fields:
+                try:
+                    conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_{field} ON {table} ({field})')
+                except sqlite3.IntegrityError:
+                    # 历史数据中已有重复值：退化为普通索引，新写入仍由 utils 层的检查兜底
+                    print(f'[存储] {table}.{field} 存在重复值，无法建立唯一索引')
+                    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{field} ON {table} ({field})')
+
+    def _add_missing_columns(self, conn, table, columns):
+        """旧数据库升级：补上后来新增的列，并从 data 列回填"""
+        existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+        missing = [c for c in columns if c not in existing]
+        if not missing:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for column in missing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+            rows = conn.execute(f'SELECT key, data FROM {table}').fetchall()
+            assignments = ', '.join(f'{c} = ?' for c in missing)
+            conn.executemany(f'UPDATE {table} SET {assignments} WHERE key = ?', [
+                tuple(field_value(record, c) for c in missing) + (key,)
+                for key, record in ((key, serializers.loads_json(text)) for key, text in rows)
+            ])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _init_terms(self, conn, name):
+        """全文索引表：(词, 记录键, 词频)；首次创建时从已有数据回填"""
+        terms = f'{TABLES[name][0]}_terms'
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (terms,)).fetchone():
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {terms} (term TEXT NOT NULL, key TEXT NOT NULL, '
+                         f'tf INTEGER NOT NULL, PRIMARY KEY (term, key)) WITHOUT ROWID')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{terms}_key ON {terms} (key)')
+            rows = conn.execute(f'SELECT key, data FROM {TABLES[name][0]}').fetchall()
+            self._write_terms(conn, name, [(key, serializers.loads_json(text)) for key, text in rows])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _write_terms(self, conn, name, changes):
+        terms = f'{TABLES[name][0]}_terms'
+        changes = dict(changes)  # 同一记录多次修改时以最后一次为准
+        conn.executemany(f'DELETE FROM {terms} WHERE key = ?', [(key,) for key in changes])
+        conn.executemany(f'INSERT INTO {terms} (term, key, tf) VALUES (?, ?, ?)', [
+            (term, key, tf)
+            for key, record in changes.items() if record is not None
+            for term, tf in textsearch.record_terms(record, TEXT_INDEXES[name]).items()
+        ])
+
+    def search(self, name, text):
+        """与 JsonStore.search 相同，走全文索引表"""
+        terms = textsearch.query_terms(text)
+        if not terms:
+            return []
+        table = TABLES[name][0]
+        placeholders = ', '.join('?' * len(terms))
+        rows = self._conn().execute(
+            f'SELECT t.data, SUM(x.tf) FROM {table}_terms x JOIN {table} t ON t.key = x.key '
+            f'WHERE x.term IN ({placeholders}) GROUP BY x.key HAVING COUNT(*) = ?',
+            tuple(terms) + (len(terms),))
+        return [(load_record(name, serializers.loads_json(data)), tf) for data, tf in rows]
+
+    def build_indexes(self):
+        """索引由 SQLite 维护，无需预建"""
+
+    def _version(self, name):
+        row = self._conn().execute(
+            'SELECT version FROM collection_versions WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _bump(self, conn, name):
+        conn.execute('INSERT INTO collection_versions (name, version) VALUES (?, 1) '
+                     'ON CONFLICT(name) DO UPDATE SET version = version + 1', (name,))
+
+    def _select(self, name, where='', params=()):
+        """返回 (key, data) 查询结果"""
+        if name in TABLES:
+            table = TABLES[name][0]
+            sql = f'SELECT key, data FROM {table}'
+            if where:
+                sql += f' WHERE {where}'
+            return self._conn().execute(sql, params)
+        sql = 'SELECT key, data FROM documents WHERE name = ?'
+        if where:
+            sql += f' AND {where}'
+        return self._conn().execute(sql, (name,) + tuple(params))
+
+    def read(self, name):
+        """整个集合的只读视图，按集合版本号缓存"""
+        cache_key = f'sqlite:{self.db_path}:{name}'
+        signature = self._version(name)
+        data = cache.get(cache_key, signature)
+        if data is not None:
+            return data
+        version = cache.version(cache_key)
+        size = 0
+        records = {}
+        for key, text in self._select(name):
+            records[key] = serializers.loads_json(text)
+            size += len(text)
+        data = load_collection(name, records)
+        cache.put(cache_key, signature, version, data, size)
+        return data
+
+    def get(self, name, key):
+        row = self._select(name, 'key = ?', (str(key),)).fetchone()
+        return load_record(name, serializers.loads_json(row[1])) if row else None
+
+    def find(self, name, **criteria):
+        """按字段相等条件查询；条件字段都有对应列时走索引"""
+        columns = TABLES[name][1] if name in TABLES else ()
+        if not criteria or not all(field in columns for field in criteria):
+            return [r for r in self.read(name).values()
+                    if all(r.get(f) == v for f, v in criteria.items())]
+        where = ' AND '.join(f'{field} = ?' for field in criteria)
+        return [load_record(name, serializers.loads_json(text))
+                for key, text in self._select(name, where, tuple(criteria.values()))]
+
+    @staticmethod
+    def _group_clause(group):
+        return ' AND '.join(f'{f} = ?' for f in group), tuple(group.values())
+
+    def find_range(self, name, field, start, end, **group):
+        """分组内 field 在 [start, end) 的记录，走 (分组列, 排序列) 复合索引"""
+        where, params = self._group_clause(group)
+        rows = self._select(name, f'{where} AND {field} >= ? AND {field} < ? ORDER BY {field}',
+                            params + (start, end))
+        return [load_record(name, serializers.loads_json(text)) for key, text in rows]
+
+    def find_page(self, name, field, limit, after=None, descending=False, where=None, **group):
+        """与 JsonStore.find_page 相同；按索引顺序分批读取，直到凑满一页"""
+        group_where, group_params = self._group_clause(group)
+        op, order = ('<', 'DESC') if descending else ('>', 'ASC')
+        records = []
+        cursor = None
+        while True:
+            sql = f'{group_where} AND {field} IS NOT NULL'
+            params = group_params
+            if after is not None:
+                sql += f' AND ({field}, key) {op} (?, ?)'
+                params += tuple(after)
+            sql += f' ORDER BY {field} {order}, key {order} LIMIT {limit + 1}'
+            rows = self._select(name, sql, params).fetchall()
+            for key, text in rows:
+                record = load_record(name, serializers.loads_json(text))
+                after = (field_value(record, field), key)
+                if where is not None and not where(record):
+                    continue
+                if len(records) == limit:
+                    return records, cursor
+                records.append(record)
+                cursor = after
+            if len(rows) <= limit:
+                return records, None
+
+    def _count(self, name, where, params):
+        sql = f'SELECT COUNT(*) FROM {TABLES[name][0]}'
+        if where:
+            sql += f' WHERE {where}'
+        return self._conn().execute(sql, params).fetchone()[0]
+
+    def count(self, name, **criteria):
+        columns = TABLES[name][1] if name in TABLES else ()
+        if name not in TABLES or not all(field in columns for field in criteria):
+            return len(self.find(name, **criteria) if criteria else self.read(name))
+        return self._count(name, *self._group_clause(criteria))
+
+    def count_range(self, name, field, start=None, end=None, inclusive_end=False, **group):
+        where, params = self._group_clause(group)
+        where += f' AND {field} IS NOT NULL'
+        if start is not None:
+            where += f' AND {field} >= ?'
+            params += (start,)
+        if end is not None:
+            where += f' AND {field} {"<=" if inclusive_end else "<"} ?'
+            params += (end,)
+        return self._count(name, where, params)
+
+    def position(self, name, field, key, **group):
+        record = self.get(name, key)
+        if record is None or any(field_value(record, f) != v for f, v in group.items()):
+            return None
+        value = field_value(record, field)
+        if value is None:
+            return None
+        where, params = self._group_clause(group)
+        return self._count(name, f'{where} AND ({field}, key) < (?, ?)', params + (value, str(key)))
+
+    def reserve_ids(self, name, count=1):
+        """为集合分配 count 个连续的新 id，返回第一个（在写事务中完成，多进程安全）"""
+        with self._write_txn() as conn:
+            row = conn.execute('SELECT value FROM sequences WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                if name in TABLES:
+                    row = conn.execute(f'SELECT MAX(CAST(key AS INTEGER)) FROM {TABLES[name][0]}').fetchone()
+                else:
+                    row = conn.execute('SELECT MAX(CAST(key AS INTEGER)) FROM documents WHERE name = ?',
+                                       (name,)).fetchone()
+            last = row[0] or 0
+            conn.execute('INSERT INTO sequences (name, value) VALUES (?, ?) '
+                         'ON CONFLICT(name) DO UPDATE SET value = excluded.value', (name, last + count))
+        return last + 1
+
+    def next_id(self, name):
+        return self.reserve_ids(name, 1)
+
+    def put(self, name, key, record):
+        self.apply(name, [(str(key), record)])
+
+    def delete(self, name, key):
+        if self.get(name, key) is None:
+            return False
+        self.apply(name, [(str(key), None)])
+        return True
+
+    @contextmanager
+    def _write_txn(self):
+        """写事务：BEGIN IMMEDIATE 持有数据库写锁；已在事务中时直接并入外层事务"""
+        conn = self._conn()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    @contextmanager
+    def transaction(self, name):
+        """读-改-写事务：整个过程持有数据库写锁，读者（WAL）不受影响"""
+        with self._write_txn() as conn:
+            tx = Transaction(lambda key: self.get(name, key),
+                             lambda: [key for key, _ in self._select(name)])
+            yield tx
+            changes = tx.changes()
+            if changes:
+                events = self._old_records(name, changes)
+                try:
+                    self._write(conn, name, changes)
+                except sqlite3.IntegrityError as e:
+                    raise self._duplicate_error(name, e, changes) from e
+                self._bump(conn, name)
+        if changes and events:
+            self._notify(name, events)
+
+    @staticmethod
+    def _duplicate_error(name, error, changes):
+        # 错误信息形如 "UNIQUE constraint failed: users.username_key"
+        field = str(error).rsplit('.', 1)[-1]
+        value = next((field_value(r, field) for _, r in changes if r is not None), None)
+        return DuplicateKeyError(name, field, value)
+
+    def apply(self, name, changes):
+        with self._write_txn() as conn:
+            events = self._old_records(name, changes)
+            try:
+                self._write(conn, name, changes)
+            except sqlite3.IntegrityError as e:
+                raise self._duplicate_error(name, e, changes) from e
+            self._bump(conn, name)
+        if events:
+            # 事务提交之后再通知，监听者读到的是已提交的数据
+            self._notify(name, events)
+
+    def _old_records(self, name, changes):
+        """写入前（在写事务内）读出被修改记录的旧值，返回写入事件 [(键, 旧记录, 新记录)]；没有监听者时不查询"""
+        if not self._listeners:
+            return None
+        latest = dict((str(key), record) for key, record in typed_changes(name, changes))
+        keys = list(latest)
+        old = {}
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            for key, text in self._select(name, f'key IN ({", ".join("?" * len(batch))})', batch):
+                old[key] = load_record(name, serializers.loads_json(text))
+        return [(key, old.get(key), record) for key, record in latest.items()]
+
+    def save(self, name, data):
+        with self._write_txn() as conn:
+            if name in TABLES:
+                conn.execute(f'DELETE FROM {TABLES[name][0]}')
+                if name in TEXT_INDEXES:
+                    conn.execute(f'DELETE FROM {TABLES[name][0]}_terms')
+            else:
+                conn.execute('DELETE FROM documents WHERE name = ?', (name,))
+            self._write(conn, name, [(str(k), v) for k, v in data.items()])
+            self._bump(conn, name)
+        self._notify(name, None)
+
+    def _write(self, conn, name, changes):
+        changes = typed_changes(name, changes)
+        if name in TABLES:
+            table, columns, _ = TABLES[name]
+            placeholders = ', '.join('?' * (len(columns) + 2))
+            # 只在主键冲突时覆盖；不能用 INSERT OR REPLACE，它会静默删除违反唯一索引的其他行
+            updates = ', '.join(f'{c} = excluded.{c}' for c in ('data',) + columns)
+            upsert = (f'INSERT INTO {table} (key, data{"".join(", " + c for c in columns)}) '
+                      f'VALUES ({placeholders}) ON CONFLICT(key) DO UPDATE SET {updates}')
+            delete = f'DELETE FROM {table} WHERE key = ?'
+            rows = []
+            for key, record in changes:
+                if record is None:
+                    # 保持修改顺序：先写入之前累积的行
+                    conn.executemany(upsert, rows)
+                    rows = []
+                    conn.execute(delete, (key,))
+                else:
+                    rows.append((key, serializers.dumps_json(record).decode('utf-8'))
+                                + tuple(field_value(record, c) for c in columns))
+            conn.executemany(upsert, rows)
+            if name in TEXT_INDEXES:
+                self._write_terms(conn, name, changes)
+        else:
+            for key, record in changes:
+                if record is None:
+                    conn.execute('DELETE FROM documents WHERE name = ? AND key = ?', (name, key))
+                else:
+                    conn.execute('INSERT OR REPLACE INTO documents (name, key, data) VALUES (?, ?, ?)',
+                                 (name, key, serializers.dumps_json(record).decode('utf-8')))
+
+
+def iter_json_items(filepath, chunk_size=64 * 1024):
+    """流式读取顶层为对象的 JSON 文件，逐个产出 (key, value)，不把整个文件读入内存"""
+    decoder = json.JSONDecoder()
+    with open(filepath, 'r', encoding='utf-8') as f:
+        buf = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def skip(chars):
+            """跳过空白和给定的分隔符"""
+            nonlocal pos
+            while True:
+                while pos < len(buf) and (buf[pos].isspace() or buf[pos] in chars):
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return
+                fill()
+
+        def decode():
+            nonlocal pos
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # 数字等标量可能被块边界截断，读到下一个分隔符再解析
+                    if end == len(buf) and not eof:
+                        raise ValueError
+                    pos = end
+                    return value
+                except ValueError:
+                    if eof:
+                        raise
+                    fill()
+
+        fill()
+        skip('')
+        if pos >= len(buf):
+            return
+        if buf[pos] != '{':
+            raise ValueError(f'{filepath} 顶层不是 JSON 对象')
+        pos += 1
+        while True:
+            skip(',')
+            if pos >= len(buf):
+                raise ValueError(f'{filepath} 意外结束')
+            if buf[pos] == '}':
+                return
+            key = decode()
+            skip(':')
+            value = decode()
+            yield key, value
+
+
+def iter_items(filepath):
+    """逐个产出数据文件中的 (key, value)：JSON 流式解析，其他格式（msgpack）整体解码"""
+    with open(filepath, 'rb') as f:
+        head = f.read(64)
+    if serializers.is_json(head):
+        yield from iter_json_items(filepath)
+        return
+    with open(filepath, 'rb') as f:
+        yield from serializers.loads(f.read()).items()
+
+
+def migrate_from_json(data_dir, db_path=None, names=None):
+    """把 data/*.json 逐条导入 SQLite，返回 {集合: 导入条数}"""
+    store = SqliteStore(data_dir, db_path)
+    conn = store._conn()
+    counts = {}
+    for name in names or TABLES:
+        filepath = os.path.join(data_dir, name)
+        if not os.path.exists(filepath):
+            continue
+        count = 0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if name in TABLES:
+                conn.execute(f'DELETE FROM {TABLES[name][0]}')
+            batch = []
+            for key, record in iter_items(filepath):
+                batch.append((key, record))
+                if len(batch) >= MIGRATE_BATCH_SIZE:
+                    store._write(conn, name, batch)
+                    count += len(batch)
+                    batch = []
+            store._write(conn, name, batch)
+            count += len(batch)
+            store._bump(conn, name)
+            # 重新导入后由 reserve_ids 按现有最大 id 重新初始化序列
+            conn.execute('DELETE FROM sequences WHERE name = ?', (name,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        counts[name] = count
+    return counts
@@ -0,0 +1,1251 @@
+"""数据存储层：JSON 文档缓存与可切换的存储后端"""
+import bisect
+import contextvars
+import io
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows：用 msvcrt 锁住锁文件的第一个字节
+    fcntl = None
+    import msvcrt
+
+import records
+import serializers
+import textsearch
+from config import DATA_FORMAT, DOC_CACHE_MAX_BYTES, JOURNAL_COMPACT_MIN_BYTES, JOURNAL_COMPACT_RATIO
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError('缓存中的数据是只读的，如需修改请使用 thaw() 得到的副本')
+
+
+class FrozenDict(dict):
+    """只读字典：缓存共享给所有调用方，禁止原地修改"""
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """只读列表"""
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = remove = pop = clear = sort = reverse = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze(value):
+    """将解析出的 JSON 数据递归转换为只读结构"""
+    if isinstance(value, (FrozenDict, FrozenList, records.Record)):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """返回只读结构的可修改深拷贝（写时复制）"""
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [thaw(v) for v in value]
+    if isinstance(value, records.Record):
+        return {k: thaw(v) for k, v in value.to_dict().items()}
+    return value
+
+
+def load_record(name, record):
+    """从存储中读出的一条记录：登记了记录类型的集合转换为类型化记录，其他集合转换为只读字典"""
+    record_type = records.type_for(name)
+    return record_type.load(record) if record_type else freeze(record)
+
+
+def load_collection(name, data):
+    """从存储中读出的整个集合 {键: 记录} 转换为只读视图"""
+    record_type = records.type_for(name)
+    if record_type is None:
+        return freeze(data)
+    return FrozenDict((key, record_type.load(record)) for key, record in data.items())
+
+
+def typed_changes(name, changes):
+    """写入前按集合的记录类型校验并统一字段类型，值无效时抛出 ValueError（不写入任何数据）"""
+    record_type = records.type_for(name)
+    if record_type is None:
+        return changes
+    return [(key, None if record is None else record_type.coerce(record)) for key, record in changes]
+
+
+def file_signature(filepath):
+    """文件的变更标识 (mtime, size, inode)，文件不存在时返回 None"""
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class DocumentCache:
+    """按文件路径缓存解析结果，LRU 淘汰，以文件字节数近似内存占用"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        # filepath -> (signature, version, data, size)
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, filepath):
+        """该文件在本进程内被写入的次数"""
+        with self._lock:
+            return self._versions.get(filepath, 0)
+
+    def get(self, filepath, signature):
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry is not None and entry[0] == signature \
+                    and entry[1] == self._versions.get(filepath, 0):
+                self._entries.move_to_end(filepath)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, filepath, signature, version, data, size):
+        with self._lock:
+            # 解析期间文件被本进程再次写入，丢弃这份旧数据
+            if version != self._versions.get(filepath, 0):
+                return
+            self._discard(filepath)
+            self._entries[filepath] = (signature, version, data, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+
+    def bump(self, filepath):
+        """写入前调用：使旧条目失效并返回新版本号"""
+        with self._lock:
+            self._discard(filepath)
+            version = self._versions.get(filepath, 0) + 1
+            self._versions[filepath] = version
+            return version
+
+    def invalidate(self, filepath=None):
+        with self._lock:
+            if filepath is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                self._discard(filepath)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _discard(self, filepath):
+        entry = self._entries.pop(filepath, None)
+        if entry is not None:
+            self._bytes -= entry[3]
+
+
+cache = DocumentCache(DOC_CACHE_MAX_BYTES)
+serializer = serializers.get_serializer(DATA_FORMAT)
+
+
+def read_document(filepath, name=None):
+    """读取数据文件的只读视图（格式自动识别）；文件未变化时直接返回缓存。
+    name 为集合名时按集合的记录类型加载"""
+    signature = file_signature(filepath)
+    if signature is None:
+        return FrozenDict()
+    data = cache.get(filepath, signature)
+    if data is not None:
+        return data
+    version = cache.version(filepath)
+    with open(filepath, 'rb') as f:
+        data = serializers.loads(f.read())
+    data = load_collection(name, data) if name else freeze(data)
+    cache.put(filepath, signature, version, data, signature[1])
+    return data
+
+
+def write_document(filepath, data):
+    """按 DATA_FORMAT 写入数据文件（先写临时文件再替换，读者不会看到写了一半的文件）"""
+    version = cache.bump(filepath)
+    tmp_path = f'{filepath}.tmp.{os.getpid()}.{threading.get_ident()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(serializer.dumps(data))
+    os.replace(tmp_path, filepath)
+    signature = file_signature(filepath)
+    data = freeze(data)
+    cache.put(filepath, signature, version, data, signature[1])
+    return data
+
+
+def _fsync_dir(dirpath):
+    """rename 之后同步目录项，保证替换在断电后仍然可见（Windows 上不支持，忽略）"""
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+SEQUENCES = 'sequences.json'
+
+
+def lock_file(fd):
+    """对打开的文件加跨进程的排他锁，阻塞到取得为止（fcntl.flock，Windows 上为 msvcrt.locking）"""
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    os.lseek(fd, 0, os.SEEK_SET)
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            # LK_LOCK 重试约 10 秒后仍未取得，继续等待
+            pass
+
+
+def unlock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class CollectionLock:
+    """集合写锁：进程内可重入的线程锁 + 跨进程的文件锁（lock_file，仅最外层持有）。
+    只有写者需要加锁；读者读取的是不可变快照，不会被写者阻塞"""
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            if self._depth == 0:
+                fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    lock_file(fd)
+                except BaseException:
+                    os.close(fd)
+                    raise
+                self._fd = fd
+        except BaseException:
+            self._lock.release()
+            raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            unlock_file(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+
+class Transaction:
+    """集合上的读-改-写事务视图。通过 [] / get() 取到的记录是可修改的副本，
+    退出 with 时把被修改、新增、删除的记录一次性提交"""
+
+    def __init__(self, load, keys):
+        self._load = load
+        self._keys = keys
+        self._originals = {}
+        self._records = {}
+
+    def _fetch(self, key):
+        key = str(key)
+        if key not in self._records:
+            original = self._load(key)
+            self._originals[key] = original
+            self._records[key] = thaw(original) if original is not None else None
+        return self._records[key]
+
+    def get(self, key, default=None):
+        record = self._fetch(key)
+        return default if record is None else record
+
+    def __getitem__(self, key):
+        record = self._fetch(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __contains__(self, key):
+        return self._fetch(key) is not None
+
+    def __setitem__(self, key, record):
+        self._fetch(key)
+        self._records[str(key)] = record
+
+    def __delitem__(self, key):
+        if self._fetch(key) is None:
+            raise KeyError(key)
+        self._records[str(key)] = None
+
+    def keys(self):
+        """当前可见的全部键：包含本事务新增的，不含本事务删除的"""
+        keys = [k for k in self._keys() if k not in self._records or self._records[k] is not None]
+        keys += [k for k, r in self._records.items() if r is not None and self._originals[k] is None]
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def changes(self):
+        return [(key, record) for key, record in self._records.items()
+                if record != self._originals[key]]
+
+
+class DuplicateKeyError(ValueError):
+    """写入违反唯一索引"""
+
+    def __init__(self, name, field, value):
+        super().__init__(f'{name} 中 {field}={value!r} 已存在')
+        self.name = name
+        self.field = field
+        self.value = value
+
+
+def normalize_identity(value):
+    """用户名/邮箱的规范形式：去掉首尾空白并忽略大小写，空值返回 None"""
+    if not value:
+        return None
+    return str(value).strip().casefold() or None
+
+
+def to_timestamp(value):
+    """ISO 时间字符串转换为 UTC 纪元秒；为空或格式错误时返回 None。
+    不带时区信息的时间按本地时间处理，以 Z 结尾的按 UTC 处理"""
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def conversation_key(user1_id, user2_id):
+    """两个用户之间会话的标识，与消息方向无关"""
+    low, high = sorted((user1_id, user2_id))
+    return f'{low}_{high}'
+
+
+def _timestamp_of(record, field):
+    ts = record.get(f'{field}_ts')
+    return ts if ts is not None else to_timestamp(record.get(field))
+
+
+# 由记录计算出的虚拟字段，可以像普通字段一样用于 find() 和索引
+VIRTUAL_FIELDS = {
+    'conversation': lambda r: conversation_key(r.get('sender_id'), r.get('receiver_id')),
+    'username_key': lambda r: normalize_identity(r.get('username')),
+    'email_key': lambda r: normalize_identity(r.get('email')),
+    # 尚未回填 *_ts 的旧记录现场解析
+    'start_time_ts': lambda r: _timestamp_of(r, 'start_time'),
+    'created_at_ts': lambda r: _timestamp_of(r, 'created_at'),
+    # 带重复规则的任务，查询时需要按窗口展开
+    'recurring': lambda r: bool(r.get('recurrence')),
+}
+
+
+def field_value(record, field):
+    compute = VIRTUAL_FIELDS.get(field)
+    return compute(record) if compute else record.get(field)
+
+
+# 唯一索引：写入时检查，值为 None 的记录不参与
+UNIQUE_FIELDS = {
+    'users.json': ('username_key', 'email_key'),
+}
+
+# 启动时预先建立的二级索引：集合 -> 字段组合（按字段名排序）
+INDEXES = {
+    'users.json': [('username_key',), ('email_key',)],
+    'tasks.json': [('user_id',), ('status', 'user_id'), ('recurring',), ('recurring', 'user_id')],
+    'notifications.json': [('user_id',), ('read', 'user_id')],
+    'posts.json': [('user_id',)],
+    'messages.json': [('conversation',), ('receiver_id', 'sender_id')],
+}
+
+
+# 比任何记录键都大的键：游标 (v, KEY_MAX) 之后即排序值大于 v 的条目
+KEY_MAX = '\U0010ffff'
+
+# 启动时预先建立的有序索引：集合 -> [(分组字段组合（按字段名排序）, 排序字段)]，
+# 供 find_range() 区间查询、find_page() 游标分页、count_range()/position() 计数
+RANGE_INDEXES = {
+    'tasks.json': [
+        (('user_id',), 'start_time_ts'),
+        (('user_id',), 'created_at_ts'),
+        (('status', 'user_id'), 'start_time_ts'),
+    ],
+}
+
+# 全文索引：集合 -> 参与检索的文本字段
+TEXT_INDEXES = {
+    'tasks.json': ('name', 'description', 'notes', 'location'),
+}
+
+
+class FieldIndex:
+    """内存二级索引：字段值 -> 记录键（有序集合，保持插入顺序）。
+    索引与构建它的集合快照对象绑定，快照被重新加载时自动重建"""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.source = None
+        self.buckets = {}
+
+    def key_of(self, record):
+        return tuple(field_value(record, f) for f in self.fields)
+
+    def rebuild(self, data):
+        buckets = {}
+        for key, record in data.items():
+            buckets.setdefault(self.key_of(record), {})[key] = None
+        self.buckets = buckets
+        self.source = data
+
+    def update(self, old_data, new_data, changes):
+        """在 old_data 基础上增量应用 changes；索引不是基于 old_data 时留待下次查询重建"""
+        if self.source is not old_data:
+            return
+        for key, record in changes:
+            old = old_data.get(key)
+            if old is not None:
+                bucket = self.buckets.get(self.key_of(old))
+                if bucket is not None:
+                    bucket.pop(key, None)
+                    if not bucket:
+                        del self.buckets[self.key_of(old)]
+            if record is not None:
+                self.buckets.setdefault(self.key_of(record), {})[key] = None
+        self.source = new_data
+
+    def keys(self, value):
+        return list(self.buckets.get(value, ()))
+
+
+class RangeIndex:
+    """内存有序索引：分组字段值 -> 按排序字段有序的 [(排序值, 记录键)]，排序值为 None 的记录不收录。
+    与 FieldIndex 一样绑定集合快照；区间查询和计数用二分查找，代价与集合大小无关"""
+
+    def __init__(self, group_fields, sort_field):
+        self.group_fields = group_fields
+        self.sort_field = sort_field
+        self.lock = threading.Lock()
+        self.source = None
+        self.groups = {}
+
+    def entry_of(self, key, record):
+        value = field_value(record, self.sort_field)
+        if value is None:
+            return None, None
+        return tuple(field_value(record, f) for f in self.group_fields), (value, key)
+
+    def rebuild(self, data):
+        groups = {}
+        for key, record in data.items():
+            group, entry = self.entry_of(key, record)
+            if entry is not None:
+                groups.setdefault(group, []).append(entry)
+        for entries in groups.values():
+            entries.sort()
+        self.groups = groups
+        self.source = data
+
+    def update(self, old_data, new_data, changes):
+        if self.source is not old_data:
+            return
+        for key, record in changes:
+            old = old_data.get(key)
+            if old is not None:
+                group, entry = self.entry_of(key, old)
+                entries = self.groups.get(group)
+                if entries:
+                    i = bisect.bisect_left(entries, entry)
+                    if i < len(entries) and entries[i] == entry:
+                        del entries[i]
+            if record is not None:
+                group, entry = self.entry_of(key, record)
+                if entry is not None:
+                    bisect.insort(self.groups.setdefault(group, []), entry)
+        self.source = new_data
+
+    def keys(self, group, start, end):
+        """排序值在 [start, end) 内的记录键，按排序值升序"""
+        entries = self.groups.get(group, ())
+        lo = bisect.bisect_left(entries, (start,))
+        hi = bisect.bisect_left(entries, (end,))
+        return [key for _, key in entries[lo:hi]]
+
+    def count(self, group, start=None, end=None, inclusive_end=False):
+        """排序值在 [start, end) 内的条目数（inclusive_end 为真时为 [start, end]），边界为 None 表示不限"""
+        entries = self.groups.get(group, ())
+        lo = 0 if start is None else bisect.bisect_left(entries, (start,))
+        if end is None:
+            hi = len(entries)
+        elif inclusive_end:
+            hi = bisect.bisect_right(entries, (end, KEY_MAX))
+        else:
+            hi = bisect.bisect_left(entries, (end,))
+        return max(hi - lo, 0)
+
+    def position(self, group, entry):
+        """条目在分组中的位置（从 0 开始），不在索引中时返回 None"""
+        entries = self.groups.get(group, ())
+        i = bisect.bisect_left(entries, entry)
+        return i if i < len(entries) and entries[i] == entry else None
+
+    def scan(self, group, after=None, descending=False):
+        """按 (排序值, 键) 顺序逐个产出位于游标 after 之后的条目；须在持有 lock 时迭代完"""
+        entries = self.groups.get(group, ())
+        if descending:
+            i = len(entries) if after is None else bisect.bisect_left(entries, tuple(after))
+            while i > 0:
+                i -= 1
+                yield entries[i]
+        else:
+            i = 0 if after is None else bisect.bisect_right(entries, tuple(after))
+            while i < len(entries):
+                yield entries[i]
+                i += 1
+
+
+class ChangeEvents:
+    """进程内写入事件：写入提交后依次调用 on_change 注册的 fn(name, changes)，
+    changes 为 [(键, 旧记录, 新记录)]（不存在的一方为 None），整体替换集合（save）时为 None。
+    其他进程的写入不会触发事件"""
+
+    def on_change(self, fn):
+        self._listeners.append(fn)
+        return fn
+
+    def _notify(self, name, changes):
+        for fn in self._listeners:
+            try:
+                fn(name, changes)
+            except Exception as e:
+                # 数据已经写入，监听者出错不影响写入结果
+                print(f'[存储] 写入事件处理失败 {name}: {e}')
+
+
+class JsonStore(ChangeEvents):
+    """每个集合对应 data/ 下的一个 JSON 文件，任何修改都重写整个文件"""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._indexes = {}
+        self._listeners = []
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def _lock(self, name):
+        """集合级写锁（进程内与进程间都串行化写入）"""
+        with self._locks_guard:
+            lock = self._locks.get(name)
+            if lock is None:
+                # 分片集合（如 notifications/3.json）位于子目录中，首次写入前创建
+                os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+                lock = self._locks[name] = CollectionLock(self.path(name) + '.lock')
+            return lock
+
+    @contextmanager
+    def transaction(self, name):
+        """读-改-写事务：在集合写锁内读取最新数据，正常退出时一次写入所有修改。
+
+            with store.transaction('posts.json') as posts:
+                posts[post_id]['likes'].append(user_id)
+        """
+        with self._lock(name):
+            data = self.read(name)
+            tx = Transaction(data.get, lambda: list(data))
+            yield tx
+            changes = tx.changes()
+            if changes:
+                self.apply(name, changes)
+
+    def read(self, name):
+        """整个集合的只读视图"""
+        return read_document(self.path(name), name)
+
+    def save(self, name, data):
+        """用 data 整体替换集合内容"""
+        data = dict(typed_changes(name, list(data.items())))
+        with self._lock(name):
+            write_document(self.path(name), data)
+            self._notify(name, None)
+
+    def get(self, name, key):
+        """单条记录的只读视图，不存在时返回 None"""
+        return self.read(name).get(str(key))
+
+    def find(self, name, **criteria):
+        """按字段相等条件查询，返回只读记录列表；代价与命中的记录数成正比"""
+        if not criteria:
+            return list(self.read(name).values())
+        index = self._index(name, tuple(sorted(criteria)))
+        with index.lock:
+            data = self.read(name)
+            if index.source is not data:
+                index.rebuild(data)
+            keys = index.keys(tuple(criteria[f] for f in index.fields))
+        return [data[key] for key in keys]
+
+    @contextmanager
+    def _ordered(self, name, field, group):
+        """持有有序索引的锁并保证索引基于当前快照，产出 (索引, 快照, 分组值)"""
+        fields = tuple(sorted(group))
+        index = self._range_index(name, fields, field)
+        with index.lock:
+            data = self.read(name)
+            if index.source is not data:
+                index.rebuild(data)
+            yield index, data, tuple(group[f] for f in fields)
+
+    def find_range(self, name, field, start, end, **group):
+        """分组（字段相等条件）内 field 在 [start, end) 的记录，按 field 升序"""
+        with self._ordered(name, field, group) as (index, data, value):
+            keys = index.keys(value, start, end)
+        return [data[key] for key in keys]
+
+    def find_page(self, name, field, limit, after=None, descending=False, where=None, **group):
+        """分组内按 (field, 键) 顺序的游标分页：返回游标 after 之后至多 limit 条满足 where 的记录，
+        以及下一页的游标 (field 值, 键)，没有更多记录时为 None。代价与扫描到的条目数成正比"""
+        records = []
+        cursor = last = None
+        with self._ordered(name, field, group) as (index, data, value):
+            for entry in index.scan(value, after, descending):
+                record = data[entry[1]]
+                if where is not None and not where(record):
+                    continue
+                if len(records) == limit:
+                    cursor = last
+                    break
+                records.append(record)
+                last = entry
+        return records, cursor
+
+    def count(self, name, **criteria):
+        """满足字段相等条件的记录数，直接取索引桶的大小"""
+        if not criteria:
+            return len(self.read(name))
+        index = self._index(name, tuple(sorted(criteria)))
+        with index.lock:
+            data = self.read(name)
+            if index.source is not data:
+                index.rebuild(data)
+            return len(index.buckets.get(tuple(criteria[f] for f in index.fields), ()))
+
+    def count_range(self, name, field, start=None, end=None, inclusive_end=False, **group):
+        """分组内 field 在 [start, end) 的记录数（inclusive_end 为真时包含 end，field 为空的记录不计），
+        边界为 None 表示不限"""
+        with self._ordered(name, field, group) as (index, data, value):
+            return index.count(value, start, end, inclusive_end)
+
+    def position(self, name, field, key, **group):
+        """记录在分组内按 (field, 键) 排序的位置（从 0 开始），不在分组中时返回 None"""
+        with self._ordered(name, field, group) as (index, data, value):
+            record = data.get(str(key))
+            if record is None:
+                return None
+            group_value, entry = index.entry_of(str(key), record)
+            return index.position(value, entry) if group_value == value else None
+
+    def search(self, name, text):
+        """全文检索：返回同时包含 text 中所有词的 (记录, 词频之和) 列表，不排序；代价与命中的记录数成正比"""
+        terms = textsearch.query_terms(text)
+        if not terms:
+            return []
+        index = self._text_index(name)
+        with index.lock:
+            data = self.read(name)
+            if index.source is not data:
+                index.rebuild(data)
+            hits = index.match(terms)
+        return [(data[key], tf) for key, tf in hits.items()]
+
+    def _text_index(self, name):
+        with self._locks_guard:
+            index = self._indexes.get((name, 'text'))
+            if index is None:
+                index = self._indexes[(name, 'text')] = textsearch.TextIndex(TEXT_INDEXES[name])
+            return index
+
+    def _range_index(self, name, group_fields, field):
+        with self._locks_guard:
+            index = self._indexes.get((name, 'range', group_fields, field))
+            if index is None:
+                index = self._indexes[(name, 'range', group_fields, field)] = RangeIndex(group_fields, field)
+            return index
+
+    def _index(self, name, fields):
+        with self._locks_guard:
+            index = self._indexes.get((name, fields))
+            if index is None:
+                index = self._indexes[(name, fields)] = FieldIndex(fields)
+            return index
+
+    def _update_indexes(self, name, old_data, new_data, changes):
+        with self._locks_guard:
+            indexes = [index for key, index in self._indexes.items() if key[0] == name]
+        for index in indexes:
+            with index.lock:
+                index.update(old_data, new_data, changes)
+
+    def _check_unique(self, name, old_data, changes):
+        """在写锁内检查唯一索引，冲突时抛出 DuplicateKeyError，不写入任何数据"""
+        changed = {key for key, _ in changes}
+        for field in UNIQUE_FIELDS.get(name, ()):
+            index = self._index(name, (field,))
+            seen = {}
+            with index.lock:
+                if index.source is not old_data:
+                    index.rebuild(old_data)
+                for key, record in changes:
+                    if record is None:
+                        continue
+                    value = field_value(record, field)
+                    if value is None:
+                        continue
+                    old = old_data.get(key)
+                    if old is not None and field_value(old, field) == value:
+                        # 值没有改变：历史数据中已有的重复值不妨碍修改记录的其他字段
+                        continue
+                    holders = [k for k in index.buckets.get((value,), ()) if k not in changed]
+                    if holders or seen.setdefault(value, key) != key:
+                        raise DuplicateKeyError(name, field, value)
+
+    def build_indexes(self):
+        """按 INDEXES 从数据文件预建二级索引（启动时调用，避免首个请求承担重建开销）"""
+        for name, field_sets in INDEXES.items():
+            for fields in field_sets:
+                index = self._index(name, fields)
+                with index.lock:
+                    index.rebuild(self.read(name))
+        for name, ordered in RANGE_INDEXES.items():
+            for group_fields, field in ordered:
+                index = self._range_index(name, group_fields, field)
+                with index.lock:
+                    index.rebuild(self.read(name))
+        for name in TEXT_INDEXES:
+            index = self._text_index(name)
+            with index.lock:
+                index.rebuild(self.read(name))
+
+    def put(self, name, key, record):
+        self.apply(name, [(str(key), record)])
+
+    def delete(self, name, key):
+        """删除记录，返回记录原本是否存在"""
+        if self.get(name, key) is None:
+            return False
+        self.apply(name, [(str(key), None)])
+        return True
+
+    def reserve_ids(self, name, count=1):
+        """为集合分配 count 个连续的新 id，返回第一个。
+        各集合已分配的最大 id 持久化在 sequences.json 中，首次使用时取现有最大 id"""
+        with self._lock(SEQUENCES):
+            last = self.read(SEQUENCES).get(name)
+            if last is None or any(self.get(name, last + i) is not None for i in range(1, count + 1)):
+                # 尚未初始化，或数据被外部改动过（如从备份恢复）：重新对齐到现有最大 id
+                last = max(last or 0, max(map(int, self.read(name).keys()), default=0))
+            self.put(SEQUENCES, name, last + count)
+            return last + 1
+
+    def next_id(self, name):
+        return self.reserve_ids(name, 1)
+
+    def apply(self, name, changes):
+        """批量写入：changes 为 (key, record) 列表，record 为 None 表示删除"""
+        changes = typed_changes(name, changes)
+        with self._lock(name):
+            old_data = self.read(name)
+            self._check_unique(name, old_data, changes)
+            data = dict(old_data)
+            for key, record in changes:
+                if record is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = record
+            new_data = write_document(self.path(name), data)
+            self._update_indexes(name, old_data, new_data, [(k, new_data.get(k)) for k, _ in changes])
+            self._notify(name, [(k, old_data.get(k), new_data.get(k)) for k in dict(changes)])
+
+
+class JournalStore(JsonStore):
+    """快照 + 追加日志：每次修改只向 <集合>.journal 追加一行记录，
+    内存状态由快照重放日志得到，日志过大时压缩为新快照"""
+
+    def journal_path(self, name):
+        return self.path(name) + '.journal'
+
+    def _signature(self, name):
+        return (file_signature(self.path(name)), file_signature(self.journal_path(name)))
+
+    def read(self, name):
+        """整个集合的只读视图。缓存失效时不加写锁重放，读取期间快照被压缩替换时重试"""
+        path = self.path(name)
+        data = cache.get(path, self._signature(name))
+        if data is not None:
+            return data
+        for _ in range(3):
+            data = self._replay(name)
+            if data is not None:
+                return data
+        with self._lock(name):
+            return self._replay(name, locked=True)
+
+    def _read_locked(self, name):
+        """持有写锁时读取：重放时截断追加时崩溃留下的不完整记录，之后的追加不会接在它后面"""
+        data = cache.get(self.path(name), self._signature(name))
+        return data if data is not None else self._replay(name, locked=True)
+
+    def _replay(self, name, locked=False):
+        """加载快照并重放日志到读取开始时的长度（写入者只向日志追加，快照加日志的任一完整前缀都是一致的状态）。
+        读取期间快照被压缩替换时返回 None。日志末尾不完整的记录（正在追加，或追加时崩溃）不重放：
+        持有写锁时截断，否则结果不放入缓存，由下一次持有写锁的读取截断"""
+        path = self.path(name)
+        jpath = self.journal_path(name)
+        version = cache.version(path)
+        signature = self._signature(name)
+        data = {}
+        if signature[0] is not None:
+            with open(path, 'rb') as f:
+                data = serializers.loads(f.read())
+        good = 0
+        if signature[1] is not None:
+            with open(jpath, 'rb') as f:
+                journal = f.read(signature[1][1])
+            for line in io.BytesIO(journal):
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = serializers.loads_json(line)
+                except ValueError:
+                    break
+                if entry['op'] == 'put':
+                    data[entry['key']] = entry['value']
+                else:
+                    data.pop(entry['key'], None)
+                good += len(line)
+        if file_signature(path) != signature[0]:
+            return None
+        if signature[1] is not None and good < signature[1][1]:
+            if not locked:
+                return load_collection(name, data)
+            print(f"[存储] {jpath} 末尾存在不完整记录，已截断到 {good} 字节")
+            with open(jpath, 'r+b') as f:
+                f.truncate(good)
+            signature = self._signature(name)
+        data = load_collection(name, data)
+        cache.put(path, signature, version, data, self._size(signature))
+        return data
+
+    @staticmethod
+    def _size(signature):
+        return sum(sig[1] for sig in signature if sig is not None)
+
+    def save(self, name, data):
+        data = FrozenDict(typed_changes(name, list(data.items())))
+        with self._lock(name):
+            self._compact(name, data)
+            self._notify(name, None)
+
+    def apply(self, name, changes):
+        changes = typed_changes(name, changes)
+        path = self.path(name)
+        jpath = self.journal_path(name)
+        with self._lock(name):
+            state = self._read_locked(name)
+            self._check_unique(name, state, changes)
+            lines = []
+            for key, record in changes:
+                if record is None:
+                    entry = {'op': 'del', 'key': key}
+                else:
+                    entry = {'op': 'put', 'key': key, 'value': record}
+                lines.append(serializers.dumps_json(entry) + b'\n')
+            version = cache.bump(path)
+            with open(jpath, 'ab') as f:
+                f.write(b''.join(lines))
+            # 顶层字典写时复制：正在遍历旧视图的读者不受影响
+            data = dict(state)
+            for key, record in changes:
+                if record is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = freeze(record)
+            data = FrozenDict(data)
+            signature = self._signature(name)
+            cache.put(path, signature, version, data, self._size(signature))
+            self._update_indexes(name, state, data, [(k, data.get(k)) for k, _ in changes])
+            self._notify(name, [(k, state.get(k), data.get(k)) for k in dict(changes)])
+            snapshot_size = signature[0][1] if signature[0] else 0
+            journal_size = signature[1][1]
+            if journal_size >= max(JOURNAL_COMPACT_MIN_BYTES, snapshot_size * JOURNAL_COMPACT_RATIO):
+                self._compact(name, data)
+
+    def compact(self, name):
+        """立即把日志合并进快照"""
+        with self._lock(name):
+            self._compact(name, self._read_locked(name))
+
+    def _compact(self, name, data):
+        """原子地写入新快照（临时文件 + fsync + rename）后清空日志。
+        若在两步之间崩溃，重放旧日志是幂等的（按键 upsert/delete）"""
+        path = self.path(name)
+        jpath = self.journal_path(name)
+        version = cache.bump(path)
+        tmp_path = f'{path}.tmp.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(serializer.dumps(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(os.path.dirname(path) or '.')
+        if os.path.exists(jpath):
+            with open(jpath, 'w', encoding='utf-8'):
+                pass
+        signature = self._signature(name)
+        cache.put(path, signature, version, freeze(data), self._size(signature))
+
+
+_current_unit = contextvars.ContextVar('current_unit_of_work', default=None)
+
+
+class UnitOfWork:
+    """请求级工作单元：同一请求内对每个集合/记录的读取只访问一次存储，
+    写入先缓冲在内存中，结束时每个集合合并为一次 apply()。
+
+    有唯一索引的集合直接写入，保证唯一性检查是原子的；
+    整集合读取和 find() 之前会先刷新该集合的缓冲写入（autoflush）。"""
+
+    def __init__(self, store):
+        self.store = store
+        self._collections = {}   # name -> 只读集合视图
+        self._records = {}       # (name, key) -> 只读记录或 None
+        self._queries = {}       # (name, criteria) -> 记录列表
+        self._pending = {}       # name -> {key: record 或 None}
+        self.reads = 0
+        self.reads_avoided = 0
+        self.writes_buffered = 0
+        self.flushes = 0
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_unit.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
+
+    def close(self):
+        """停用工作单元并丢弃未刷新的写入"""
+        self._pending.clear()
+        if self._token is not None:
+            try:
+                _current_unit.reset(self._token)
+            except ValueError:
+                _current_unit.set(None)
+            self._token = None
+
+    def _forget(self, name):
+        self._collections.pop(name, None)
+        self._queries = {k: v for k, v in self._queries.items() if k[0] != name}
+        self._records = {k: v for k, v in self._records.items() if k[0] != name}
+
+    def read(self, name):
+        self._flush_collection(name)
+        if name in self._collections:
+            self.reads_avoided += 1
+            return self._collections[name]
+        self.reads += 1
+        data = self._collections[name] = self.store.read(name)
+        return data
+
+    def get(self, name, key):
+        key = str(key)
+        pending = self._pending.get(name)
+        if pending is not None and key in pending:
+            self.reads_avoided += 1
+            return freeze(pending[key])
+        if (name, key) in self._records:
+            self.reads_avoided += 1
+            return self._records[(name, key)]
+        if name in self._collections:
+            self.reads_avoided += 1
+            return self._collections[name].get(key)
+        self.reads += 1
+        record = self._records[(name, key)] = self.store.get(name, key)
+        return record
+
+    def find(self, name, **criteria):
+        self._flush_collection(name)
+        query = (name, tuple(sorted(criteria.items())))
+        if query in self._queries:
+            self.reads_avoided += 1
+            return list(self._queries[query])
+        self.reads += 1
+        records = self._queries[query] = self.store.find(name, **criteria)
+        return list(records)
+
+    def find_range(self, name, field, start, end, **group):
+        self._flush_collection(name)
+        query = (name, ('range', field, start, end) + tuple(sorted(group.items())))
+        if query in self._queries:
+            self.reads_avoided += 1
+            return list(self._queries[query])
+        self.reads += 1
+        records = self._queries[query] = self.store.find_range(name, field, start, end, **group)
+        return list(records)
+
+    def find_page(self, name, field, limit, after=None, descending=False, where=None, **group):
+        # where 是任意函数，结果不缓存
+        self._flush_collection(name)
+        self.reads += 1
+        return self.store.find_page(name, field, limit, after, descending, where, **group)
+
+    def count(self, name, **criteria):
+        self._flush_collection(name)
+        self.reads += 1
+        return self.store.count(name, **criteria)
+
+    def count_range(self, name, field, start=None, end=None, inclusive_end=False, **group):
+        self._flush_collection(name)
+        self.reads += 1
+        return self.store.count_range(name, field, start, end, inclusive_end, **group)
+
+    def position(self, name, field, key, **group):
+        self._flush_collection(name)
+        self.reads += 1
+        return self.store.position(name, field, key, **group)
+
+    def search(self, name, text):
+        self._flush_collection(name)
+        self.reads += 1
+        return self.store.search(name, text)
+
+    def put(self, name, key, record):
+        self.apply(name, [(str(key), record)])
+
+    def delete(self, name, key):
+        if self.get(name, key) is None:
+            return False
+        self.apply(name, [(str(key), None)])
+        return True
+
+    @contextmanager
+    def transaction(self, name):
+        self._flush_collection(name)
+        try:
+            with self.store.transaction(name) as tx:
+                yield tx
+        finally:
+            self._forget(name)
+
+    def apply(self, name, changes):
+        # 在缓冲前校验，错误在调用处抛出而不是推迟到刷新时
+        changes = typed_changes(name, changes)
+        if name in UNIQUE_FIELDS:
+            self._flush_collection(name)
+            self.store.apply(name, changes)
+            self.flushes += 1
+            self._forget(name)
+            return
+        pending = self._pending.setdefault(name, {})
+        for key, record in changes:
+            pending[str(key)] = record
+            self._records.pop((name, str(key)), None)
+        self._collections.pop(name, None)
+        self._queries = {k: v for k, v in self._queries.items() if k[0] != name}
+        self.writes_buffered += len(changes)
+
+    def save(self, name, data):
+        self._pending.pop(name, None)
+        self.store.save(name, data)
+        self.flushes += 1
+        self._forget(name)
+
+    def _flush_collection(self, name):
+        pending = self._pending.pop(name, None)
+        if pending:
+            self.store.apply(name, list(pending.items()))
+            self.flushes += 1
+            self._forget(name)
+
+    def flush(self):
+        """把缓冲的写入提交到存储，每个集合一次写入"""
+        for name in list(self._pending):
+            self._flush_collection(name)
+
+    def stats(self):
+        return {
+            'reads': self.reads,
+            'reads_avoided': self.reads_avoided,
+            'writes_buffered': self.writes_buffered,
+            'flushes': self.flushes,
+        }
+
+    def __getattr__(self, attr):
+        # reserve_ids / build_indexes 等不涉及缓存的操作直接交给底层存储
+        return getattr(self.store, attr)
+
+
+class ScopedStore:
+    """存储代理：当前上下文中有活动的工作单元时转发给它，否则直接访问底层存储"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def begin(self):
+        """创建绑定到本存储的工作单元，用 with 语句或 __enter__/close 激活"""
+        return UnitOfWork(self.store)
+
+    def current(self):
+        unit = _current_unit.get()
+        return unit if unit is not None and unit.store is self.store else None
+
+    def __getattr__(self, attr):
+        return getattr(self.current() or self.store, attr)
+
+
+STORES = {
+    'json': JsonStore,
+    'journal': JournalStore,
+}
+
+
+def open_store(backend, data_dir):
+    """按配置创建存储后端"""
+    if backend == 'sqlite':
+        from sqlite_store import SqliteStore  # sqlite_store 依赖本模块，延迟导入
+        return SqliteStore(data_dir)
+    try:
+        store_class = STORES[backend]
+    except KeyError:
+        raise ValueError(f'未知的存储后端: {backend}')
+    return store_class(data_dir)
+
+
+class ShardRouter:
+    """按归属划分的集合路由：启用时通知按用户保存在 notifications/<user_id>.json，
+    消息按会话保存在 messages/<low>_<high>.json，每次写入只涉及一个用户或一个会话的数据。
+    未启用时所有方法都返回原来的全局集合"""
+    SHARDED = {'notifications.json': 'notifications', 'messages.json': 'messages'}
+
+    def __init__(self, data_dir, enabled):
+        self.data_dir = data_dir
+        self.enabled = enabled
+
+    def notifications(self, user_id):
+        return f'notifications/{user_id}.json' if self.enabled else 'notifications.json'
+
+    def messages(self, user1_id, user2_id):
+        if self.enabled:
+            return f'messages/{conversation_key(user1_id, user2_id)}.json'
+        return 'messages.json'
+
+    def shard_for(self, name, record):
+        """全局集合中的一条记录迁移后所属的分片"""
+        if name == 'notifications.json':
+            return f'notifications/{record["user_id"]}.json'
+        return f'messages/{conversation_key(record["sender_id"], record["receiver_id"])}.json'
+
+    def collections(self, name):
+        """全局集合对应的所有集合名（用于统计等需要遍历全部数据的场合）"""
+        if not self.enabled or name not in self.SHARDED:
+            return [name]
+        directory = os.path.join(self.data_dir, self.SHARDED[name])
+        try:
+            files = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        shards = set()
+        for f in files:
+            if f.endswith('.journal'):  # JournalStore 的分片可能还没有快照文件
+                f = f[:-len('.journal')]
+            if f.endswith('.json'):
+                shards.add(f'{self.SHARDED[name]}/{f}')
+        return sorted(shards)
+
+    def split(self, store, name):
+        """把全局集合拆分到各分片，返回迁移的记录数。
+        先写分片再清空全局集合；中途失败可以重新执行（按键覆盖，结果相同）"""
+        data = store.read(name)
+        if not data:
+            return 0
+        shards = {}
+        for key, record in data.items():
+            shards.setdefault(self.shard_for(name, record), []).append((key, record))
+        for shard, changes in shards.items():
+            store.apply(shard, changes)
+        # 分片后全局集合为空，id 序列需要按迁移前的最大 id 对齐
+        with store.transaction(SEQUENCES) as sequences:
+            last = max(map(int, data.keys()))
+            sequences[name] = max(sequences.get(name) or 0, last)
+        store.save(name, {})
+        return len(data)
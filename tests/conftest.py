@@ -0,0 +1,41 @@
+"""测试的公共设置：每个测试在临时目录中打开独立的存储，并替换 utils.store 底层的存储"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+import utils  # noqa: E402
+
+BACKENDS = ('json', 'journal', 'sqlite')
+
+
+def open_store(backend, data_dir):
+    """在 data_dir 中打开存储后端；sqlite 的数据库文件也放在 data_dir 中"""
+    if backend == 'sqlite':
+        from sqlite_store import SqliteStore
+        return SqliteStore(data_dir, os.path.join(data_dir, 'test.db'))
+    return storage.open_store(backend, data_dir)
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    return str(tmp_path)
+
+
+@pytest.fixture
+def store(backend, data_dir):
+    """临时目录中的存储，测试期间代替 utils.store 的底层存储"""
+    real_store = utils.store.store
+    utils.store.store = open_store(backend, data_dir)
+    try:
+        yield utils.store.store
+    finally:
+        utils.store.store = real_store
@@ -0,0 +1,256 @@
+"""提醒调度：用模拟时钟演练停机与补发，多进程选举后杀掉持有租约的进程，检查每个提醒恰好处理一次"""
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+import scheduler
+import utils
+from config import REMINDER_CATCHUP_RATE
+from conftest import open_store
+
+
+def record_sent_entries(store):
+    """在写入事件中记下每条发送记录 {(任务键, 发生序号, 分钟数): 记录}：
+    已经开始的各次发生的记录会被清理（prune_occurrences），检查时不能只看最终数据"""
+    recorded = {}
+
+    @store.on_change
+    def record(name, changes):
+        if name != 'tasks.json' or changes is None:
+            return
+        for key, _, task in changes:
+            if task is None:
+                continue
+            holders = [(None, task)] + [(n, o) for n, o in (task.get('occurrences') or {}).items()]
+            for n, holder in holders:
+                for entry in holder.get('sent_reminders') or ():
+                    recorded[key, n, entry['minutes']] = entry
+
+    return recorded
+
+
+def run_until(sched, clock, until):
+    """与 run_forever 相同的节奏：睡到下一个触发时间，补发期间每秒一次"""
+    while clock.now < until:
+        next_fire = sched.next_fire_time()
+        step = 1 if sched.stats()['backlog'] else 60
+        clock.now = min(until, clock.now + step, max(next_fire or math.inf, clock.now))
+        sched.run_due()
+        sched.dispatcher.wait_idle(30)
+
+
+def test_downtime_catch_up_handles_each_reminder_once(store, count=500, downtime=6):
+    """运行 1 小时、停机若干小时、重启后补发：每个提醒恰好有一条发送记录，
+    补发期间按时的提醒不被推迟"""
+    rng = random.Random(42)
+    clock = scheduler.SimulatedClock(math.floor(time.time() / 60) * 60)
+    t0 = clock.now
+    restart_at = t0 + 3600 + downtime * 3600
+    end = restart_at + 2 * 3600
+    # 用户没有邮箱：只写站内通知，不会发出真实邮件
+    store.apply('users.json', [(str(u), {'id': u, 'username': f'sim{u}', 'email': '', 'password': 'x'})
+                               for u in range(1, 51)])
+    created = datetime.fromtimestamp(t0 - 86400).isoformat()
+    tasks = []
+    for i in range(1, count + 1):
+        start = datetime.fromtimestamp(t0 + 35 * 60 + rng.random() * (end - t0 - 35 * 60))
+        task = {'id': i, 'user_id': rng.randint(1, 50), 'name': f'模拟任务 {i}',
+                'start_time': start.strftime('%Y-%m-%dT%H:%M'), 'status': 'pending',
+                'reminder_times': [30, 5], 'created_at': created, 'sent_reminders': []}
+        if i % 10 == 0:
+            task['recurrence'] = {'freq': 'daily', 'interval': 1}
+        tasks.append((str(i), task))
+    store.apply('tasks.json', tasks)
+    recorded = record_sent_entries(store)
+
+    def start_scheduler():
+        sched = scheduler.ReminderScheduler(utils.store, scheduler.ReminderDispatcher(utils.store, clock=clock),
+                                            clock=clock, catchup_rate=REMINDER_CATCHUP_RATE)
+        store.on_change(sched.on_change)
+        sched.build()
+        return sched
+
+    run_until(start_scheduler(), clock, t0 + 3600)
+    clock.now = restart_at
+    second = start_scheduler()
+    assert second.stats()['backlog'] > 0
+    run_until(second, clock, end)
+
+    # 每个触发时间在 [t0, end) 内的提醒都应恰好有一条发送记录
+    expected = 0
+    for _, task in tasks:
+        if task.get('recurrence'):
+            targets = list(utils.iter_occurrences(store.get('tasks.json', task['id']), t0, end + 1800, end))
+        else:
+            targets = [store.get('tasks.json', task['id'])]
+        for target in targets:
+            start = utils.record_timestamp(target, 'start_time')
+            expected += sum(1 for m in (30, 5) if t0 <= start - m * 60 < end)
+    entries = [e for e in recorded.values() if t0 <= e['due_at'] < end]
+    assert len(entries) == expected
+    statuses = {}
+    for entry in entries:
+        statuses[entry['status']] = statuses.get(entry['status'], 0) + 1
+    assert statuses.get('missed') and statuses.get('sent')
+    notifications = [n for u in range(1, 51) for n in utils.get_user_notifications(u)]
+    reminders = sum(1 for n in notifications if n['title'] == '任务即将开始')
+    assert reminders == statuses.get('sent', 0) + statuses.get('failed', 0)
+    assert any(n['title'] == '错过的任务提醒' for n in notifications)
+    # 重启之后到期的提醒都按时认领
+    assert all(e['claimed_at'] <= e['due_at'] for e in entries if e['due_at'] >= restart_at)
+
+
+def test_prune_keeps_marker_below_retrying_occurrence(store):
+    """第 3 次发生的提醒等待重试、第 4~5 次已发送：reminded_before 只推进到 3，
+    第 3 次的重试不被丢弃；第 3 次发送成功后再推进到 6"""
+    now = math.floor(time.time() / 60) * 60
+    start = datetime.fromtimestamp(now - 5.5 * 86400).strftime('%Y-%m-%dT%H:%M')
+    sent = {'status': 'sent', 'attempts': 1}
+    occurrences = {str(n): {'sent_reminders': [dict(sent, minutes=5)]} for n in (0, 1, 2, 4, 5)}
+    occurrences['3'] = {'sent_reminders': [{'minutes': 5, 'status': 'retry', 'attempts': 1, 'next_at': now + 60}]}
+    store.apply('tasks.json', [('1', {
+        'id': 1, 'user_id': 1, 'name': '每日任务', 'status': 'pending', 'start_time': start,
+        'recurrence': {'freq': 'daily', 'interval': 1}, 'reminder_times': [5],
+        'created_at': datetime.fromtimestamp(now - 6 * 86400).isoformat(), 'occurrences': occurrences})])
+
+    utils.update_reminder_entries([(1, 6, 5, {'status': 'queued', 'attempts': 0})], claim=True, now=now)
+    task = store.get('tasks.json', '1')
+    assert task['reminded_before'] == 3
+    assert sorted(task['occurrences'], key=int) == ['3', '4', '5', '6']
+    assert not utils.occurrence_reminded(task, 3)
+    assert utils.update_reminder_entries([(1, 3, 5, {'status': 'sent'})], now=now)[0]['status'] == 'sent'
+
+    utils.update_reminder_entries([(1, 7, 5, {'status': 'queued', 'attempts': 0})], claim=True, now=now)
+    task = store.get('tasks.json', '1')
+    assert task['reminded_before'] == 6
+    assert sorted(task['occurrences'], key=int) == ['6', '7']
+
+
+def test_timed_out_send_holds_slot_and_late_success_cancels_retry(store, monkeypatch):
+    """挂住的发送超时后记为重试，但仍占用发送线程，此时不再接受提交；
+    它之后发送成功时写回 sent，重试不会再发一封邮件"""
+    release = threading.Event()
+    calls = []
+
+    def email_task_reminder(target, remaining, timeout=None):
+        calls.append(target['id'])
+        if len(calls) == 1:
+            release.wait(10)
+
+    monkeypatch.setattr(utils, 'email_task_reminder', email_task_reminder)
+    now = time.time()
+    start = datetime.fromtimestamp(now + 3600).isoformat(timespec='seconds')
+    store.apply('tasks.json', [(str(i), {'id': i, 'user_id': 1, 'name': f'任务 {i}', 'status': 'pending',
+                                         'start_time': start, 'reminder_times': [5], 'sent_reminders': []})
+                               for i in (1, 2)])
+    utils.update_reminder_entries([(i, None, 5, {'status': 'queued', 'attempts': 0}) for i in (1, 2)], claim=True)
+    dispatcher = scheduler.ReminderDispatcher(utils.store, workers=1, timeout=0.2)
+
+    def entry(task_id):
+        return utils.reminder_entry(store.get('tasks.json', str(task_id))['sent_reminders'], 5)
+
+    def wait_for_status(task_id, status):
+        deadline = time.time() + 10
+        while time.time() < deadline and entry(task_id)['status'] != status:
+            time.sleep(0.05)
+        return entry(task_id)['status']
+
+    assert dispatcher.submit('1', None, 5, now)
+    assert wait_for_status(1, 'retry') == 'retry'
+    assert dispatcher.stalled()
+    assert not dispatcher.submit('2', None, 5, now)
+
+    release.set()
+    assert wait_for_status(1, 'sent') == 'sent'
+    assert not dispatcher.stalled()
+    # 到了重试时间再提交：记录已是 sent，不会再发送
+    assert dispatcher.submit('1', None, 5, now)
+    assert dispatcher.submit('2', None, 5, now)
+    assert wait_for_status(2, 'sent') == 'sent'
+    assert dispatcher.wait_idle(10)
+    assert calls == [1, 2]
+    assert entry(1)['attempts'] == 1
+
+
+def _scheduler_worker(backend, data_dir, lease_seconds):
+    """单个进程：与 run-scheduler 相同地参与选举并处理提醒，数据和租约文件都在临时目录中"""
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    store = utils.store.store = open_store(backend, data_dir)
+    lease = scheduler.FileLease(os.path.join(data_dir, 'reminder_scheduler.lease'), lease_seconds)
+    sched = scheduler.ReminderScheduler(utils.store, scheduler.ReminderDispatcher(utils.store), lease)
+    store.on_change(sched.on_change)
+    sched.run_forever()
+
+
+def _lease_pid(data_dir):
+    # Windows 上持有者正在续约时租约文件被锁住，稍后重试
+    for _ in range(10):
+        try:
+            with open(os.path.join(data_dir, 'reminder_scheduler.lease')) as f:
+                return json.load(f).get('pid')
+        except PermissionError:
+            time.sleep(0.1)
+        except (OSError, ValueError):
+            return None
+    return None
+
+
+def test_lease_takeover_sends_each_reminder_once(backend, data_dir, processes=4, count=150, lease_seconds=1.0):
+    """多个调度进程选出一个处理提醒；提醒陆续到期时杀掉持有租约的进程，
+    其他进程接管后每个提醒恰好有一条发送记录和一条通知"""
+    store = open_store(backend, data_dir)
+    # 用户没有邮箱：只写站内通知，不会发出真实邮件
+    store.apply('users.json', [(str(u), {'id': u, 'username': f'stress{u}', 'email': '', 'password': 'x'})
+                               for u in range(1, 11)])
+    now = time.time()
+    created = datetime.fromtimestamp(now).isoformat(timespec='seconds')
+    # 开始前 1 分钟提醒，提醒在启动后第 6~16 秒之间陆续到期
+    store.apply('tasks.json', [(str(i), {
+        'id': i, 'user_id': i % 10 + 1, 'name': f'压测任务 {i}', 'status': 'pending', 'reminder_times': [1],
+        'start_time': datetime.fromtimestamp(now + 66 + 10 * i / count).isoformat(timespec='seconds'),
+        'created_at': created, 'sent_reminders': []}) for i in range(1, count + 1)])
+
+    def sent_entries():
+        tasks = open_store(backend, data_dir).read('tasks.json')
+        return [e for task in tasks.values() for e in task.get('sent_reminders') or ()]
+
+    procs = [multiprocessing.Process(target=_scheduler_worker, args=(backend, data_dir, lease_seconds))
+             for _ in range(processes)]
+    for p in procs:
+        p.start()
+    try:
+        # 在提醒处理到一半时杀掉持有租约的进程，不给它交出租约的机会
+        time.sleep(max(now + 11 - time.time(), 0))
+        leader = next((p for p in procs if p.pid == _lease_pid(data_dir)), None)
+        assert leader is not None
+        leader.kill()
+        leader.join()
+        assert 0 < len(sent_entries()) < count
+        # 等待接管后的进程处理完剩余的提醒
+        deadline = time.time() + 60 + 3 * lease_seconds
+        while time.time() < deadline and len(sent_entries()) < count:
+            time.sleep(0.5)
+        successor = _lease_pid(data_dir)
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.kill()
+            p.join()
+    assert successor not in (None, leader.pid)
+    entries = sent_entries()
+    assert len(entries) == count
+    assert all(e['status'] == 'sent' for e in entries)
+    real_store = utils.store.store
+    utils.store.store = open_store(backend, data_dir)
+    try:
+        notifications = [n for u in range(1, 11) for n in utils.get_user_notifications(u)]
+    finally:
+        utils.store.store = real_store
+    contents = [n['content'] for n in notifications if n['title'] == '任务即将开始']
+    assert len(contents) == len(set(contents)) == count
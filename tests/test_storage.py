@@ -0,0 +1,121 @@
+"""存储后端的跨进程并发测试"""
+import multiprocessing
+import threading
+
+import pytest
+
+import storage
+import utils
+from conftest import open_store
+
+
+def _stress_worker(backend, data_dir, worker, threads, rounds):
+    """单个进程：多个线程并发对同一条记录做读-改-写"""
+    store = open_store(backend, data_dir)
+
+    def run(thread):
+        for i in range(rounds):
+            with store.transaction('counters.json') as counters:
+                counter = counters['hits']
+                counter['count'] += 1
+                counter['log'].append(f'{worker}-{thread}-{i}')
+
+    pool = [threading.Thread(target=run, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+
+def test_concurrent_transactions_lose_no_updates(backend, data_dir, processes=4, threads=4, rounds=25):
+    """多进程、多线程并发执行事务，计数和日志都不丢失更新"""
+    open_store(backend, data_dir).save('counters.json', {'hits': {'count': 0, 'log': []}})
+    procs = [multiprocessing.Process(target=_stress_worker, args=(backend, data_dir, w, threads, rounds))
+             for w in range(processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert all(p.exitcode == 0 for p in procs)
+    counter = open_store(backend, data_dir).get('counters.json', 'hits')
+    expected = processes * threads * rounds
+    assert counter['count'] == expected
+    assert len(set(counter['log'])) == expected
+
+
+def test_unread_notification_count_follows_writes(store):
+    """未读通知数由索引计数，随新增通知和标记已读更新"""
+    ids = [utils.add_notification(user_id, '通知', '内容') for user_id in (1, 1, 1, 2)]
+    assert utils.count_unread_notifications(1) == 3
+    assert utils.mark_notification_read(str(ids[0]), 1)
+    assert utils.count_unread_notifications(1) == 2
+    assert utils.count_unread_notifications(2) == 1
+    assert utils.count_unread_notifications(3) == 0
+
+
+@pytest.mark.parametrize('backend', ['json', 'journal'])
+def test_legacy_identity_collisions(store):
+    """建立唯一索引之前已有的忽略大小写重复的用户：启动时能找出来，登录查找结果确定，
+    修改这些用户的其他字段不被唯一索引拒绝，改成重复的值仍被拒绝"""
+    store.save('users.json', {
+        '1': {'id': 1, 'username': 'bob', 'email': 'bob@example.com', 'password': 'x'},
+        '2': {'id': 2, 'username': 'Bob', 'email': 'BOB@example.com', 'password': 'x'},
+        '3': {'id': 3, 'username': 'carol', 'email': 'carol@example.com', 'password': 'x'},
+    })
+    assert sorted(utils.find_identity_collisions()) == [('email', 'bob@example.com', [1, 2]),
+                                                         ('username', 'bob', [1, 2])]
+    assert utils.get_user_by_username('Bob')['id'] == 2
+    assert utils.get_user_by_username('BOB')['id'] == 1
+    assert utils.get_user_by_email('Bob@Example.com')['id'] == 1
+    assert utils.update_user(2, {'nickname': 'Bobby'})
+    assert utils.follow_user(2, 1) and utils.unfollow_user(2, 1)
+    with pytest.raises(utils.DuplicateKeyError):
+        utils.update_user(3, {'username': 'BOB'})
+
+
+def test_unit_of_work_counts_index_queries_as_reads(store):
+    """计数和位置查询与其他查询一样计入工作单元的读取次数"""
+    store.apply('tasks.json', [(str(i), {'id': i, 'user_id': 1, 'name': f'任务 {i}', 'status': 'pending',
+                                         'start_time': f'2030-01-0{i}T10:00'}) for i in range(1, 4)])
+    with storage.UnitOfWork(store) as unit:
+        assert unit.count('tasks.json', user_id=1) == 3
+        assert unit.count_range('tasks.json', 'start_time_ts', user_id=1) == 3
+        assert unit.position('tasks.json', 'start_time_ts', '2', user_id=1) == 1
+    assert unit.reads == 3
+
+
+def test_journal_read_replays_without_writer_lock(data_dir):
+    """缓存失效后的读取不等待持有写锁的写入者，不重放末尾不完整的记录；
+    追加时崩溃留下的不完整记录在下一次写入时截断"""
+    store = open_store('journal', data_dir)
+    store.apply('items.json', [(str(i), {'id': i}) for i in range(5)])
+    jpath = store.journal_path('items.json')
+    with open(jpath, 'ab') as f:
+        f.write(b'{"op": "put", "key": "9", "val')
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with store._lock('items.json'):
+            locked.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    try:
+        locked.wait(10)
+        storage.cache.invalidate()
+        result = []
+        reader = threading.Thread(target=lambda: result.append(store.read('items.json')))
+        reader.start()
+        reader.join(5)
+        assert not reader.is_alive()
+        assert sorted(result[0], key=int) == ['0', '1', '2', '3', '4']
+    finally:
+        release.set()
+        holder.join()
+    store.apply('items.json', [('5', {'id': 5})])
+    storage.cache.invalidate()
+    assert sorted(store.read('items.json'), key=int) == ['0', '1', '2', '3', '4', '5']
+    with open(jpath, 'rb') as f:
+        assert b'"val{' not in f.read()
@@ -0,0 +1,27 @@
+"""任务的批量导入导出"""
+import io
+
+import utils
+
+
+def test_export_import_round_trips_recurrence(store):
+    """导出的重复规则（CSV 中为 JSON 文本）能原样导入，无效规则和没有开始时间的重复任务被拒绝"""
+    rule = {'freq': 'weekly', 'interval': 2, 'count': 5}
+    count, errors = utils.import_tasks(1, [(1, {'name': '周会', 'start_time': '2030-01-07T10:00', 'recurrence': rule}),
+                                           (2, {'name': '一次性', 'start_time': '2030-01-08T10:00'})])
+    assert (count, errors) == (2, [])
+
+    for fmt, parse in (('csv', utils.iter_csv_rows), ('ndjson', utils.iter_ndjson_rows)):
+        exported = ''.join(utils.export_tasks(1, fmt)).encode('utf-8')
+        count, errors = utils.import_tasks(2, parse(io.BytesIO(exported)))
+        assert (count, errors) == (2, [])
+        rules = {task['name']: task.get('recurrence') for task in utils.store.find('tasks.json', user_id=2)}
+        assert rules == {'周会': rule, '一次性': None}
+        utils.store.apply('tasks.json', [(str(task['id']), None) for task in utils.store.find('tasks.json', user_id=2)])
+
+    count, errors = utils.import_tasks(3, [(1, {'name': '无效', 'start_time': '2030-01-07T10:00',
+                                                'recurrence': '{"freq": "hourly"}'}),
+                                           (2, {'name': '无开始时间', 'recurrence': {'freq': 'daily'}}),
+                                           (3, {'name': '格式错误', 'recurrence': 'weekly'})])
+    assert count == 0
+    assert errors == ['第 1 行：重复频率只能是每天、每周或每月', '第 2 行：重复任务必须设置开始时间', '第 3 行：重复规则格式错误']
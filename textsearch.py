@@ -0,0 +1,94 @@
+"""全文检索的分词与倒排索引。
+中日韩文字没有空格分词，按相邻两字切分（同时收录单字，以支持单字查询）；拉丁字母和数字按单词切分，不区分大小写"""
+import re
+import threading
+from collections import Counter
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'  # 假名、汉字、谚文
+_CJK_RE = re.compile(f'[{_CJK}]+')
+# 字母数字组成的单词（\w 去掉下划线和中日韩文字）
+_WORD_RE = re.compile(f'[^\\W_{_CJK}]+')
+
+
+def tokenize(text):
+    """索引用的词：中日韩文字的单字和相邻两字，以及拉丁单词"""
+    text = str(text).lower()
+    terms = _WORD_RE.findall(text)
+    for run in _CJK_RE.findall(text):
+        terms.extend(run)
+        terms.extend([run[i:i + 2] for i in range(len(run) - 1)])
+    return terms
+
+
+def query_terms(text):
+    """查询用的词：两字以上的中文只用相邻两字（更精确），单个汉字用单字"""
+    text = str(text).lower()
+    terms = set(_WORD_RE.findall(text))
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            terms.add(run)
+        else:
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def record_terms(record, fields):
+    """记录中各文本字段的词频 {词: 次数}"""
+    # 字段之间用换行分隔，不会产生跨字段的两字词
+    return Counter(tokenize('\n'.join(v for v in map(record.get, fields) if isinstance(v, str))))
+
+
+class TextIndex:
+    """内存倒排索引：词 -> {记录键: 词频}，索引 fields 中的文本字段。
+    与 storage 中的其他索引一样绑定集合快照，写入时按变化的记录增量更新"""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.source = None
+        self.postings = {}
+
+    def _add(self, key, record):
+        postings = self.postings
+        for term, tf in record_terms(record, self.fields).items():
+            posting = postings.get(term)
+            if posting is None:
+                posting = postings[term] = {}
+            posting[key] = tf
+
+    def _remove(self, key, record):
+        for term in record_terms(record, self.fields):
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(key, None)
+                if not posting:
+                    del self.postings[term]
+
+    def rebuild(self, data):
+        self.postings = {}
+        for key, record in data.items():
+            self._add(key, record)
+        self.source = data
+
+    def update(self, old_data, new_data, changes):
+        if self.source is not old_data:
+            return
+        for key, record in changes:
+            old = old_data.get(key)
+            if old is not None:
+                self._remove(key, old)
+            if record is not None:
+                self._add(key, record)
+        self.source = new_data
+
+    def match(self, terms):
+        """同时包含所有词的记录：{记录键: 各词词频之和}；从最短的倒排表开始求交集"""
+        postings = sorted((self.postings.get(term, {}) for term in terms), key=len)
+        if not postings or not postings[0]:
+            return {}
+        hits = dict(postings[0])
+        for posting in postings[1:]:
+            hits = {key: tf + posting[key] for key, tf in hits.items() if key in posting}
+            if not hits:
+                break
+        return hits
@@ -1,49 +1,74 @@
+import csv
+import heapq
+import io
 import json
 import os
+import time
 from datetime import datetime, timedelta
 import hashlib
 from werkzeug.security import generate_password_hash, check_password_hash
-from config import REMINDER_TIMES
+from config import (REMINDER_CATCHUP_MAX_SECONDS, REMINDER_TIMES, SEARCH_RECENCY_DAYS, SHARD_BY_OWNER, STORAGE_BACKEND,
+                    TASK_IMPORT_MAX_ROWS)
+import records
+import recurrence
+import storage
+from storage import DuplicateKeyError, conversation_key, normalize_identity, thaw, to_timestamp
 
 DATA_DIR = 'data'
 
+# 请求期间通过 store.begin() 开启的工作单元会自动接管读写
+store = storage.ScopedStore(storage.open_store(STORAGE_BACKEND, DATA_DIR))
+# 通知、消息按用户/会话分片（SQLite 本身按行存储，无需分片）
+router = storage.ShardRouter(DATA_DIR, SHARD_BY_OWNER and STORAGE_BACKEND != 'sqlite')
+
+def read_json(file_name):
+    """读取数据文件的只读缓存视图（不可修改，需修改请用 load_json）"""
+    return store.read(file_name)
+
 def load_json(file_name):
-    filepath = os.path.join(DATA_DIR, file_name)
-    if os.path.exists(filepath):
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+    """读取数据文件，返回调用方独占、可自由修改的副本"""
+    return thaw(read_json(file_name))
 
 def save_json(file_name, data):
-    filepath = os.path.join(DATA_DIR, file_name)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    store.save(file_name, data)
 
 def get_user_by_id(user_id):
-    users = load_json('users.json')
-    return users.get(str(user_id))
+    user = read_json('users.json').get(str(user_id))
+    return thaw(user) if user else None
+
+def _pick_user(users, field, value):
+    """同一用户名/邮箱（忽略大小写）对应多个用户时（建立唯一索引之前的历史数据），
+    优先取大小写完全一致的，其次取 id 最小的，结果不随索引中的顺序变化"""
+    if not users:
+        return None
+    return thaw(min(users, key=lambda u: (u.get(field) != value, int(u['id']))))
 
 def get_user_by_username(username):
-    users = load_json('users.json')
-    for uid, user in users.items():
-        if user.get('username') == username:
-            return user
-    return None
+    """按用户名查找用户（忽略大小写）"""
+    key = normalize_identity(username)
+    users = store.find('users.json', username_key=key) if key else []
+    return _pick_user(users, 'username', username)
 
 def get_user_by_email(email):
-    users = load_json('users.json')
-    for uid, user in users.items():
-        if user.get('email') == email:
-            return user
-    return None
+    """按邮箱查找用户（忽略大小写）"""
+    key = normalize_identity(email)
+    users = store.find('users.json', email_key=key) if key else []
+    return _pick_user(users, 'email', email)
+
+def find_identity_collisions():
+    """忽略大小写后重复的用户名和邮箱（建立唯一索引之前的历史数据）：[(字段, 规范值, [用户 id])]"""
+    groups = {}
+    for user in read_json('users.json').values():
+        for field in ('username', 'email'):
+            key = normalize_identity(user.get(field))
+            if key:
+                groups.setdefault((field, key), []).append(int(user['id']))
+    return [(field, key, sorted(ids)) for (field, key), ids in groups.items() if len(ids) > 1]
 
 def create_user(username, password, email, verified=False):
-    users = load_json('users.json')
-    # Generate new user id
-    user_id = 1
-    if users:
-        user_id = max(map(int, users.keys())) + 1
-    users[str(user_id)] = {
+    """创建用户；用户名或邮箱（忽略大小写）已被占用时抛出 DuplicateKeyError"""
+    user_id = store.next_id('users.json')
+    store.put('users.json', user_id, {
         'id': user_id,
         'username': username,
         'password': generate_password_hash(password),  # hashed password
@@ -60,8 +85,7 @@ def create_user(username, password, email, verified=False):
         'email_verification_attempts': 0,
         'test_email_sent_count': 0,
         'test_email_last_date': ''
-    }
-    save_json('users.json', users)
+    })
     return user_id
 
 def check_password(user, password):
@@ -83,70 +107,76 @@ def check_password(user, password):
             return False
 
 def update_user(user_id, updates):
-    users = load_json('users.json')
-    if str(user_id) in users:
-        users[str(user_id)].update(updates)
-        save_json('users.json', users)
-        return True
+    with store.transaction('users.json') as users:
+        user = users.get(user_id)
+        if user:
+            user.update(updates)
+            return True
     return False
 
+# 各集合中需要预先计算时间戳的字段：写入时同时保存 <字段>_ts（UTC 纪元秒）
+TIMESTAMP_FIELDS = {
+    'tasks.json': ('created_at', 'start_time'),
+    'notifications.json': ('created_at',),
+    'messages.json': ('created_at',),
+    'posts.json': ('created_at',),
+}
+
+def stamp_timestamps(record, fields):
+    """根据记录中的时间字段写入对应的 <字段>_ts，返回记录本身"""
+    for field in fields:
+        ts = to_timestamp(record.get(field))
+        if ts is None:
+            record.pop(f'{field}_ts', None)
+        else:
+            record[f'{field}_ts'] = ts
+    return record
+
+def record_timestamp(record, field):
+    """记录中预先计算的时间戳；尚未回填的旧记录现场解析"""
+    ts = record.get(f'{field}_ts')
+    return ts if ts is not None else to_timestamp(record.get(field))
+
+def created_order(record):
+    """按创建时间排序的键：用 created_at_ts（尚未回填的旧记录解析 created_at），
+    不按 ISO 字符串比较，带时区或精度不同的时间也能正确排序；无法解析的排在最早"""
+    return record_timestamp(record, 'created_at') or 0
+
+def day_start_timestamp(day):
+    """本地日期当天零点的纪元秒"""
+    return datetime(day.year, day.month, day.day).timestamp()
+
 def determine_task_status(start_time_str):
     """根据开始时间确定任务状态"""
-    if not start_time_str:
+    start = to_timestamp(start_time_str)
+    if start is None or time.time() < start:
         return 'pending'
-    try:
-        # 处理可能的时区信息
-        if start_time_str.endswith('Z'):
-            start_time_str = start_time_str[:-1] + '+00:00'
-        start = datetime.fromisoformat(start_time_str)
-        now = datetime.now()
-        # 如果 start 有时区信息而 now 没有，将 start 转换为本地 naive datetime
-        if start.tzinfo is not None:
-            # 转换为本地时区并移除时区信息
-            start = start.astimezone(None).replace(tzinfo=None)
-        if now < start:
-            return 'pending'
-        else:
-            return 'in_progress'
-    except ValueError:
+    return 'in_progress'
+
+def compute_task_status(task, now=None):
+    """读取时推导任务的当前状态，不写回存储。now 为纪元秒。
+    保存的状态是用户设置的覆盖值：开始前一律为待开始，开始后保存的待开始视为进行中"""
+    status = task.get('status', 'pending')
+    start = record_timestamp(task, 'start_time')
+    if start is None:
+        return status
+    if (now or time.time()) < start:
         return 'pending'
+    return 'in_progress' if status == 'pending' else status
 
-def update_task_status_if_needed(task):
-    """根据开始时间自动更新任务状态"""
-    start_time = task.get('start_time')
-    if not start_time:
-        return task
-    try:
-        # 处理可能的时区信息
-        if start_time.endswith('Z'):
-            start_time = start_time[:-1] + '+00:00'
-        start = datetime.fromisoformat(start_time)
-        now = datetime.now()
-        # 如果 start 有时区信息而 now 没有，将 start 转换为本地 naive datetime
-        if start.tzinfo is not None:
-            start = start.astimezone(None).replace(tzinfo=None)
-        
-        if now < start:
-            # 当前时间在开始时间之前
-            if task.get('status') in ('in_progress', 'completed'):
-                # 进行中或已完成的任务应重置为待开始
-                update_task(task['id'], {'status': 'pending'})
-                task['status'] = 'pending'
-        else:
-            # 当前时间已到达或超过开始时间
-            if task.get('status') == 'pending':
-                # 待开始的任务应更新为进行中
-                update_task(task['id'], {'status': 'in_progress'})
-                task['status'] = 'in_progress'
-    except ValueError:
-        pass
+def with_computed_status(task, now=None):
+    """把 task['status'] 替换为推导出的当前状态（task 须是可修改的副本）"""
+    task['status'] = compute_task_status(task, now)
     return task
 
 def add_task(user_id, task_data):
-    tasks = load_json('tasks.json')
-    task_id = 1
-    if tasks:
-        task_id = max(map(int, tasks.keys())) + 1
+    task_id = store.next_id('tasks.json')
+    prepare_task(task_id, user_id, task_data)
+    store.put('tasks.json', task_id, task_data)
+    return task_id
+
+def prepare_task(task_id, user_id, task_data):
+    """按新建任务的规则补全并规范化 task_data（原地修改）"""
     task_data['id'] = task_id
     task_data['user_id'] = user_id
     task_data['created_at'] = datetime.now().isoformat()
@@ -172,74 +202,336 @@ def add_task(user_id, task_data):
         else:
             task_data['reminder_times'] = REMINDER_TIMES
     task_data['sent_reminders'] = []
-    tasks[str(task_id)] = task_data
-    save_json('tasks.json', tasks)
-    return task_id
+    # 重复规则只保存一次，各次发生在查询时按窗口展开
+    rule = recurrence.normalize_rule(task_data.get('recurrence'))
+    if rule and to_timestamp(start_time) is None:
+        raise ValueError('重复任务必须设置开始时间')
+    if rule:
+        task_data['recurrence'] = rule
+    else:
+        task_data.pop('recurrence', None)
+    stamp_timestamps(task_data, TIMESTAMP_FIELDS['tasks.json'])
+    return task_data
+
+# 重复任务每次发生可单独覆盖的字段，只为有改动的那几次保存
+OCCURRENCE_FIELDS = ('status', 'completion_rate', 'sent_reminders')
+
+def iter_occurrences(task, start_ts, end_ts=None, now=None):
+    """重复任务开始时间在 [start_ts, end_ts) 内的各次发生，惰性产出可修改的副本：
+    id 仍是任务 id，开始时间换成该次的时间，并合并该次保存的覆盖值"""
+    rule = task['recurrence']
+    first = datetime.fromtimestamp(record_timestamp(task, 'start_time'))
+    end = datetime.fromtimestamp(end_ts) if end_ts is not None else None
+    overrides = task.get('occurrences') or {}
+    base = thaw({k: v for k, v in task.items() if k != 'occurrences'})
+    base.update(status='pending', completion_rate=0, sent_reminders=[])
+    now = now or time.time()
+    for n, when in recurrence.occurrences(first, rule, datetime.fromtimestamp(start_ts), end):
+        occurrence = dict(base, occurrence=n, start_time=when.strftime('%Y-%m-%dT%H:%M'),
+                          start_time_ts=when.timestamp())
+        occurrence.update(thaw(overrides.get(str(n), {})))
+        yield with_computed_status(occurrence, now)
+
+def get_occurrence(task, n, now=None):
+    """重复任务的第 n 次发生（与 iter_occurrences 产出的相同），不在重复范围内时返回 None"""
+    first = datetime.fromtimestamp(record_timestamp(task, 'start_time'))
+    start = recurrence.occurrence_start(first, task['recurrence'], n).timestamp()
+    return next((o for o in iter_occurrences(task, start, start + 1, now) if o['occurrence'] == n), None)
+
+def update_occurrence(task_id, n, updates):
+    """保存重复任务第 n 次发生的覆盖值；n 不在重复范围内时返回 False"""
+    with store.transaction('tasks.json') as tasks:
+        task = tasks.get(task_id)
+        if not task or not task.get('recurrence'):
+            return False
+        first = datetime.fromtimestamp(record_timestamp(task, 'start_time'))
+        if not recurrence.in_series(task['recurrence'], n,
+                                    recurrence.occurrence_start(first, task['recurrence'], n)):
+            return False
+        overrides = task.setdefault('occurrences', {})
+        overrides.setdefault(str(n), {}).update(
+            {field: value for field, value in updates.items() if field in OCCURRENCE_FIELDS})
+        return True
+
+# 批量导入/导出的任务字段
+TASK_IMPORT_FIELDS = ('name', 'description', 'start_time', 'location', 'duration', 'notes',
+                      'show_on_homepage', 'reminder_times', 'recurrence')
+TASK_EXPORT_FIELDS = ('id', 'name', 'description', 'start_time', 'location', 'duration', 'notes',
+                      'status', 'completion_rate', 'show_on_homepage', 'reminder_times', 'recurrence', 'created_at')
+
+def iter_ndjson_rows(stream):
+    """逐行读取上传的 NDJSON 文件，产出 (行号, dict)；无法解析的行产出 (行号, None)"""
+    for line_no, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8-sig'), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_no, row if isinstance(row, dict) else None
+
+def iter_csv_rows(stream):
+    """逐行读取上传的 CSV 文件（首行为表头），产出 (行号, dict)"""
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        yield reader.line_num, row
+
+def parse_import_rule(value):
+    """导入行中的重复规则：NDJSON 中为对象，CSV 中为 JSON 文本；按 prepare_task 的规则校验，无效时抛出 ValueError"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise ValueError('重复规则格式错误')
+    if value and not isinstance(value, dict):
+        raise ValueError('重复规则格式错误')
+    return recurrence.normalize_rule(value)
+
+def import_tasks(user_id, rows, max_rows=TASK_IMPORT_MAX_ROWS):
+    """批量导入任务：rows 逐条产出 (行号, dict)，每行按 add_task 的规则校验和规范化。
+    全部通过后一次分配 id 段、一次写入；任何一行出错则不导入。返回 (导入条数, 错误列表)"""
+    tasks = []
+    errors = []
+    for line_no, row in rows:
+        if len(tasks) + len(errors) >= max_rows:
+            errors.append(f'超过单次导入上限 {max_rows} 条')
+            break
+        if row is None:
+            errors.append(f'第 {line_no} 行：格式错误')
+            continue
+        task = {field: row[field] for field in TASK_IMPORT_FIELDS if row.get(field) not in (None, '')}
+        name = str(task.get('name', '')).strip()
+        if not name:
+            errors.append(f'第 {line_no} 行：缺少任务名称')
+            continue
+        task['name'] = name
+        if 'start_time' in task and to_timestamp(task['start_time']) is None:
+            errors.append(f'第 {line_no} 行：开始时间格式错误')
+            continue
+        try:
+            rule = parse_import_rule(task.pop('recurrence', None))
+        except ValueError as e:
+            errors.append(f'第 {line_no} 行：{e}')
+            continue
+        if rule and 'start_time' not in task:
+            errors.append(f'第 {line_no} 行：重复任务必须设置开始时间')
+            continue
+        task.setdefault('show_on_homepage', False)
+        reminder_times = task.pop('reminder_times', None)
+        try:
+            # 时长、是否显示在首页等按任务记录的字段类型校验并统一类型；提醒时间由 prepare_task 规范化
+            task = records.Task.coerce(task).to_dict()
+        except ValueError as e:
+            errors.append(f'第 {line_no} 行：{e}')
+            continue
+        if reminder_times is not None:
+            task['reminder_times'] = reminder_times
+        if rule:
+            task['recurrence'] = rule
+        tasks.append(task)
+    if errors or not tasks:
+        return 0, errors
+    first_id = store.reserve_ids('tasks.json', len(tasks))
+    store.apply('tasks.json', [(str(task_id), prepare_task(task_id, user_id, task))
+                               for task_id, task in enumerate(tasks, first_id)])
+    return len(tasks), []
+
+def export_tasks(user_id, fmt='ndjson'):
+    """逐条产出用户任务的 NDJSON 或 CSV 文本（含表头），不在内存中拼出整个文件"""
+    records = store.find('tasks.json', user_id=user_id)
+    now = time.time()
+
+    def rows():
+        for record in records:
+            task = {field: thaw(record.get(field)) for field in TASK_EXPORT_FIELDS}
+            task['status'] = compute_task_status(record, now)
+            yield task
+
+    if fmt == 'ndjson':
+        return (json.dumps(task, ensure_ascii=False) + '\n' for task in rows())
+
+    def csv_lines():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(TASK_EXPORT_FIELDS)
+        for task in rows():
+            task['reminder_times'] = ','.join(str(t) for t in task['reminder_times'] or [])
+            task['recurrence'] = json.dumps(task['recurrence'], ensure_ascii=False) if task['recurrence'] else None
+            writer.writerow(['' if task[f] is None else task[f] for f in TASK_EXPORT_FIELDS])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+    return csv_lines()
 
 def get_tasks_by_user(user_id):
-    tasks = load_json('tasks.json')
-    user_tasks = []
-    for tid, task in tasks.items():
-        if task.get('user_id') == user_id:
-            # 自动更新状态
-            task = update_task_status_if_needed(task)
-            user_tasks.append(task)
-    return user_tasks
+    now = time.time()
+    return [with_computed_status(thaw(task), now) for task in store.find('tasks.json', user_id=user_id)]
+
+def get_tasks_in_range(user_id, start_ts, end_ts):
+    """开始时间在 [start_ts, end_ts) 内的任务，按开始时间升序；代价与区间内的任务数成正比。
+    重复任务只展开落在区间内的各次发生"""
+    now = time.time()
+    tasks = [with_computed_status(thaw(task), now)
+             for task in store.find_range('tasks.json', 'start_time_ts', start_ts, end_ts, user_id=user_id)
+             if not task.get('recurrence')]
+    series = store.find('tasks.json', recurring=True, user_id=user_id)
+    if series:
+        for task in series:
+            tasks.extend(iter_occurrences(task, start_ts, end_ts, now))
+        tasks.sort(key=lambda t: t['start_time_ts'])
+    return tasks
+
+def get_tasks_page(user_id, limit=20, after=None, status=None, start_from=None, start_to=None):
+    """按创建时间倒序分页的任务列表，游标为上一页最后一条的 (created_at_ts, 键)。
+    可按状态和开始时间 [start_from, start_to) 过滤。返回 (任务列表, 下一页游标或 None)"""
+    now = time.time()
+
+    def where(task):
+        if status and compute_task_status(task, now) != status:
+            return False
+        if start_from is not None or start_to is not None:
+            start = record_timestamp(task, 'start_time')
+            if start is None:
+                return False
+            if start_from is not None and start < start_from:
+                return False
+            if start_to is not None and start >= start_to:
+                return False
+        return True
+
+    tasks, cursor = store.find_page('tasks.json', 'created_at_ts', limit, after, descending=True,
+                                    where=where, user_id=user_id)
+    return [with_computed_status(thaw(task), now) for task in tasks], cursor
+
+TASK_STATUSES = ('pending', 'in_progress', 'completed')
+
+def count_tasks_by_status(user_id, now=None):
+    """按推导出的当前状态统计用户的任务数。
+    计数来自按 (状态, 用户) 维护的索引：开始时间在 now 之后的一律为待开始，
+    之前的待开始算作进行中，没有开始时间的按保存的状态计。代价与任务总数无关"""
+    now = now or time.time()
+    counts = {'total': 0, 'pending': 0, 'in_progress': 0, 'completed': 0}
+    for status in TASK_STATUSES:
+        total = store.count('tasks.json', status=status, user_id=user_id)
+        scheduled = store.count_range('tasks.json', 'start_time_ts', status=status, user_id=user_id)
+        # 开始时间 <= now 即视为已开始，与 compute_task_status 一致
+        started = store.count_range('tasks.json', 'start_time_ts', None, now, inclusive_end=True,
+                                    status=status, user_id=user_id)
+        counts['total'] += total
+        counts['pending'] += scheduled - started
+        counts[status] += total - scheduled
+        counts['in_progress' if status == 'pending' else status] += started
+    return counts
+
+def get_task_ordinal(task):
+    """任务在所有者全部任务中按创建时间的序号（从 1 开始），由有序索引直接定位"""
+    position = store.position('tasks.json', 'created_at_ts', task['id'], user_id=task['user_id'])
+    return None if position is None else position + 1
+
+def search_tasks(viewer_id, query, limit=20, mine=False):
+    """全文检索 viewer 可以查看的任务（自己的任务，以及别人展示到主页的任务），mine 为真时只查自己的。
+    按词频排序并随创建时间衰减：SEARCH_RECENCY_DAYS 天前创建的任务得分减半"""
+    now = time.time()
+
+    def visible(task):
+        if task['user_id'] == viewer_id:
+            return True
+        return not mine and task.get('show_on_homepage', False)
+
+    def score(hit):
+        task, tf = hit
+        age_days = max(now - (record_timestamp(task, 'created_at') or 0), 0) / 86400
+        return tf / (1 + age_days / SEARCH_RECENCY_DAYS), record_timestamp(task, 'created_at') or 0
+
+    hits = (hit for hit in store.search('tasks.json', query) if visible(hit[0]))
+    return [with_computed_status(thaw(task), now) for task, _ in heapq.nlargest(limit, hits, key=score)]
+
+def get_recent_tasks(user_id, limit=5):
+    """最近创建的任务，直接取有序索引的末尾，无需对全部任务排序"""
+    return get_tasks_page(user_id, limit)[0]
+
+def encode_cursor(cursor):
+    return f'{cursor[0]!r}_{cursor[1]}' if cursor else None
+
+def decode_cursor(value):
+    """解析分页游标，格式错误时返回 None（从第一页开始）"""
+    try:
+        ts, key = value.split('_', 1)
+        return float(ts), key
+    except (AttributeError, ValueError):
+        return None
 
 def get_task_by_id(task_id):
-    tasks = load_json('tasks.json')
-    return tasks.get(str(task_id))
+    task = read_json('tasks.json').get(str(task_id))
+    return with_computed_status(thaw(task)) if task else None
 
 def update_task(task_id, updates):
-    tasks = load_json('tasks.json')
-    if str(task_id) in tasks:
-        tasks[str(task_id)].update(updates)
-        save_json('tasks.json', tasks)
-        return True
+    with store.transaction('tasks.json') as tasks:
+        task = tasks.get(task_id)
+        if task:
+            series = (task.get('recurrence'), record_timestamp(task, 'start_time'))
+            task.update(updates)
+            if 'recurrence' in updates:
+                rule = recurrence.normalize_rule(updates['recurrence'])
+                if rule:
+                    task['recurrence'] = rule
+                else:
+                    task.pop('recurrence', None)
+            stamp_timestamps(task, TIMESTAMP_FIELDS['tasks.json'])
+            if task.get('recurrence') and task.get('start_time_ts') is None:
+                raise ValueError('重复任务必须设置开始时间')
+            # 规则或首次开始时间变了，各次发生的序号不再对应原来的时间，旧的覆盖值作废
+            if series != (task.get('recurrence'), task.get('start_time_ts')):
+                task.pop('occurrences', None)
+                task.pop('reminded_before', None)
+            return True
     return False
 
 def delete_task(task_id):
-    tasks = load_json('tasks.json')
-    if str(task_id) in tasks:
-        del tasks[str(task_id)]
-        save_json('tasks.json', tasks)
-        return True
-    return False
+    return store.delete('tasks.json', task_id)
 
 def add_notification(user_id, title, content, ntype='system'):
-    notifications = load_json('notifications.json')
-    notif_id = 1
-    if notifications:
-        notif_id = max(map(int, notifications.keys())) + 1
-    notifications[str(notif_id)] = {
-        'id': notif_id,
-        'user_id': user_id,
-        'title': title,
-        'content': content,
-        'type': ntype,
-        'read': False,
-        'created_at': datetime.now().isoformat()
-    }
-    save_json('notifications.json', notifications)
-    return notif_id
+    return add_notifications([user_id], title, content, ntype)[0]
+
+def add_notifications(user_ids, title, content, ntype='system'):
+    """向多个用户发送同一条通知，一次分配 id 段并一次写入，返回通知 id 列表"""
+    if not user_ids:
+        return []
+    first_id = store.reserve_ids('notifications.json', len(user_ids))
+    now = datetime.now()
+    created_at = now.isoformat()
+    created_at_ts = now.timestamp()
+    shards = {}
+    for notif_id, user_id in enumerate(user_ids, first_id):
+        shards.setdefault(router.notifications(user_id), []).append((str(notif_id), {
+            'id': notif_id,
+            'user_id': user_id,
+            'title': title,
+            'content': content,
+            'type': ntype,
+            'read': False,
+            'created_at': created_at,
+            'created_at_ts': created_at_ts
+        }))
+    for name, changes in shards.items():
+        store.apply(name, changes)
+    return list(range(first_id, first_id + len(user_ids)))
 
 def get_user_notifications(user_id):
-    notifications = load_json('notifications.json')
-    user_notifs = []
-    for nid, notif in notifications.items():
-        if notif.get('user_id') == user_id:
-            user_notifs.append(notif)
-    user_notifs.sort(key=lambda x: x['created_at'], reverse=True)
+    user_notifs = [thaw(n) for n in store.find(router.notifications(user_id), user_id=user_id)]
+    user_notifs.sort(key=created_order, reverse=True)
     return user_notifs
 
+def count_unread_notifications(user_id):
+    """未读通知数：按 (read, user_id) 索引计数，不读取通知列表"""
+    return store.count(router.notifications(user_id), user_id=user_id, read=False)
+
 def get_user_notifications_paginated(user_id, page=1, per_page=20):
     """获取用户通知的分页列表"""
-    notifications = load_json('notifications.json')
-    user_notifs = []
-    for nid, notif in notifications.items():
-        if notif.get('user_id') == user_id:
-            user_notifs.append(notif)
-    user_notifs.sort(key=lambda x: x['created_at'], reverse=True)
+    user_notifs = store.find(router.notifications(user_id), user_id=user_id)
+    user_notifs.sort(key=created_order, reverse=True)
     total = len(user_notifs)
     total_pages = (total + per_page - 1) // per_page
     # 确保页码在有效范围内
@@ -249,7 +541,7 @@ def get_user_notifications_paginated(user_id, page=1, per_page=20):
         page = total_pages
     start = (page - 1) * per_page
     end = start + per_page
-    paginated = user_notifs[start:end]
+    paginated = [thaw(n) for n in user_notifs[start:end]]
     return {
         'notifications': paginated,
         'total': total,
@@ -304,64 +596,62 @@ def generate_pagination_range(current_page, total_pages, left_edge=2, right_edge
             unique_pages.append(p)
     return unique_pages
 
-def mark_notification_read(notif_id):
-    notifications = load_json('notifications.json')
-    if str(notif_id) in notifications:
-        notifications[str(notif_id)]['read'] = True
-        save_json('notifications.json', notifications)
-        return True
+def mark_notification_read(notif_id, user_id):
+    """把用户自己的一条通知标记为已读"""
+    with store.transaction(router.notifications(user_id)) as notifications:
+        notif = notifications.get(notif_id)
+        if notif and notif['user_id'] == user_id:
+            notif['read'] = True
+            return True
     return False
 
 # Friendship functions
 def follow_user(follower_id, followee_id):
-    friendships = load_json('friendships.json')
     key = f"{follower_id}_{followee_id}"
-    if key not in friendships:
+    # 固定加锁顺序：先 friendships 再 users，避免与 unfollow_user 互相等待
+    with store.transaction('friendships.json') as friendships:
+        if key in friendships:
+            return False
         friendships[key] = {
             'follower_id': follower_id,
             'followee_id': followee_id,
             'created_at': datetime.now().isoformat()
         }
-        save_json('friendships.json', friendships)
         # Update user's followers/following lists
-        users = load_json('users.json')
-        if str(follower_id) in users:
-            if followee_id not in users[str(follower_id)].get('following', []):
-                users[str(follower_id)]['following'].append(followee_id)
-        if str(followee_id) in users:
-            if follower_id not in users[str(followee_id)].get('followers', []):
-                users[str(followee_id)]['followers'].append(follower_id)
-        save_json('users.json', users)
-        return True
-    return False
+        with store.transaction('users.json') as users:
+            follower = users.get(follower_id)
+            if follower and followee_id not in follower.get('following', []):
+                follower.setdefault('following', []).append(followee_id)
+            followee = users.get(followee_id)
+            if followee and follower_id not in followee.get('followers', []):
+                followee.setdefault('followers', []).append(follower_id)
+    return True
 
 def unfollow_user(follower_id, followee_id):
-    friendships = load_json('friendships.json')
     key = f"{follower_id}_{followee_id}"
-    if key in friendships:
+    with store.transaction('friendships.json') as friendships:
+        if key not in friendships:
+            return False
         del friendships[key]
-        save_json('friendships.json', friendships)
         # Update user's followers/following lists
-        users = load_json('users.json')
-        if str(follower_id) in users:
-            if followee_id in users[str(follower_id)].get('following', []):
-                users[str(follower_id)]['following'].remove(followee_id)
-        if str(followee_id) in users:
-            if follower_id in users[str(followee_id)].get('followers', []):
-                users[str(followee_id)]['followers'].remove(follower_id)
-        save_json('users.json', users)
-        return True
-    return False
+        with store.transaction('users.json') as users:
+            follower = users.get(follower_id)
+            if follower and followee_id in follower.get('following', []):
+                follower['following'].remove(followee_id)
+            followee = users.get(followee_id)
+            if followee and follower_id in followee.get('followers', []):
+                followee['followers'].remove(follower_id)
+    return True
 
 def are_mutual_followers(user_id1, user_id2):
-    friendships = load_json('friendships.json')
+    friendships = read_json('friendships.json')
     key1 = f"{user_id1}_{user_id2}"
     key2 = f"{user_id2}_{user_id1}"
     return key1 in friendships and key2 in friendships
 
 def get_following(user_id):
     """获取用户关注的用户列表（关注对象）"""
-    users = load_json('users.json')
+    users = read_json('users.json')
     user = users.get(str(user_id))
     if not user:
         return []
@@ -370,12 +660,12 @@ def get_following(user_id):
     for uid in following_ids:
         u = users.get(str(uid))
         if u:
-            following.append(u)
+            following.append(thaw(u))
     return following
 
 def get_followers(user_id):
     """获取用户的粉丝列表"""
-    users = load_json('users.json')
+    users = read_json('users.json')
     user = users.get(str(user_id))
     if not user:
         return []
@@ -384,12 +674,12 @@ def get_followers(user_id):
     for uid in follower_ids:
         u = users.get(str(uid))
         if u:
-            followers.append(u)
+            followers.append(thaw(u))
     return followers
 
 def search_users(query, current_user_id):
     """根据关键词搜索用户，返回分类结果"""
-    users = load_json('users.json')
+    users = read_json('users.json')
     current_user = users.get(str(current_user_id))
     following_ids = set(current_user.get('following', [])) if current_user else set()
     follower_ids = set(current_user.get('followers', [])) if current_user else set()
@@ -422,7 +712,7 @@ def search_users(query, current_user_id):
 
 def is_following(follower_id, followee_id):
     """检查 follower_id 是否关注了 followee_id"""
-    users = load_json('users.json')
+    users = read_json('users.json')
     follower = users.get(str(follower_id))
     if not follower:
         return False
@@ -430,81 +720,71 @@ def is_following(follower_id, followee_id):
 
 # Message functions
 def send_message(sender_id, receiver_id, content):
-    messages = load_json('messages.json')
-    msg_id = 1
-    if messages:
-        msg_id = max(map(int, messages.keys())) + 1
-    messages[str(msg_id)] = {
+    msg_id = store.next_id('messages.json')
+    now = datetime.now()
+    store.put(router.messages(sender_id, receiver_id), msg_id, {
         'id': msg_id,
         'sender_id': sender_id,
         'receiver_id': receiver_id,
         'content': content,
         'read': False,
-        'created_at': datetime.now().isoformat()
-    }
-    save_json('messages.json', messages)
+        'created_at': now.isoformat(),
+        'created_at_ts': now.timestamp()
+    })
     return msg_id
 
 def get_messages_between(user1_id, user2_id, limit=None, offset=0, reverse=True):
     """获取两个用户之间的消息列表，支持分页和排序"""
-    messages = load_json('messages.json')
-    conversation = []
-    for mid, msg in messages.items():
-        if (msg['sender_id'] == user1_id and msg['receiver_id'] == user2_id) or \
-           (msg['sender_id'] == user2_id and msg['receiver_id'] == user1_id):
-            conversation.append(msg)
+    conversation = store.find(router.messages(user1_id, user2_id),
+                              conversation=conversation_key(user1_id, user2_id))
     # Sort by time
-    conversation.sort(key=lambda x: x['created_at'], reverse=reverse)
+    conversation.sort(key=created_order, reverse=reverse)
     # Apply pagination if limit is specified
     if limit is not None:
         start = offset
         end = offset + limit
         conversation = conversation[start:end]
-    return conversation
+    return [thaw(msg) for msg in conversation]
+
+def count_messages():
+    """全站消息总数"""
+    return sum(len(read_json(name)) for name in router.collections('messages.json'))
 
 def count_messages_today(sender_id, receiver_id):
-    today = datetime.now().date()
-    messages = load_json('messages.json')
+    today_start = day_start_timestamp(datetime.now().date())
     count = 0
-    for mid, msg in messages.items():
-        if msg['sender_id'] == sender_id and msg['receiver_id'] == receiver_id:
-            msg_date = datetime.fromisoformat(msg['created_at']).date()
-            if msg_date == today:
-                count += 1
+    for msg in store.find(router.messages(sender_id, receiver_id), sender_id=sender_id, receiver_id=receiver_id):
+        ts = record_timestamp(msg, 'created_at')
+        if ts is not None and ts >= today_start:
+            count += 1
     return count
 
 # Post functions
 def create_post(user_id, content, images=None):
-    posts = load_json('posts.json')
-    post_id = 1
-    if posts:
-        post_id = max(map(int, posts.keys())) + 1
-    posts[str(post_id)] = {
+    post_id = store.next_id('posts.json')
+    now = datetime.now()
+    store.put('posts.json', post_id, {
         'id': post_id,
         'user_id': user_id,
         'content': content,
         'images': images or [],
         'likes': [],
         'comments': [],
-        'created_at': datetime.now().isoformat()
-    }
-    save_json('posts.json', posts)
+        'created_at': now.isoformat(),
+        'created_at_ts': now.timestamp()
+    })
     return post_id
 
 def get_posts_by_user(user_id):
-    posts = load_json('posts.json')
-    user_posts = []
-    for pid, post in posts.items():
-        if post.get('user_id') == user_id:
-            user_posts.append(post)
-    return user_posts
+    return [thaw(post) for post in store.find('posts.json', user_id=user_id)]
 
 def get_all_posts():
-    posts = load_json('posts.json')
+    posts = read_json('posts.json')
+    users = read_json('users.json')
     enriched = []
     for post in posts.values():
-        post_copy = post.copy()
-        user = get_user_by_id(post['user_id'])
+        post_copy = thaw(post)
+        user = users.get(str(post['user_id']))
         if user:
             post_copy['user_name'] = user.get('nickname') or user.get('username')
             post_copy['user_avatar'] = user.get('avatar')
@@ -515,7 +795,7 @@ def get_all_posts():
         comments_with_user = []
         for comment in post_copy.get('comments', []):
             comment_copy = comment.copy()
-            comment_user = get_user_by_id(comment['user_id'])
+            comment_user = users.get(str(comment['user_id']))
             if comment_user:
                 comment_copy['user_name'] = comment_user.get('nickname') or comment_user.get('username')
                 comment_copy['user_avatar'] = comment_user.get('avatar')
@@ -528,171 +808,259 @@ def get_all_posts():
     return enriched
 
 def get_post_by_id(post_id):
-    posts = load_json('posts.json')
-    return posts.get(str(post_id))
+    post = read_json('posts.json').get(str(post_id))
+    return thaw(post) if post else None
 
 def update_post(post_id, updates):
-    posts = load_json('posts.json')
-    if str(post_id) in posts:
-        posts[str(post_id)].update(updates)
-        save_json('posts.json', posts)
-        return True
+    with store.transaction('posts.json') as posts:
+        post = posts.get(post_id)
+        if post:
+            post.update(updates)
+            return True
     return False
 
 def delete_post(post_id):
-    posts = load_json('posts.json')
-    if str(post_id) in posts:
-        del posts[str(post_id)]
-        save_json('posts.json', posts)
-        return True
-    return False
+    return store.delete('posts.json', post_id)
 
 def toggle_like(post_id, user_id):
     """切换用户对帖子的点赞状态（如果已点赞则取消，否则点赞）"""
-    posts = load_json('posts.json')
-    if str(post_id) not in posts:
-        return False
-    post = posts[str(post_id)]
-    likes = post.get('likes', [])
-    if user_id in likes:
-        likes.remove(user_id)
-    else:
-        likes.append(user_id)
-    post['likes'] = likes
-    save_json('posts.json', posts)
+    with store.transaction('posts.json') as posts:
+        post = posts.get(post_id)
+        if not post:
+            return False
+        likes = post.get('likes', [])
+        if user_id in likes:
+            likes.remove(user_id)
+        else:
+            likes.append(user_id)
+        post['likes'] = likes
     return True
 
 def add_comment(post_id, user_id, content):
     """为帖子添加评论"""
-    posts = load_json('posts.json')
-    if str(post_id) not in posts:
-        return False
-    post = posts[str(post_id)]
-    comments = post.get('comments', [])
-    # 生成新评论ID
-    comment_id = 1
-    if comments:
-        comment_id = max(c.get('id', 0) for c in comments) + 1
-    new_comment = {
-        'id': comment_id,
-        'user_id': user_id,
-        'content': content,
-        'likes': [],
-        'created_at': datetime.now().isoformat()
-    }
-    comments.append(new_comment)
-    post['comments'] = comments
-    save_json('posts.json', posts)
+    with store.transaction('posts.json') as posts:
+        post = posts.get(post_id)
+        if not post:
+            return False
+        comments = post.get('comments', [])
+        # 生成新评论ID
+        comment_id = 1
+        if comments:
+            comment_id = max(c.get('id', 0) for c in comments) + 1
+        now = datetime.now()
+        new_comment = {
+            'id': comment_id,
+            'user_id': user_id,
+            'content': content,
+            'likes': [],
+            'created_at': now.isoformat(),
+            'created_at_ts': now.timestamp()
+        }
+        comments.append(new_comment)
+        post['comments'] = comments
     return comment_id
 
 def toggle_comment_like(post_id, comment_id, user_id):
     """切换用户对评论的点赞状态"""
-    posts = load_json('posts.json')
-    if str(post_id) not in posts:
-        return False
-    post = posts[str(post_id)]
-    comments = post.get('comments', [])
-    for comment in comments:
-        if comment['id'] == comment_id:
-            likes = comment.get('likes', [])
-            if user_id in likes:
-                likes.remove(user_id)
-            else:
-                likes.append(user_id)
-            comment['likes'] = likes
-            save_json('posts.json', posts)
-            return True
+    with store.transaction('posts.json') as posts:
+        post = posts.get(post_id)
+        if not post:
+            return False
+        comments = post.get('comments', [])
+        for comment in comments:
+            if comment['id'] == comment_id:
+                likes = comment.get('likes', [])
+                if user_id in likes:
+                    likes.remove(user_id)
+                else:
+                    likes.append(user_id)
+                comment['likes'] = likes
+                return True
     return False
 
 def delete_comment(post_id, comment_id, user_id):
     """删除评论（仅评论发布者或帖子所有者可删除）"""
-    posts = load_json('posts.json')
-    if str(post_id) not in posts:
-        return False
-    post = posts[str(post_id)]
-    comments = post.get('comments', [])
-    for i, comment in enumerate(comments):
-        if comment['id'] == comment_id:
-            # 检查权限：评论发布者或帖子所有者
-            if comment['user_id'] == user_id or post['user_id'] == user_id:
-                del comments[i]
-                post['comments'] = comments
-                save_json('posts.json', posts)
-                return True
-            else:
-                return False
+    with store.transaction('posts.json') as posts:
+        post = posts.get(post_id)
+        if not post:
+            return False
+        comments = post.get('comments', [])
+        for i, comment in enumerate(comments):
+            if comment['id'] == comment_id:
+                # 检查权限：评论发布者或帖子所有者
+                if comment['user_id'] == user_id or post['user_id'] == user_id:
+                    del comments[i]
+                    post['comments'] = comments
+                    return True
+                else:
+                    return False
     return False
 
-def check_task_reminders():
-    """检查即将开始的任务，并发送通知和邮件提醒"""
-    tasks = load_json('tasks.json')
-    now = datetime.now()
-    print(f"[提醒检查] 开始检查，当前时间: {now}")
-    for tid, task in tasks.items():
-        if not task.get('start_time'):
-            continue
-        try:
-            start = datetime.fromisoformat(task['start_time'])
-        except ValueError:
+def task_reminder_times(task):
+    """任务的提醒时间列表（开始前的分钟数），没有或格式不对时使用全局配置"""
+    reminder_times = task.get('reminder_times', REMINDER_TIMES)
+    return reminder_times if isinstance(reminder_times, list) else REMINDER_TIMES
+
+def reminder_entry(sent_reminders, minutes):
+    """sent_reminders 中提醒 minutes 的发送记录 {'minutes', 'status', 'attempts', ...}，没有时返回 None。
+    status：queued（已认领待发送）、retry（等待重试，next_at 为重试时间）、sent、failed、
+    missed（错过时任务已开始，合并在一条错过提醒的通知中）；
+    旧数据只记录分钟数（整数），视为已发送"""
+    for item in sent_reminders or ():
+        if isinstance(item, dict):
+            if item.get('minutes') == minutes:
+                return item
+        elif item == minutes:
+            return {'minutes': minutes, 'status': 'sent'}
+    return None
+
+def occurrence_reminded(task, n):
+    """重复任务的第 n 次发生是否在 reminded_before 之前：其发送记录已经清理，提醒都视为已处理"""
+    return n is not None and n < (task.get('reminded_before') or 0)
+
+def _occurrence_finished(task, override, start, now):
+    """一次发生的提醒是否都已处理完：已经开始，每个提醒都有 queued/retry 之外的记录；
+    没有记录的提醒须是不会再补发的（触发时间早于任务创建或超出补发的回看范围）"""
+    if start > now:
+        return False
+    sent = (override or {}).get('sent_reminders')
+    created = record_timestamp(task, 'created_at') or 0
+    for minutes in task_reminder_times(task):
+        if minutes <= 0:
             continue
-        # 计算距离开始还有多少分钟
-        delta = start - now
-        minutes = delta.total_seconds() / 60
-        print(f"[提醒检查] 任务 {task['name']} 开始时间 {start}，距离开始 {minutes:.1f} 分钟")
-        
-        # 获取提醒时间列表，如果没有则使用全局配置
-        reminder_times = task.get('reminder_times', REMINDER_TIMES)
-        if not isinstance(reminder_times, list):
-            # 如果格式不对，回退到默认
-            reminder_times = REMINDER_TIMES
-        print(f"[提醒检查] 提醒时间列表: {reminder_times}")
-        
-        user_id = task['user_id']
-        user = get_user_by_id(user_id)
-        user_email = user.get('email') if user else None
-        
-        # 获取已发送提醒列表
-        sent_reminders = task.get('sent_reminders', [])
-        # 检查每个提醒时间
-        for remind_minutes in reminder_times:
-            if remind_minutes <= 0:
+        entry = reminder_entry(sent, minutes)
+        if entry is None:
+            fire_at = start - minutes * 60
+            if fire_at >= created and fire_at >= now - REMINDER_CATCHUP_MAX_SECONDS:
+                return False
+        elif entry['status'] in ('queued', 'retry'):
+            return False
+    return True
+
+def prune_occurrences(task, now, keep=()):
+    """reminded_before 越过从当前值起连续、提醒都已处理完的各次发生，遇到第一个未处理完的发生即停止；
+    之前的各次发生中没有覆盖状态和完成率的记录（keep 中的序号除外）删除，使 occurrences 不随发生次数无限增长"""
+    overrides = task.get('occurrences') or {}
+    rule = task['recurrence']
+    first = datetime.fromtimestamp(record_timestamp(task, 'start_time'))
+    n = task.get('reminded_before') or 0
+    while True:
+        start = recurrence.occurrence_start(first, rule, n)
+        if not recurrence.in_series(rule, n, start) or not _occurrence_finished(task, overrides.get(str(n)),
+                                                                                start.timestamp(), now):
+            break
+        n += 1
+    if n > (task.get('reminded_before') or 0):
+        task['reminded_before'] = n
+    for key in [key for key in overrides if int(key) < n and key not in keep]:
+        if not set(overrides[key]) - {'sent_reminders'}:
+            del overrides[key]
+    if 'occurrences' in task and not overrides:
+        del task['occurrences']
+
+def update_reminder_entries(updates, claim=False, started=(), now=None):
+    """把一批提醒发送记录的修改合并为一次 tasks.json 写入，返回与 updates 对应的更新后记录。
+    updates 为 (任务 id, 发生序号 n（非重复任务为 None）, 分钟数, 修改) 列表；
+    claim 为真时用于认领：只在尚无记录时新建，已有记录（已被认领或已发送）的结果为 None，
+    同时清理认领的重复任务中此前已经开始的各次发生的记录（prune_occurrences）。
+    started 中已到开始时间、保存的状态仍是待开始的任务在同一次写入中落盘为进行中
+    （读取时已按开始时间推导状态，这里只是落盘；重复任务各次发生的状态只在读取时推导，不写回）"""
+    now = now or time.time()
+    results = []
+    claimed = {}
+    with store.transaction('tasks.json') as tasks:
+        for task_id, n, minutes, changes in updates:
+            task = tasks.get(str(task_id))
+            if not task or (claim and occurrence_reminded(task, n)):
+                results.append(None)
                 continue
-            # 检查当前分钟是否在提醒时间窗口内（考虑到检查可能不是精确的每分钟）
-            if remind_minutes - 2 <= minutes <= remind_minutes + 2:
-                # 检查是否已发送过该提醒
-                if remind_minutes in sent_reminders:
-                    print(f"[提醒检查] 提醒已发送过，跳过: 任务 {task['name']} 在 {remind_minutes} 分钟后开始")
-                    continue
-                print(f"[提醒检查] 触发提醒！任务 {task['name']} 将在 {remind_minutes} 分钟后开始")
-                # 发送通知
-                add_notification(user_id, '任务即将开始',
-                                 f"任务「{task['name']}」将在{remind_minutes}分钟后开始。",
-                                 'reminder')
-                # 发送邮件
-                if user_email:
-                    subject = f'Smart To-Do 任务提醒：{task["name"]}'
-                    body = f'''您的任务「{task['name']}」将在{remind_minutes}分钟后开始。
+            if claim and n is not None:
+                # 本次写入的记录留到下一次认领时再清理
+                claimed.setdefault(str(task_id), set()).add(str(n))
+            holder = task if n is None else task.setdefault('occurrences', {}).setdefault(str(n), {})
+            sent_reminders = holder.setdefault('sent_reminders', [])
+            for i, item in enumerate(sent_reminders):
+                if (item.get('minutes') if isinstance(item, dict) else item) == minutes:
+                    if claim:
+                        results.append(None)
+                    else:
+                        if not isinstance(item, dict):
+                            item = sent_reminders[i] = {'minutes': minutes, 'status': 'sent'}
+                        item.update(changes)
+                        results.append(dict(item))
+                    break
+            else:
+                if claim:
+                    entry = dict(changes, minutes=minutes)
+                    sent_reminders.append(entry)
+                    results.append(dict(entry))
+                else:
+                    results.append(None)
+        for tid in started:
+            task = tasks.get(str(tid))
+            if task and task.get('status') == 'pending' and not task.get('recurrence'):
+                print(f"[提醒检查] 任务 {task['name']} 已开始，更新状态为进行中")
+                task['status'] = 'in_progress'
+        for tid, keep in claimed.items():
+            prune_occurrences(tasks[tid], now, keep)
+    return results
+
+def notification_record(notif_id, user_id, title, content, ntype='system'):
+    """已分配 id 的通知记录，由 insert_notifications 写入"""
+    now = datetime.now()
+    return {
+        'id': notif_id,
+        'user_id': user_id,
+        'title': title,
+        'content': content,
+        'type': ntype,
+        'read': False,
+        'created_at': now.isoformat(),
+        'created_at_ts': now.timestamp()
+    }
+
+def reminder_notification(task, remind_minutes, notif_id):
+    """任务提醒的站内通知记录；id 在认领提醒时预留，同一提醒再次写入不会产生第二条通知"""
+    return notification_record(notif_id, task['user_id'], '任务即将开始',
+                               f"任务「{task['name']}」将在{remind_minutes}分钟后开始。", 'reminder')
+
+def missed_reminders_notification(user_id, tasks, notif_id):
+    """提醒服务停止期间错过、且任务已经开始的提醒合并成的一条通知；tasks 为这些任务或某次发生"""
+    names = list(dict.fromkeys(task['name'] for task in tasks))
+    shown = '、'.join(f'「{name}」' for name in names[:5])
+    if len(names) > 5:
+        shown += f' 等 {len(names)} 个任务'
+    return notification_record(notif_id, user_id, '错过的任务提醒',
+                               f'提醒服务暂停期间，任务{shown}已经开始，未能按时提醒。', 'reminder')
+
+def insert_notifications(notifications):
+    """写入已分配 id 的通知，每个分片一次写入；已存在的通知保持不变，返回新写入的条数"""
+    shards = {}
+    for notif in notifications:
+        name = router.notifications(notif['user_id'])
+        if store.get(name, notif['id']) is None:
+            shards.setdefault(name, []).append((str(notif['id']), notif))
+    for name, changes in shards.items():
+        store.apply(name, changes)
+    return sum(len(changes) for changes in shards.values())
+
+def email_task_reminder(task, remind_minutes, timeout=30):
+    """发送任务提醒邮件，失败时抛出异常（邮箱未配置时为 ValueError）；用户没有邮箱时直接返回"""
+    user = get_user_by_id(task['user_id'])
+    user_email = user.get('email') if user else None
+    if not user_email:
+        print(f"[提醒检查] 用户无邮箱，跳过邮件发送")
+        return
+    subject = f'Smart To-Do 任务提醒：{task["name"]}'
+    body = f'''您的任务「{task['name']}」将在{remind_minutes}分钟后开始。
 开始时间：{task['start_time']}
 地点：{task.get('location', '未设置')}
 备注：{task.get('notes', '无')}
 请做好准备！
 '''
-                    try:
-                        send_email(user_email, subject, body)
-                        print(f"[提醒检查] 提醒邮件已发送至 {user_email}")
-                    except Exception as e:
-                        print(f"[提醒检查] 发送提醒邮件失败: {e}")
-                else:
-                    print(f"[提醒检查] 用户无邮箱，跳过邮件发送")
-                # 记录已发送提醒
-                sent_reminders.append(remind_minutes)
-                update_task(int(tid), {'sent_reminders': sent_reminders})
-                break  # 只触发一个提醒（避免同一任务多个提醒同时触发）
-        
-        # 如果任务已经开始，自动更新状态为进行中
-        if minutes <= 0 and task.get('status') == 'pending':
-            print(f"[提醒检查] 任务 {task['name']} 已开始，更新状态为进行中")
-            update_task(int(tid), {'status': 'in_progress'})
+    if not send_email(user_email, subject, body, timeout=timeout):
+        raise RuntimeError(f'发送提醒邮件至 {user_email} 失败')
+    print(f"[提醒检查] 提醒邮件已发送至 {user_email}")
 
 def get_user_stats(user_id, days=7):
     """获取用户统计数据"""
@@ -718,14 +1086,16 @@ def get_user_stats(user_id, days=7):
                 pass
     avg_rate = sum(completion_rates) / len(completion_rates) if completion_rates else 0
     
-    # 按日期统计完成率
+    # 按日期统计完成率；重复任务只展开统计窗口内的各次发生，按发生日期计入
     date_rates = {}
-    for task in tasks:
-        if task.get('created_at'):
-            try:
-                date = datetime.fromisoformat(task['created_at'].replace('Z', '+00:00')).date()
-            except ValueError:
-                continue
+    window_start = day_start_timestamp(now.date() - timedelta(days=days - 1))
+    window_end = day_start_timestamp(now.date() + timedelta(days=1))
+    occurrences = [occurrence for task in tasks if task.get('recurrence')
+                   for occurrence in iter_occurrences(task, window_start, window_end)]
+    for task in [t for t in tasks if not t.get('recurrence')] + occurrences:
+        ts = record_timestamp(task, 'start_time' if 'occurrence' in task else 'created_at')
+        if ts is not None:
+            date = datetime.fromtimestamp(ts).date()
             rate = task.get('completion_rate', 0)
             if isinstance(rate, str):
                 try:
@@ -884,8 +1254,8 @@ def update_email_config(mail_server=None, mail_port=None, mail_use_tls=None,
         config['mail_default_sender'] = mail_default_sender
     save_config(config)
 
-def send_email(to_email, subject, body):
-    """发送邮件"""
+def send_email(to_email, subject, body, timeout=30):
+    """发送邮件；timeout 为 SMTP 连接和每次读写的超时秒数"""
     config = get_email_config()
     mail_server = config['mail_server']
     mail_port = config['mail_port']
@@ -910,7 +1280,7 @@ def send_email(to_email, subject, body):
         print(f"尝试发送邮件到 {to_email}，使用服务器 {mail_server}:{mail_port}，发件人 {mail_default_sender}")
         if mail_port == 465:
             print("使用 SSL (SMTP_SSL) 连接")
-            with smtplib.SMTP_SSL(mail_server, mail_port, timeout=30) as server:
+            with smtplib.SMTP_SSL(mail_server, mail_port, timeout=timeout) as server:
                 server.ehlo()
                 print(f"登录用户 {mail_username}")
                 server.login(mail_username, mail_password)
@@ -918,7 +1288,7 @@ def send_email(to_email, subject, body):
                 server.sendmail(mail_default_sender, [to_email], msg.as_string())
                 print("邮件发送完成")
         else:
-            with smtplib.SMTP(mail_server, mail_port, timeout=30) as server:
+            with smtplib.SMTP(mail_server, mail_port, timeout=timeout) as server:
                 server.ehlo()
                 if mail_use_tls:
                     print("启用 TLS...")
@@ -1040,10 +1410,13 @@ def can_send_test_email(user_id):
 
 def get_test_email_quota(user_id):
     """获取用户今日测试邮件的配额信息"""
-    user = get_user_by_id(user_id)
+    return test_email_quota(read_json('users.json').get(str(user_id)))
+
+def test_email_quota(user, today=None):
+    """由用户记录计算 today 的测试邮件配额（不读取存储）"""
     if not user:
         return {'sent': 0, 'limit': 3, 'remaining': 0, 'allowed': False}
-    today = datetime.now().date()
+    today = today or datetime.now().date()
     last_date_str = user.get('test_email_last_date', '')
     count = user.get('test_email_sent_count', 0)
     